@@ -29,7 +29,7 @@
 # Sharing    - http://wiki.laptop.org/go/Shared_Sugar_Activities
 
 # Import standard Python modules.
-import logging, os, sys, math, time, copy, json, tempfile
+import logging, os, sys, math, time, copy, tempfile
 from gettext import gettext as _
 
 # Prefer local modules.
@@ -44,33 +44,22 @@ except (ImportError, AttributeError):
 
 # Import the C++ component of the activity.
 from colorsc import *
+from videopaint import *
+from latency import *
 
 # Import PyGTK.
 import gobject, pygtk, gtk, pango
 # Needed to avoid thread crashes with GStreamer
 gobject.threads_init()  
 
-# Import PyGame.  Used for camera and sound.
-try:
-    from pygame import camera, transform, surface, mask
-except ImportError:
-    print "No pygame available."
-
-# Import DBUS and mesh networking modules.
-import dbus, telepathy, telepathy.client
-from dbus import Interface
-from dbus.service import method, signal
-from dbus.gobject_service import ExportedGObject
-from sugar.presence.tubeconn import TubeConnection
-from sugar.presence import presenceservice
-from sugar.datastore import datastore
-
 # Import Sugar UI modules.
-from sugar import graphics
-from sugar.graphics import *
-from sugar.graphics import toggletoolbutton
+from sugar.graphics import style, toolbutton, toggletoolbutton, alert
 from sugar.graphics.menuitem import MenuItem
 
+# Optional features import their modules where they are first used, so that starting the activity doesn't pay for
+# them: Pygame in scan_cameras, DBus and telepathy once the activity is shared (see mesh.py), the presence service in
+# init_presence and the datastore when saving to the Journal.  See the imports benchmark in colorsc/benchmark.py.
+
 # Import GStreamer (for camera access).
 #import pygst, gst
 
@@ -83,11 +72,6 @@ logging.basicConfig()
 #import gc
 #gc.set_debug(gc.DEBUG_LEAK)
 
-# DBUS identifiers are used to uniquely identify the activity for network communcations.
-DBUS_IFACE   = "org.laptop.community.Colors"
-DBUS_PATH    = "/org/laptop/community/Colors"
-DBUS_SERVICE = DBUS_IFACE
-
 # This is the overlay that appears when the user presses the Palette toobar button.  It covers the entire screen,
 # and offers controls for brush type, size, opacity, and color.
 # 
@@ -233,9 +217,10 @@ class BrushControlsPanel(gtk.HBox):
         old_foreground = gc.foreground
         old_line_width = gc.line_width
         
-        # Draw palette image.
+        # Draw palette image.  The triangle is only rendered again if the hue has changed.
         self.palette.render_triangle(self.paletteimage)
-        self.palettearea.window.draw_image(gc, self.paletteimage, 0, 0, 0, 0, -1, -1)
+        a = event.area
+        self.palettearea.window.draw_image(gc, self.paletteimage, a.x, a.y, a.x, a.y, a.width, a.height)
         
         # Draw circles to indicate selected color.
         # todo- Better looking circles.
@@ -259,11 +244,27 @@ class BrushControlsPanel(gtk.HBox):
         gc.foreground = old_foreground
         gc.line_width = old_line_width
 
+    # Returns the areas covered by the wheel and triangle cursor circles, as (x, y, w, h) tuples.
+    def get_palette_cursor_rects (self):
+        r = int(self.palette.WHEEL_WIDTH*0.75)
+        rects = []
+        for pos in (self.palette.get_wheel_pos(), self.palette.get_triangle_pos()):
+            # Allow for the line width.
+            rects.append((int(pos.x-r/2)-2, int(pos.y-r/2)-2, r+4, r+4))
+        return rects
+
     def on_palette_mouse (self, widget, event):
         if event.state & gtk.gdk.BUTTON1_MASK:
             widget.grab_focus()
+            old_h = self.palette.palette_h
+            old_rects = self.get_palette_cursor_rects()
             self.palette.process_mouse(int(event.x), int(event.y))
-            self.palettearea.queue_draw()
+            # The triangle rotates with the hue, otherwise only the cursor circles need repainting.
+            if self.palette.palette_h != old_h:
+                inner = self.palette.WHEEL_WIDTH
+                self.palettearea.queue_draw_area(inner, inner, BrushControlsPanel.PALETTE_SIZE-2*inner, BrushControlsPanel.PALETTE_SIZE-2*inner)
+            for x, y, w, h in old_rects + self.get_palette_cursor_rects():
+                self.palettearea.queue_draw_area(x, y, w, h)
             self.brush.color = self.palette.get_color()
             self.previewarea.queue_draw()
         if event.type == gtk.gdk.BUTTON_RELEASE:
@@ -360,7 +361,7 @@ Alt Enter - Full screen
 # This is the main Colors! activity class.
 # 
 # It owns the main application window, the painting canvas, and all the various toolbars and options.
-class Colors(activity.Activity, ExportedGObject):
+class Colors(activity.Activity):
     # Application mode definitions.
     MODE_INTRO     = 0
     MODE_PLAYBACK  = 1
@@ -383,13 +384,45 @@ class Colors(activity.Activity, ExportedGObject):
     BUTTON_CONTROL    = 1<<9
     BUTTON_UNDO       = 1<<10
 
+    # Number of recent drawing command batches the host keeps for peers who missed some.
+    DRAW_HISTORY_SIZE = 256
+
+    # Milliseconds a peer waits for missing batches or a snapshot it asked the host for, before asking again.
+    DRAW_REQUEST_TIMEOUT = 2000
+
+    # Milliseconds between the host's announcements of the next batch number, and how many it makes after each batch.
+    DRAW_SEQ_ANNOUNCE_INTERVAL = 1000
+    DRAW_SEQ_ANNOUNCE_COUNT = 3
+
+    # The intro was drawn on a DS at 60hz, and is played back 8 times as fast to make it watchable.  It is played
+    # against the clock, a frame at a time, rather than 8 commands per update as fast as the main loop allows, which
+    # kept the CPU busy blitting to the screen throughout startup.
+    INTRO_COMMANDS_PER_SECOND = 8*60
+    INTRO_FRAME_TIME = 33   # Milliseconds.
+
     # Number of drawing steps to execute between progress bar updates.  More updates means faster overall drawing
     # but a less responsive UI.
     PROGRESS_DELTA  = 50
 
+    # Space on disk for the pixels of drawings resumed from the Journal, see rendercache.py.  0 disables the cache.
+    # Only drawings which took at least RENDER_CACHE_MIN_TIME seconds to replay are stored, as restoring the pixels of
+    # short drawings takes longer than replaying them.  Drawings saved with snapshots (see Canvas::make_next_snapshot) are
+    # usually quicker than that to open already.
+    RENDER_CACHE_BYTES = 16*1024*1024
+    RENDER_CACHE_MIN_TIME = 0.05
+
+    # Startup is split into the critical path run by __init__, which gets the window and canvas on the screen, and
+    # the rest, which is run from idle callbacks once the window has been painted, see run_deferred_init.  The time
+    # taken by each phase is logged.
+
     def __init__ (self, handle):
+        self.startup_time = time.time()
+        self.startup_phase_time = self.startup_time
+        self.startup_painted = False
+
         activity.Activity.__init__(self, handle)
         self.set_title(_("Colors!"))
+        self.log_startup_phase("activity")
         
         # Uncomment to test out a bunch of the C++ heavy lifting APIs.  Takes awhile on the XO though.
         #self.benchmark()
@@ -409,50 +442,109 @@ class Colors(activity.Activity, ExportedGObject):
         
         # Build the toolbar.
         self.build_toolbar()
+        self.log_startup_phase("toolbar")
         
         # Set up drawing canvas (which is also the parent for any popup widgets like the brush controls).
         self.build_canvas()
+        self.log_startup_phase("canvas")
         
-        # Build the brush control popup window.
-        self.build_brush_controls()
+        # The brush control popup window is built once idle, or when the palette is first opened.
+        self.brush_controls = None
         
         # Build the progress display popup window.
         self.build_progress()
         
         # Build the help popup window.
         self.build_help()
+        self.log_startup_phase("panels")
         
-        # Start camera processing.
+        # Set up camera processing.  The cameras are scanned for once idle.
         self.init_camera()
         
-        # Set up mesh networking.
+        # Set up mesh networking.  The presence service is contacted once idle.
         self.init_mesh()
+        self.log_startup_phase("camera and mesh")
         
-        # Scan for input devices.
-        self.init_input_devices()
+        # The render cache is opened when a drawing is first resumed from the Journal.
+        self.render_cache = None
+        
+        # Snapshots to save with the drawing are taken when idle, see queue_make_snapshots.
+        self.make_snapshots_queued = False
         
         # This has to happen last, because it calls the read_file method when restoring from the Journal.
         self.set_canvas(self.easelarea)
         
         # Reveal the main window (but not the panels).
         self.show_all()
-        self.brush_controls.hide()
         self.progress.hide()
         self.help.hide()
         self.overlay_active = False
-        
-        # Start it running.
         self.update_timer = None
-        self.update()
 
         # store event.get_axis() of last event to ignore fake pressure
         # when system doesnt support gtk.gdk.AXIS_PRESSURE but
         # event.get_axis(gtk.gdk.AXIS_PRESSURE) returns 0.0 value
         self._prev_AXIS_PRESSURE = None
+        self.log_startup_phase("show")
+
+        # Start it running, and do everything else, once the window has been painted.
+        self.start_deferred_init()
+
+    def log_startup_phase (self, phase):
+        now = time.time()
+        log.debug("Startup: %s took %.1fms (%.1fms since start)", phase, (now-self.startup_phase_time)*1000, 
+            (now-self.startup_time)*1000)
+        self.startup_phase_time = now
+
+    def start_deferred_init (self):
+        # The priority is below redrawing, so that the window is painted first, but above the update timer, so 
+        # that the intro playback doesn't hold up the rest.
+        self.deferred_init = [
+            ("intro", self.update),
+            ("samples", self.load_samples),
+            ("presence", self.init_presence),
+            ("input devices", self.init_input_devices),
+            ("cameras", self.scan_cameras),
+            ("brush controls", self.build_brush_controls),
+        ]
+        gobject.idle_add(self.run_deferred_init, priority=gobject.PRIORITY_HIGH_IDLE+25)
+
+    def run_deferred_init (self):
+        """Runs one of the deferred startup phases, so that input and redraws are still handled in between."""
+        self.startup_phase_time = time.time()
+        phase, fn = self.deferred_init.pop(0)
+        fn()
+        self.log_startup_phase(phase)
+        return len(self.deferred_init) > 0
 
     #-----------------------------------------------------------------------------------------------------------------
     # User interface construction
 
+    def load_samples (self):
+        """Adds a button to the Learn toolbar for each sample drawing.  Reads the list from an INDEX file in the data 
+        folder."""
+        samples = []
+        fd = open(activity.get_bundle_path() + '/data/INDEX', 'r')
+        try:
+            samples = json.loads(fd.read())
+        finally:
+            fd.close()
+        
+        log.debug("Samples: %r", samples)
+        for s in samples:
+            btn = toolbutton.ToolButton('media-playback-start')
+            btn.filename = activity.get_bundle_path() + '/data/' + s['drw']
+            btn.set_tooltip(s['title'])
+            img = gtk.Image()
+            img.set_from_file(activity.get_bundle_path() + '/data/' + s['icon'])
+            btn.set_icon_widget(img)
+            btn.connect('clicked', self.on_sample)
+            # Sample drawings cannot be activated while shared, see disable_shared_commands.
+            btn.set_sensitive(not self.connected)
+            self.samplebox.insert(btn, len(self.samplebtns))
+            btn.show_all()
+            self.samplebtns.append(btn)
+
     def build_canvas (self):
         # The canvasarea is the main window which covers the entire screen below the toolbar.
         self.easelarea = gtk.Layout()
@@ -467,6 +559,10 @@ class Colors(activity.Activity, ExportedGObject):
         self.easelarea.add_events(gtk.gdk.BUTTON_PRESS_MASK|gtk.gdk.BUTTON_RELEASE_MASK)
         self.easelarea.add_events(gtk.gdk.KEY_PRESS_MASK|gtk.gdk.KEY_RELEASE_MASK)
         
+        # Receive events from extended input devices like tablets.  The devices are set up once idle, see
+        # init_input_devices.
+        self.easelarea.set_extension_events(gtk.gdk.EXTENSION_EVENTS_CURSOR)
+        
         # The actual drawing canvas is at 1/2 resolution, which improves performance by 4x and still leaves a decent
         # painting resolution of 600x400 on the XO.
         self.easel = Canvas(gtk.gdk.screen_width()/2, gtk.gdk.screen_height()/2)
@@ -488,8 +584,10 @@ class Colors(activity.Activity, ExportedGObject):
         self.easelarea.connect('motion-notify-event', self.on_mouse_event)
 
     def build_brush_controls (self):
+        if self.brush_controls:
+            return
         self.brush_controls = BrushControlsPanel()
-        self.brush_controls.set_size_request(gtk.gdk.screen_width(), gtk.gdk.screen_height())
+        self.brush_controls.set_size_request(self.width, self.height)
         self.easelarea.put(self.brush_controls, 0, 0)
 
     def build_progress (self):
@@ -632,15 +730,15 @@ class Colors(activity.Activity, ExportedGObject):
         self.pausebtn.set_tooltip(_("Pause Playback"))
         self.pausebtn.connect('clicked', self.on_pause)
         
-        #self.backonebtn = toolbutton.ToolButton('media-seek-backward')
-        #self.backonebtn.set_tooltip(_("Back One Stroke"))
-        #self.backonebtn.connect('clicked', self.on_back_one)
-        #self.backonebtn.props.accelerator = '<Ctrl>Left'
+        self.backonebtn = toolbutton.ToolButton('go-previous')
+        self.backonebtn.set_tooltip(_("Back One Stroke"))
+        self.backonebtn.connect('clicked', self.on_back_one)
+        self.backonebtn.props.accelerator = '<Ctrl>Left'
         
-        #self.forwardonebtn = toolbutton.ToolButton('media-seek-forward')
-        #self.forwardonebtn.set_tooltip(_("Forward One Stroke"))
-        #self.forwardonebtn.connect('clicked', self.on_forward_one)
-        #self.forwardonebtn.props.accelerator = '<Ctrl>Right'
+        self.forwardonebtn = toolbutton.ToolButton('go-next')
+        self.forwardonebtn.set_tooltip(_("Forward One Stroke"))
+        self.forwardonebtn.connect('clicked', self.on_forward_one)
+        self.forwardonebtn.props.accelerator = '<Ctrl>Right'
         
         # Position bar
         self.playbackpossep = gtk.SeparatorToolItem()
@@ -667,32 +765,16 @@ class Colors(activity.Activity, ExportedGObject):
         playbox.insert(self.startbtn, -1)
         playbox.insert(self.pausebtn, -1)
         playbox.insert(self.beginbtn, -1)
+        playbox.insert(self.backonebtn, -1)
+        playbox.insert(self.forwardonebtn, -1)
         playbox.insert(self.endbtn, -1)
         playbox.insert(self.playbackpossep, -1)
         playbox.insert(self.playbackpositem, -1)
         
-        # Sample files to learn from.  Reads the list from an INDEX file in the data folder.
+        # Sample files to learn from.  The buttons are added once idle, see load_samples.
         samplebox = gtk.Toolbar()
+        self.samplebox = samplebox
         self.samplebtns = []
-        
-        samples = []
-        fd = open(activity.get_bundle_path() + '/data/INDEX', 'r')
-        try:
-            samples = json.loads(fd.read())
-        finally:
-            fd.close()
-        
-        log.debug("Samples: %r", samples)
-        for s in samples:
-            btn = toolbutton.ToolButton('media-playback-start')
-            btn.filename = activity.get_bundle_path() + '/data/' + s['drw']
-            btn.set_tooltip(s['title'])
-            img = gtk.Image()
-            img.set_from_file(activity.get_bundle_path() + '/data/' + s['icon'])
-            btn.set_icon_widget(img)
-            btn.connect('clicked', self.on_sample)
-            samplebox.insert(btn, -1)
-            self.samplebtns.append(btn)
 
         self.webbtn = toolbutton.ToolButton('web')
         self.webbtn.set_tooltip(_("Colors! Gallery"))
@@ -726,26 +808,32 @@ class Colors(activity.Activity, ExportedGObject):
     # 
     # The new camera module from Pygame, by Nirav Patel, is used for camera access.
     # It was only recently added, so we have to handle the case where the module doesn't exist.
+    #
+    # Capturing and analyzing frames happens on a VideoPaintWorker thread (see videopaint.py), so a slow camera never
+    # stalls painting.  The main loop picks up the latest result in on_videopaint_tick without blocking.
 
     def init_camera (self):
         self.camera_enabled = False
+        self.videopaint_worker = None
+        self.videopaint_last_worker = None
+        self.videopaint_latency = LatencyStats()
         self.videopaintbtn.set_sensitive(False)
-        
+
+    def scan_cameras (self):
         try:
-            camera_list = camera.list_cameras()
-            if len(camera_list):
-                self.cam = camera.Camera(camera_list[0],(320,240),"RGB")
-                self.camcapture = surface.Surface((320,240),0,16,(63488,2016,31,0))
-                self.camsmall = surface.Surface((240,180),0,self.camcapture)
-                self.camhsv = surface.Surface((240,180),0,self.camcapture)
-                self.camera_enabled = True
-                self.videopaintbtn.set_sensitive(True)
-            else:
-                log.debug('No cameras found, videopaint disabled.')
-        
-        except NameError:
+            from pygame import camera, surface
+        except ImportError:
             log.debug('Pygame camera module not found, videopaint disabled.')
-            pass
+            return
+
+        camera_list = camera.list_cameras()
+        if len(camera_list):
+            self.cam = camera.Camera(camera_list[0],(320,240),"RGB")
+            self.camcapture = surface.Surface((320,240),0,16,(63488,2016,31,0))
+            self.camera_enabled = True
+            self.videopaintbtn.set_sensitive(True)
+        else:
+            log.debug('No cameras found, videopaint disabled.')
 
     #-----------------------------------------------------------------------------------------------------------------
     # Mesh networking
@@ -766,8 +854,23 @@ class Colors(activity.Activity, ExportedGObject):
     # 
     # The net effect is that when the user paints something, they broadcast their own commands, and then *receive* 
     # their own commands, rewinding and then playing them back immediately.  So, every users canvas state is simply the
-    # sum of all the broadcasts from themselves and the other users.  Since the broadcasts are serialized, every
-    # user has the same state all the time.
+    # sum of all the broadcasts from themselves and the other users.
+    # 
+    # DBus does not guarantee that every peer sees the broadcasts in the same order, so the host (the initiating
+    # peer) serializes them.  Peers submit their commands with SubmitDrawCommands, and the host rebroadcasts each
+    # batch with BroadcastDrawCommands, tagged with a sequence number and the command index it starts at.  Peers
+    # apply batches strictly in sequence order.  If a peer notices a gap in the sequence numbers, it asks the host
+    # for just the missing batches with RequestDrawCommands, which the host serves from a ring buffer of recent
+    # batches.  Only when the missing batches have fallen out of the ring buffer does the host fall back to sending
+    # the entire history with BroadcastSnapshot.  A peer whose batches don't line up with its commands has lost track
+    # of the master state, and asks for a snapshot with RequestSnapshot.  Requests which go unanswered for
+    # DRAW_REQUEST_TIMEOUT are sent again.  A gap only shows once a later batch arrives, so for a while after each 
+    # batch the host also announces the number of the next one with BroadcastDrawSeq, which lets a peer that missed 
+    # the last batch of a burst ask for it.
+    #
+    # A snapshot holds every command the host has received or queued, and is tagged with the sequence number of the
+    # next batch, which is still to come as a BroadcastDrawCommands of its own.  A peer submits what it has drawn 
+    # before a snapshot replaces its canvas, so the host sequences that after the snapshot and it comes back.
 
     def init_mesh (self):
         self.connected = False   # If True, the activity is shared with other users.
@@ -775,23 +878,44 @@ class Colors(activity.Activity, ExportedGObject):
 
         # Set up the drawing send and receive state.
         # See send_and_receive_draw_commands for more information.
-        self.draw_command_sent = 0
-        self.draw_command_received = 0
+        self.draw_command_sent = 0       # Index of the first local command which has not been submitted yet.
+        self.draw_command_received = 0   # Number of commands in the master state.
         self.draw_command_queue = DrawCommandBuffer()
 
-        # Get the presence server and self handle.
-        self.pservice = presenceservice.get_instance()
-        self.owner = self.pservice.get_owner()
+        # Sequencing state for received batches.  draw_seq_expected is None until the peer has a starting point, 
+        # which is either the beginning of the session (host) or the first snapshot (everyone else).
+        self.draw_seq_expected = None
+        self.draw_seq_pending = {}       # Out of order batches, keyed by sequence number.
+        self.draw_seq_requested = -1     # Highest sequence number already requested from the host.
+        self.draw_seq_known = 0          # Number of batches the host is known to have sent.
+        self.draw_request_timer = None   # Asks the host again if a request goes unanswered.
+
+        # Host only: the next sequence number and command index to assign, and the ring buffer of recent batches.
+        self.draw_seq_next = 0
+        self.draw_base_next = 0
+        self.draw_history = []
+        self.draw_seq_announce_timer = None
+        self.draw_seq_announce_left = 0
+
+        # The ColorsMesh object exported on the tube, once connected.  Its signals are sent to every peer.
+        self.mesh = None
 
         self.connect('shared', self.on_shared)  # Called when the user clicks the Share button in the toolbar.
         self.connect('joined', self.on_join)    # Called when the activity joins a remote activity.
 
+    def init_presence (self):
+        # Get the presence server and self handle.
+        from sugar.presence import presenceservice
+        self.pservice = presenceservice.get_instance()
+        self.owner = self.pservice.get_owner()
+
     def on_shared (self, activity):
+        import telepathy, mesh
         self.initiating = True
         self.setup_sharing()
 
         # Offer a DBus tube that everyone else can connect to.
-        self.tubes_chan[telepathy.CHANNEL_TYPE_TUBES].OfferDBusTube(DBUS_SERVICE, {})
+        self.tubes_chan[telepathy.CHANNEL_TYPE_TUBES].OfferDBusTube(mesh.DBUS_SERVICE, {})
 
         # Cancel the intro if playing.
         self.set_mode(Colors.MODE_CANVAS)
@@ -804,6 +928,7 @@ class Colors(activity.Activity, ExportedGObject):
         pass
 
     def on_join (self, activity):
+        import telepathy
         self.initiating = False
         self.setup_sharing()
 
@@ -817,6 +942,7 @@ class Colors(activity.Activity, ExportedGObject):
     def setup_sharing (self):
         """Called to initialize mesh networking objects when the activity becomes shared (on_shared) or joins an 
            existing shared activity (on_join)."""
+        import telepathy
         # Cache connection related objects.
         self.conn = self._shared_activity.telepathy_conn
         self.tubes_chan = self._shared_activity.telepathy_tubes_chan
@@ -831,88 +957,140 @@ class Colors(activity.Activity, ExportedGObject):
 
     def on_tube (self, id, initiator, type, service, params, state):
         """Called by the NewTube callback or the ListTubes enumeration, when a real connection finally exists."""
-        if (type == telepathy.TUBE_TYPE_DBUS and service == DBUS_SERVICE):
+        import telepathy, mesh
+        if (type == telepathy.TUBE_TYPE_DBUS and service == mesh.DBUS_SERVICE):
             # If the new tube is waiting for us to finalize it, do so.
             if state == telepathy.TUBE_STATE_LOCAL_PENDING:
                 self.tubes_chan[telepathy.CHANNEL_TYPE_TUBES].AcceptDBusTube(id)
             
             if not self.connected:
-                # Create the TubeConnection object to manage the connection.
-                self.tube = TubeConnection(self.conn, 
-                    self.tubes_chan[telepathy.CHANNEL_TYPE_TUBES],
-                    id, group_iface=self.text_chan[telepathy.CHANNEL_INTERFACE_GROUP])
-                ExportedGObject.__init__(self, self.tube, DBUS_PATH)
-                
-                # Set up DBUS Signal receiviers.
-                self.tube.add_signal_receiver(self.ReceiveHello,        'BroadcastHello',        DBUS_IFACE, path=DBUS_PATH)
-                self.tube.add_signal_receiver(self.ReceiveCanvasMode,   'BroadcastCanvasMode',   DBUS_IFACE, path=DBUS_PATH)
-                self.tube.add_signal_receiver(self.ReceiveClear,        'BroadcastClear',        DBUS_IFACE, path=DBUS_PATH)
-                self.tube.add_signal_receiver(self.ReceiveDrawCommands, 'BroadcastDrawCommands', DBUS_IFACE, path=DBUS_PATH)
-                self.tube.add_signal_receiver(self.ReceivePlayback,     'BroadcastPlayback',     DBUS_IFACE, path=DBUS_PATH)
+                # Export the object which sends and receives the drawing signals over the tube.
+                self.mesh = mesh.ColorsMesh(self, self.conn, self.tubes_chan, self.text_chan, id)
+                self.tube = self.mesh.tube
                 
                 log.debug("Connected.")
                 self.connected = True
+
+                # The host's current painting is the starting point of the shared command log.
+                if self.initiating:
+                    self.easel.save_shared_image()
+                    self.draw_command_sent = self.easel.get_num_commands()
+                    self.draw_command_received = self.draw_command_sent
+                    self.draw_base_next = self.draw_command_sent
+                    self.draw_seq_expected = 0
                 
                 # Limit UI choices when sharing.
                 self.disable_shared_commands()
                 
-                # Announce our presence to the server.
+                # Announce our presence to the server.  Our own painting is replaced by the host's, so none of it 
+                # is submitted.
                 if not self.initiating:
-                    self.BroadcastHello()
+                    self.draw_command_sent = self.easel.get_num_commands()
+                    self.mesh.BroadcastHello()
+                    self.start_draw_request_timer()
 
-    # Notes about DBUS signals:
-    # - When you call a @signal function, its implementation is invoked, and the registered callback is invoked on all
-    #   the peers (including the one who invoked the signal!).  So it's usually best for the @signal function to do
-    #   nothing at all.
-    # - The 'signature' describes the parameters to the function.
+    # The signals themselves are sent with the ColorsMesh object in mesh.py, and received here.
 
-    @signal(dbus_interface=DBUS_IFACE, signature='')
-    def BroadcastHello (self):
-        """Broadcast signal sent when a client joins the shared activity."""
-        pass
     def ReceiveHello (self):
         if not self.initiating: return  # Only the initiating peer responds to Hello commands.
-        log.debug("Received Hello.  Responding with canvas state (%d commands).", self.easel.playback_length())
-        self.BroadcastCanvasMode()
-        self.BroadcastClear()
-        buf = self.easel.send_drw_commands(0, self.easel.get_num_commands())
-        self.BroadcastDrawCommands(buf.get_bytes(), buf.ncommands)
+        log.debug("Received Hello.  Responding with canvas state (%d commands).", self.draw_command_received)
+        self.mesh.BroadcastCanvasMode()
+        self.send_snapshot()
         self.update()
 
-    @signal(dbus_interface=DBUS_IFACE, signature='')
-    def BroadcastCanvasMode (self):
-        """Broadcast signal for forcing clients into Canvas mode."""
-        pass
     def ReceiveCanvasMode (self):
         log.debug("ReceiveCanvasMode")
         if self.mode != Colors.MODE_CANVAS:
             self.set_mode(Colors.MODE_CANVAS)
         self.update()
 
-    @signal(dbus_interface=DBUS_IFACE, signature='')
-    def BroadcastClear (self):
-        """Broadcast signal for clearing the canvas."""
-        pass
     def ReceiveClear (self):
         log.debug("ReceiveClear")
         self.easel.clear()
         self.easel.save_shared_image()
         self.update()
 
-    @signal(dbus_interface=DBUS_IFACE, signature='ayi')
-    def BroadcastDrawCommands (self, cmds, ncommands):
-        """Broadcast signal for drawing commands."""
-        pass
-    def ReceiveDrawCommands (self, cmds, ncommands):
-        log.debug("ReceiveDrawCommands")
+    def ReceiveSnapshot (self, cmds, ncommands, seq):
+        # The host is where snapshots come from, and peers which are already in sync ignore them.
+        if self.initiating:
+            return
+        have = self.draw_command_received + self.draw_command_queue.ncommands
+        if self.draw_seq_expected == seq and have == ncommands:
+            return
+        log.debug("ReceiveSnapshot %d commands, next batch %d", ncommands, seq)
+        # Submit what the user has drawn since the last submission rather than lose it with the canvas.  It comes back
+        # in one of the batches after the snapshot.
+        if self.easel.stroke:
+            self.easel.play_command(DrawCommand.create_end_draw(int(self.pressure)), True)
+        self.submit_draw_commands()
         s = "".join(chr(b) for b in cmds)  # Convert dbus.ByteArray to Python string.
-        self.draw_command_queue.append(DrawCommandBuffer(s, ncommands))
+        self.easel.clear()
+        self.easel.save_shared_image()
+        self.draw_command_sent = 0
+        self.draw_command_received = 0
+        self.draw_command_queue.clear()
+        self.draw_command_queue.append_from_string(s, ncommands)
+        self.draw_seq_expected = seq
+        self.draw_seq_requested = seq-1
+        self.draw_seq_known = max(self.draw_seq_known, seq)
+        # Batches we buffered while waiting for the snapshot may now be applicable.
+        for old in [k for k in self.draw_seq_pending.keys() if k < seq]:
+            del self.draw_seq_pending[old]
+        self.queue_pending_draw_commands()
+        self.request_missing_draw_commands()
         self.update()
 
-    @signal(dbus_interface=DBUS_IFACE, signature='bii')
-    def BroadcastPlayback (self, playing, playback_pos, playback_speed):
-        """Broadcast signal controlling playback.  Not yet used."""
-        pass
+    def ReceiveSubmit (self, cmds, ncommands):
+        if not self.initiating: return  # Only the initiating peer sequences commands.
+        seq = self.draw_seq_next
+        base = self.draw_base_next
+        self.draw_seq_next += 1
+        self.draw_base_next += ncommands
+        # Remember the batch so that peers who missed it can ask for it again.
+        self.draw_history.append((seq, base, cmds, ncommands))
+        if len(self.draw_history) > Colors.DRAW_HISTORY_SIZE:
+            del self.draw_history[0]
+        self.mesh.BroadcastDrawCommands(cmds, ncommands, seq, base)
+        # The host's master state is the batches as it sequences them, so it doesn't wait for its own broadcast, which
+        # is dropped as a duplicate when it comes back.
+        s = "".join(chr(b) for b in cmds)  # Convert dbus.ByteArray to Python string.
+        self.draw_seq_pending[seq] = (s, ncommands, base)
+        self.queue_pending_draw_commands()
+        self.start_draw_seq_announce()
+        self.update()
+
+    def ReceiveDrawCommands (self, cmds, ncommands, seq, base):
+        log.debug("ReceiveDrawCommands seq=%d base=%d n=%d", seq, base, ncommands)
+        if self.draw_seq_expected is not None and seq < self.draw_seq_expected:
+            return  # Duplicate of a batch we already have.
+        s = "".join(chr(b) for b in cmds)  # Convert dbus.ByteArray to Python string.
+        self.draw_seq_pending[seq] = (s, ncommands, base)
+        if self.draw_seq_expected is None:
+            return  # Waiting for a snapshot.
+        self.queue_pending_draw_commands()
+        self.request_missing_draw_commands()
+        self.update()
+
+    def ReceiveDrawSeq (self, seq):
+        if self.initiating: return  # The host is where the announcements come from.
+        self.draw_seq_known = max(self.draw_seq_known, seq)
+        self.request_missing_draw_commands()
+
+    def ReceiveRequest (self, first, last):
+        if not self.initiating: return  # Only the initiating peer keeps the batch history.
+        if not len(self.draw_history) or first < self.draw_history[0][0]:
+            log.debug("Batches %d to %d no longer available, sending snapshot.", first, last)
+            self.send_snapshot()
+            return
+        for seq, base, cmds, ncommands in self.draw_history:
+            if first <= seq <= last:
+                self.mesh.BroadcastDrawCommands(cmds, ncommands, seq, base)
+
+    def ReceiveSnapshotRequest (self):
+        if not self.initiating: return  # Only the initiating peer has the master state.
+        log.debug("Snapshot requested.")
+        self.send_snapshot()
+
     def ReceivePlayback (self):
         log.debug("ReceivePlayback")
         if playing:
@@ -931,30 +1109,115 @@ class Colors(activity.Activity, ExportedGObject):
     def on_buddy_left (self, activity, buddy):
         log.debug('Buddy %s left', buddy.props.nick)
 
+    def send_snapshot (self):
+        """Host only.  Broadcasts the entire master command list, for joining peers and for peers whose missing
+        batches have fallen out of the history ring buffer.  The batches the host has queued but not played yet are 
+        part of it, and the batches it hasn't received yet are not, so it is tagged with the next batch expected."""
+        buf = self.easel.send_drw_commands(0, self.draw_command_received)
+        cmds = buf.get_bytes() + self.draw_command_queue.get_bytes()
+        ncommands = buf.ncommands + self.draw_command_queue.ncommands
+        self.mesh.BroadcastSnapshot(cmds, ncommands, self.draw_seq_expected)
+
+    def queue_pending_draw_commands (self):
+        """Moves received batches into draw_command_queue for as long as they are in sequence."""
+        while self.draw_seq_pending.has_key(self.draw_seq_expected):
+            s, ncommands, base = self.draw_seq_pending.pop(self.draw_seq_expected)
+            expected = self.draw_command_received + self.draw_command_queue.ncommands
+            if base != expected:
+                log.debug("Batch %d starts at %d, expected %d", self.draw_seq_expected, base, expected)
+                if not self.initiating:
+                    # Applying it would put the commands in the wrong place, so start again from a snapshot.  The 
+                    # batch is kept with the others received meanwhile, for if the snapshot doesn't cover it.
+                    self.draw_seq_pending[self.draw_seq_expected] = (s, ncommands, base)
+                    self.draw_seq_expected = None
+                    self.mesh.RequestSnapshot()
+                    self.start_draw_request_timer()
+                    return
+            self.draw_command_queue.append_from_string(s, ncommands)
+            self.draw_seq_expected += 1
+
+    def request_missing_draw_commands (self):
+        """Asks the host for the batches missing before the ones waiting in draw_seq_pending, or before the next batch
+        the host has announced, unless they have been asked for already."""
+        if self.draw_seq_expected is None:
+            return
+        if len(self.draw_seq_pending):
+            last = min(self.draw_seq_pending.keys())-1
+        else:
+            last = self.draw_seq_known-1
+        if last >= self.draw_seq_expected and last > self.draw_seq_requested:
+            log.debug("Missing draw command batches %d to %d", self.draw_seq_expected, last)
+            self.mesh.RequestDrawCommands(self.draw_seq_expected, last)
+            self.draw_seq_requested = last
+            self.start_draw_request_timer()
+
+    def start_draw_request_timer (self):
+        if self.draw_request_timer:
+            gobject.source_remove(self.draw_request_timer)
+        self.draw_request_timer = gobject.timeout_add(Colors.DRAW_REQUEST_TIMEOUT, self.on_draw_request_timeout)
+
+    def on_draw_request_timeout (self):
+        """Asks the host again for whatever is still missing, in case the request or the reply was lost."""
+        self.draw_request_timer = None
+        if not self.connected or self.initiating:
+            return False
+        if self.draw_seq_expected is None:
+            log.debug("Still waiting for a snapshot, requesting it again.")
+            self.mesh.RequestSnapshot()
+            self.start_draw_request_timer()
+        elif len(self.draw_seq_pending) or self.draw_seq_known > self.draw_seq_expected:
+            self.draw_seq_requested = -1
+            self.request_missing_draw_commands()
+        return False
+
+    def start_draw_seq_announce (self):
+        """Host only.  (Re)starts the announcements of the next batch number after a batch."""
+        self.draw_seq_announce_left = Colors.DRAW_SEQ_ANNOUNCE_COUNT
+        if not self.draw_seq_announce_timer:
+            self.draw_seq_announce_timer = gobject.timeout_add(Colors.DRAW_SEQ_ANNOUNCE_INTERVAL,
+                self.on_draw_seq_announce)
+
+    def on_draw_seq_announce (self):
+        if self.connected:
+            self.mesh.BroadcastDrawSeq(self.draw_seq_next)
+            self.draw_seq_announce_left -= 1
+            if self.draw_seq_announce_left > 0:
+                return True
+        self.draw_seq_announce_timer = None
+        return False
+
+    def submit_draw_commands (self):
+        """Submits the drawing commands generated by this user since the last submission to the host."""
+        if self.draw_command_sent < self.easel.get_num_commands():
+            # TODO: Always prepend the current brush here.
+            buf = self.easel.send_drw_commands(self.draw_command_sent, self.easel.get_num_commands()-self.draw_command_sent)
+            self.mesh.SubmitDrawCommands(buf.get_bytes(), buf.ncommands)
+            self.draw_command_sent = self.easel.get_num_commands()
+
     def send_and_receive_draw_commands (self):
         if self.connected:
-            # Broadcast drawing commands that were generated by this user since the last call to this function.
-            if self.draw_command_sent < self.easel.get_num_commands():
-                # TODO: Always prepend the current brush here.
-                buf = self.easel.send_drw_commands(self.draw_command_sent, self.easel.get_num_commands()-self.draw_command_sent)
-                self.BroadcastDrawCommands(buf.get_bytes(), buf.ncommands)
+            # Submit drawing commands that were generated by this user since the last call to this function.
+            self.submit_draw_commands()
             
             # Play any queued draw commands that were received from the host.  If there are any, we first reset the
             # canvas contents back to the last received state and then play them back.
             if self.draw_command_queue.ncommands:
                 # Also, we have to save and restore the brush around the queued commands.
                 saved_brush = self.easel.brush
-                self.easel.receive_drw_commands(self.draw_command_queue, self.draw_command_sent)
+                self.easel.receive_drw_commands(self.draw_command_queue, self.draw_command_received)
                 self.easel.restore_shared_image()
-                self.easel.play_range(self.draw_command_sent, self.easel.get_num_commands())
+                self.easel.play_range(self.draw_command_received, self.easel.get_num_commands())
                 self.easel.save_shared_image()
-                self.draw_command_queue.clear()
+                # Consuming keeps the queue's allocation around for the next batches.
+                self.draw_command_queue.consume(self.draw_command_queue.ncommands)
+                self.draw_command_received = self.easel.get_num_commands()
+                self.draw_command_sent = self.draw_command_received
                 self.set_brush(saved_brush)
                 self.flush_dirty_canvas()
+                self.queue_make_snapshots()
             
-            # Note that resetting the state above means "undoing" the commands we just broadcast.  We will receive them 
-            # again by our ReceiveDrawCommands callback immediately, and will play them back so the user shouldn't notice.
-            self.draw_command_sent = self.easel.get_num_commands()
+            # Note that resetting the state above means "undoing" the commands we just submitted.  We will receive them 
+            # again from the host by our ReceiveDrawCommands callback, and will play them back so the user shouldn't notice.
 
     def disable_shared_commands (self):
         """Disables UI controls which cannot be activated by non-host peers."""
@@ -962,6 +1225,8 @@ class Colors(activity.Activity, ExportedGObject):
         self.startbtn.set_sensitive(False)
         self.pausebtn.set_sensitive(False)
         self.beginbtn.set_sensitive(False)
+        self.backonebtn.set_sensitive(False)
+        self.forwardonebtn.set_sensitive(False)
         self.endbtn.set_sensitive(False)
         self.playbackposbar.set_sensitive(False)
         self.undobtn.set_sensitive(False)
@@ -974,8 +1239,6 @@ class Colors(activity.Activity, ExportedGObject):
     # Input device (Wacom etc.) code
 
     def init_input_devices(self):
-        self.easelarea.set_extension_events(gtk.gdk.EXTENSION_EVENTS_CURSOR)
-
         self.devices = gtk.gdk.devices_list()
         for d in self.devices:
             log.debug('Input Device: name=\'%s\'' % (d.name))
@@ -997,6 +1260,12 @@ class Colors(activity.Activity, ExportedGObject):
         self.lastmy = 0
         self.lastr = 0     
 
+        # Latency from each input sample to its paint being drawn to the screen, over the whole session.  
+        # input_time is when the last sample arrived, and paint_time is set to it while that sample is being drawn.
+        self.input_latency = LatencyHistogram()
+        self.input_time = None
+        self.paint_time = None
+
     def on_key_event (self, widget, event):
         key_name = gtk.gdk.keyval_name(event.keyval)
         
@@ -1056,6 +1325,18 @@ class Colors(activity.Activity, ExportedGObject):
                 self.flush_entire_canvas()
             button = Colors.BUTTON_SCROLL
         
+        # F11 logs the input latency so far, and writes its full distribution to a file.
+        elif key_name == 'F11':
+            if event.type == gtk.gdk.KEY_PRESS:
+                self.log_input_latency()
+            return True
+
+        # F12 starts profiling the canvas, and pressed again logs what was collected.
+        elif key_name == 'F12':
+            if event.type == gtk.gdk.KEY_PRESS:
+                self.toggle_profile()
+            return True
+
         # Either Alt key for pick.
         elif key_name == 'Alt_L' or key_name == 'ISO_Level3_Shift':
             button = Colors.BUTTON_PICK
@@ -1107,6 +1388,8 @@ class Colors(activity.Activity, ExportedGObject):
         if self.overlay_active:
             return
 
+        self.input_time = time.time()
+
         if event.type == gtk.gdk.BUTTON_PRESS:
             if event.button == 1:
                 self.pending_press = self.pending_press | Colors.BUTTON_TOUCH
@@ -1341,6 +1624,8 @@ class Colors(activity.Activity, ExportedGObject):
         # Send to sharing participants.
         self.send_and_receive_draw_commands()
 
+        self.queue_make_snapshots()
+
         # Record a new default zoom-in focal point.
         #self.zoomref = (self.easel.strokemin + self.easel.strokemax) * Pos(0.5,0.5)
 
@@ -1392,6 +1677,9 @@ class Colors(activity.Activity, ExportedGObject):
                 #log.debug("play_to: main loop quit requested.")
                 return
 
+        # Jump to the snapshot nearest the position, if the drawing was saved with any and that saves replaying.
+        self.easel.restore_snapshot(to)
+
         # Keep looping until the position is reached.  Since we activate the GTK event loop processing from within
         # our inner loop, the user can actually move the scrollbar while this function is running!
         while True:
@@ -1492,23 +1780,22 @@ class Colors(activity.Activity, ExportedGObject):
     # 
     # todo- Consider breaking up into enter_intro, enter_playback, enter_canvas, etc.
 
-    def start_update_timer(self):
+    def start_update_timer(self, interval=1):
         if self.update_timer:
             gobject.source_remove(self.update_timer)
             
         # The timer priority is chosen to be above PRIORITY_REDRAW (which is PRIORITY_HIGH_IDLE_20, but not defined in PyGTK).
-        self.update_timer = gobject.timeout_add(1, self.update, priority=gobject.PRIORITY_HIGH_IDLE+30)
+        self.update_timer = gobject.timeout_add(interval, self.update, priority=gobject.PRIORITY_HIGH_IDLE+30)
         
     def enter_mode (self):
         if self.mode == Colors.MODE_INTRO:
-            # Load and play intro movie.  It was created on a DS at 60hz, so we need to speed it up drastically to
-            # make it watchable.
+            # Load and play intro movie, see INTRO_COMMANDS_PER_SECOND.
             self.clear_undo()
             self.easel.clear()
             self.easel.load(str(activity.get_bundle_path() + "/data/intro.drw"))
-            self.easel.set_playback_speed(8)
             self.easel.start_playback()
-            self.start_update_timer()
+            self.intro_start = time.time()
+            self.start_update_timer(Colors.INTRO_FRAME_TIME)
 
         if self.mode == Colors.MODE_PLAYBACK:
             self.easel.set_playback_speed(1)
@@ -1538,6 +1825,7 @@ class Colors(activity.Activity, ExportedGObject):
             #self.easel.render_overlay()
 
             # Show the brush controls window.
+            self.build_brush_controls()
             self.easelarea.set_double_buffered(True)
             self.brush_controls.set_brush(self.easel.brush)
             self.brush_controls.show_all()
@@ -1591,9 +1879,9 @@ class Colors(activity.Activity, ExportedGObject):
             self.set_mode(Colors.MODE_INTRO)
 
         if self.mode == Colors.MODE_INTRO:
-            self.easel.update_playback()
-            if not self.easel.playback_done():
-                self.flush_dirty_canvas()
+            # Play everything due by now, and draw it all in one go.
+            self.easel.playback_to(int((time.time()-self.intro_start)*Colors.INTRO_COMMANDS_PER_SECOND))
+            self.flush_dirty_canvas()
             if self.cur_buttons & Colors.BUTTON_TOUCH:
                 self.set_mode(Colors.MODE_CANVAS)
                 return
@@ -1631,8 +1919,10 @@ class Colors(activity.Activity, ExportedGObject):
                     self.save_undo()
 
                 if self.mx != self.lastmx or self.my != self.lastmy or self.videopaint_enabled:
+                    self.paint_time = self.input_time
                     self.draw(Pos(self.mx, self.my))
                     self.flush_dirty_canvas()
+                    self.paint_time = None
 
             else:
                 if self.easel.stroke:
@@ -1700,7 +1990,8 @@ class Colors(activity.Activity, ExportedGObject):
         self.easelimage = gtk.gdk.Image(gtk.gdk.IMAGE_FASTEST, gtk.gdk.visual_get_system(), rect[2], rect[3])
         
         # Resize panels.
-        self.brush_controls.set_size_request(rect[2], rect[3])
+        if self.brush_controls:
+            self.brush_controls.set_size_request(rect[2], rect[3])
         self.progress.set_size_request(rect[2], rect[3])
 
     def draw_easelarea(self, bounds):
@@ -1759,6 +2050,14 @@ class Colors(activity.Activity, ExportedGObject):
             bounds.x, bounds.y, 
             bounds.x, bounds.y, bounds.width, bounds.height)
         
+        if self.paint_time is not None:
+            self.input_latency.add(time.time() - self.paint_time)
+            self.paint_time = None
+
+        if not self.startup_painted:
+            self.startup_painted = True
+            log.debug("Startup: first paint %.1fms after start", (time.time()-self.startup_time)*1000)
+
         # Debug rectangle to test the dirty rectangle code.  It should tightly box the brush at all times.
         #self.easelarea.bin_window.draw_rectangle(gc, False, bounds.x, bounds.y, bounds.width, bounds.height)
         
@@ -1831,52 +2130,61 @@ class Colors(activity.Activity, ExportedGObject):
         if self.camera_enabled:
             self.videopaint_enabled = button.get_active()
             if button.get_active():
-                self.cam.start()
-                # flips the image to start with
-                self.cam.set_controls(hflip = 1)
-                gobject.timeout_add(33, self.on_videopaint_tick, priority=gobject.PRIORITY_HIGH_IDLE+31)
+                self.start_videopaint(self.cam, BlobAnalyzer(self.camcapture))
             else:
-                self.cam.stop()
+                self.stop_videopaint()
+
+    def start_videopaint (self, cam, analyze):
+        """Starts tracking with the given camera and frame analyzer.  Any camera-like object works, e.g. FakeCamera."""
+        # Wait for the previous worker to release the camera; at most one frame.
+        if self.videopaint_last_worker:
+            self.videopaint_last_worker.join()
+            self.videopaint_last_worker = None
+        cam.start()
+        # flips the image to start with
+        cam.set_controls(hflip = 1)
+        self.videopaint_latency.reset()
+        self.videopaint_worker = VideoPaintWorker(cam, analyze, self.camcapture)
+        self.videopaint_worker.start()
+        gobject.timeout_add(33, self.on_videopaint_tick, priority=gobject.PRIORITY_HIGH_IDLE+31)
+
+    def stop_videopaint (self):
+        if self.videopaint_worker:
+            self.videopaint_worker.stop()
+            log.debug("Videopaint: %d frames, %d dropped, capture to cursor latency %s",
+                self.videopaint_worker.frames_captured, self.videopaint_worker.frames_dropped, self.videopaint_latency)
+            analyze = self.videopaint_worker.analyze
+            if isinstance(analyze, BlobAnalyzer):
+                log.debug("Videopaint tracker: %d region of interest hits, %d full frame scans",
+                    analyze.roi_hits, analyze.full_scans)
+            self.videopaint_last_worker = self.videopaint_worker
+            self.videopaint_worker = None
 
     def on_videopaint_tick (self):
-        if not self.camera_enabled or not self.videopaint_enabled or not self.window:
+        if not self.videopaint_worker or not self.videopaint_enabled or not self.window:
             return False
 
-        if self.cam.query_image():
-            # get the new frame
-            self.camcapture = self.cam.get_image(self.camcapture)
-            # scale it to a quarter the size before colorspace conversion
-            self.camsmall = transform.scale(self.camcapture,(240,180),self.camsmall)
-            # convert colorspace to HSV, good for object tracking
-            self.camhsv = camera.colorspace(self.camsmall,"HSV",self.camhsv)
-            # currently just threshold the OLPC green color.
-            cammask = mask.from_threshold(self.camhsv,(90,128,128),(50,120,120))
-            # find the largest object in the mask
-            camcomponent = cammask.connected_component()
-            camcount = camcomponent.count()
-            # make sure its not just noise
-            if camcount > 2000:
-                campos = camcomponent.centroid()
-
-                # scale and adjust it so the borders can still be reached
-                size = self.window.get_size()
-                mx = int(max(0.0, min(1.0, (campos[0]-40)/160.0)) * size[0])
-                my = int(max(0.0, min(1.0, (campos[1]-40)/100.0)) * size[1])
-
-                # smooth a bit
-                mx = int(self.lastmx*0.5 + mx*0.5)
-                my = int(self.lastmy*0.5 + my*0.5)
-
-                self.mx, self.my = self.translate_coordinates(self.easelarea, mx, my)
-                self.pressure = int(min(255,camcount/20))
-
-                self.lastmx = self.mx
-                self.lastmy = self.my
-
-                gtk.gdk.display_get_default().warp_pointer(self.get_screen(), mx, my)
-
-                #self.flush_cursor()
-                self.update()
+        result = self.videopaint_worker.get_result()
+        if result:
+            campos = result.pos
+
+            # scale and adjust it so the borders can still be reached
+            size = self.window.get_size()
+            mx = int(max(0.0, min(1.0, (campos[0]-40)/160.0)) * size[0])
+            my = int(max(0.0, min(1.0, (campos[1]-40)/100.0)) * size[1])
+
+            self.mx, self.my = self.translate_coordinates(self.easelarea, mx, my)
+            self.pressure = int(min(255,result.count/20))
+
+            self.lastmx = self.mx
+            self.lastmy = self.my
+
+            gtk.gdk.display_get_default().warp_pointer(self.get_screen(), mx, my)
+
+            #self.flush_cursor()
+            self.update()
+
+            self.videopaint_latency.add(time.time() - result.capture_time)
 
         return True
     
@@ -1920,15 +2228,29 @@ class Colors(activity.Activity, ExportedGObject):
             self.set_mode(Colors.MODE_PLAYBACK)
         self.playbackpos.set_value(0)
 
-    def on_back_one(self, button):
-        to = self.easel.playback_pos() - 1
-        if to < self.easel.playback_length():
-            self.play_to(to)
+    def on_back_one (self, button):
+        if self.mode != Colors.MODE_PLAYBACK:
+            self.set_mode(Colors.MODE_PLAYBACK)
+        self.easel.pause_playback()
+        self.play_to_stroke(self.easel.get_prev_stroke_end(self.easel.playback_pos()))
 
     def on_forward_one (self, button):
-        to = self.easel.playback_pos() + 1
-        if to < self.easel.playback_length():
-            self.play_to(to)
+        if self.mode != Colors.MODE_PLAYBACK:
+            self.set_mode(Colors.MODE_PLAYBACK)
+        self.easel.pause_playback()
+        self.play_to_stroke(self.easel.get_next_stroke_end(self.easel.playback_pos()))
+
+    def play_to_stroke (self, to):
+        """Plays to the end of a stroke, and moves the position bar to match."""
+        self.play_to(to)
+        # Not rounded to a whole percent, so that on_playbackposbar_change maps the position straight back to to.
+        length = self.easel.playback_length()
+        self.playbackposbar.ignore_change += 1
+        if length:
+            self.playbackpos.set_value(100.0*to/length)
+        else:
+            self.playbackpos.set_value(100)
+        self.playbackposbar.ignore_change -= 1
 
     def on_skip_end (self, button):
         if self.mode != Colors.MODE_PLAYBACK:
@@ -1949,7 +2271,9 @@ class Colors(activity.Activity, ExportedGObject):
             return
         if self.mode != Colors.MODE_PLAYBACK:
             self.set_mode(Colors.MODE_PLAYBACK)
-        to = int(self.playbackpos.get_value()/100.0*self.easel.playback_length())
+        to = int(round(self.playbackpos.get_value()/100.0*self.easel.playback_length()))
+        # play_to finishes the stroke it stops in, so aim for where that stroke ends.
+        to = self.easel.get_stroke_boundary(to)
         self.play_to(to)
         self.easel.pause_playback()
 
@@ -1963,16 +2287,86 @@ class Colors(activity.Activity, ExportedGObject):
         self.easel.clear()
         self.easel.load(str(file_path.encode()))
         self.easel.start_playback()
-        self.easel.finish_playback()
+        start = time.time()
+        if not self.restore_from_render_cache():
+            # Drawings saved with snapshots only need replaying from the last of them.
+            if self.easel.restore_snapshot(self.easel.playback_length()):
+                log.debug("Restored snapshot at %d of %d commands", self.easel.playback_pos(),
+                    self.easel.playback_length())
+            self.easel.finish_playback()
+            self.store_in_render_cache(time.time()-start)
         self.playbackpos.set_value(100)
         self.set_mode(Colors.MODE_CANVAS)
-        log.debug("Played back %d commands", self.easel.playback_length())
+        log.debug("Played back %d commands in %.1fms", self.easel.playback_length(), (time.time()-start)*1000)
         self.save_undo()
+        self.queue_make_snapshots()
+
+    def get_render_cache (self):
+        if self.render_cache is None:
+            from rendercache import RenderCache
+            path = os.path.join(self.get_activity_root(), 'data', 'render-cache')
+            self.render_cache = RenderCache(path, Colors.RENDER_CACHE_BYTES)
+        return self.render_cache
+
+    def get_render_cache_key (self):
+        """Returns the render cache key of the drawing loaded in the easel, which depends only on its commands."""
+        buf = self.easel.send_drw_commands(0, self.easel.playback_length())
+        return self.get_render_cache().get_key(buf.get_bytes(), self.easel.width, self.easel.height)
+
+    def restore_from_render_cache (self):
+        """Restores the pixels of the drawing just loaded from the render cache instead of replaying it.  Returns
+        False if they aren't there."""
+        if not Colors.RENDER_CACHE_BYTES:
+            return False
+        try:
+            cache = self.get_render_cache()
+            key = self.get_render_cache_key()
+            pixels = cache.load(key, self.easel.playback_length(), self.easel.width, self.easel.height)
+        except (IOError, OSError), e:
+            log.debug("Cannot read the render cache: %s", e)
+            return False
+        if pixels is None or not self.easel.finish_playback_from_pixels(pixels, len(pixels)):
+            return False
+        log.debug("Restored %s from the render cache", key)
+        return True
+
+    def store_in_render_cache (self, replay_time):
+        """Stores the pixels of the drawing just replayed in the render cache, if it was worth it.  The pixels are
+        taken straight away, but compressed and written when the activity is idle."""
+        if not Colors.RENDER_CACHE_BYTES or replay_time < Colors.RENDER_CACHE_MIN_TIME or self.easel.stroke:
+            return
+        cache = self.get_render_cache()
+        key = self.get_render_cache_key()
+        args = (key, self.easel.playback_length(), self.easel.width, self.easel.height, self.easel.get_playback_pixels())
+        gobject.idle_add(self.on_store_in_render_cache, cache, args, priority=gobject.PRIORITY_LOW)
+
+    def on_store_in_render_cache (self, cache, args):
+        try:
+            cache.store(*args)
+            log.debug("Stored %s in the render cache", args[0])
+        except (IOError, OSError), e:
+            log.debug("Cannot write to the render cache: %s", e)
+        return False
+
+    def queue_make_snapshots (self):
+        """Takes any snapshots the drawing needs for saving with it when the activity is idle, one per callback, so
+        that neither saving nor the main loop is held up by replaying the drawing for them."""
+        if not self.make_snapshots_queued:
+            self.make_snapshots_queued = True
+            gobject.idle_add(self.on_make_snapshots, priority=gobject.PRIORITY_LOW)
+
+    def on_make_snapshots (self):
+        if self.easel.make_next_snapshot():
+            return True
+        self.make_snapshots_queued = False
+        log.debug("Have %d snapshots of %d bytes", self.easel.get_num_snapshots(), self.easel.get_snapshot_bytes())
+        return False
 
     def write_file(self, file_path):
         log.debug("Saving to journal %s", file_path)
         self.easel.save(file_path.encode())
-        log.debug("Saved %d commands", self.easel.playback_length())
+        log.debug("Saved %d commands, with %d snapshots of %d bytes", self.easel.playback_length(),
+            self.easel.get_num_snapshots(), self.easel.get_snapshot_bytes())
 
     def take_screenshot (self):
         if self.easelarea and self.easelarea.bin_window:
@@ -2025,6 +2419,9 @@ class Colors(activity.Activity, ExportedGObject):
     def clear_undo(self):
         self.undo_buffer = []
         self.undo_image_valid = False
+        # Outside of shared mode the shared image only holds the undo state, so it can go until the next save_undo.
+        if not self.connected:
+            self.easel.release_shared_image()
         self.update_undo()
 
     def update_undo(self):
@@ -2055,6 +2452,7 @@ class Colors(activity.Activity, ExportedGObject):
     
     def on_web(self, event):
         # Create a Journal entry with a link to the gallery page.
+        from sugar.datastore import datastore
         fileObject = datastore.create()
         fileObject.metadata['title'] = _('Colors! Gallery')
         fileObject.metadata['mime_type'] = 'text/uri-list'
@@ -2088,6 +2486,7 @@ class Colors(activity.Activity, ExportedGObject):
         pbuf = pbuf.get_from_image(image, self.easelarea.get_colormap(), 0, 0, 0, 0, w, h)
         
         # Create a new journal item.
+        from sugar.datastore import datastore
         ds = datastore.create()
         act_meta = self.metadata
         ds.metadata['title'] = act_meta['title'] + ' (PNG)'
@@ -2129,6 +2528,46 @@ class Colors(activity.Activity, ExportedGObject):
     # 
     # Simply causes the C++ code to do a bunch of work and prints out the time used.  Useful for testing the benefits
     # of optimization.
+    # 
+    # colorsc/benchmark.py covers the same ground and more without needing the activity to be running, and reports
+    # the results as JSON.
+
+    def log_input_latency (self):
+        """Logs the input latency percentiles of the session, and writes the distribution to latency.txt in the 
+        activity instance directory."""
+        log.debug("Input latency: %s", self.input_latency)
+        path = os.path.join(self.get_activity_root(), 'instance', 'latency.txt')
+        try:
+            f = open(path, 'w')
+            try:
+                self.input_latency.dump(f)
+            finally:
+                f.close()
+            log.debug("Input latency distribution written to %s", path)
+        except IOError, e:
+            log.debug("Could not write input latency distribution: %s", e)
+
+    def toggle_profile (self):
+        """Starts collecting the canvas profiling counters, or stops and logs them."""
+        if self.easel.profiling:
+            self.easel.profiling = False
+            self.log_profile()
+        else:
+            self.easel.reset_profile()
+            self.easel.profiling = True
+            log.debug("Canvas profiling started")
+
+    def log_profile (self):
+        """Logs the canvas profiling counters collected so far, and resets them."""
+        profile = self.easel.get_profile(True)
+        names = profile.keys()
+        names.sort()
+        for name in names:
+            c = profile[name]
+            if c['calls'] == 0:
+                continue
+            log.debug("Canvas profile: %-18s %8d calls %12d pixels %10.3f ms (%.3f us per call)", name, c['calls'], 
+                c['pixels'], c['ns']/1.0e6, c['ns']/1.0e3/c['calls'])
 
     def benchmark (self):
         # Benchmark a Canvas object.
@@ -2141,6 +2580,31 @@ class Colors(activity.Activity, ExportedGObject):
             canvas.finish_playback()
         log.debug("Canvas playback benchmark: %f sec", time.time()-start)
 
+        # Same again, blending every brush stamp into the image immediately.
+        canvas.deferred_composite = False
+        start = time.time()
+        for i in range(0,100):
+            canvas.start_playback()
+            canvas.finish_playback()
+        log.debug("Canvas playback benchmark without deferred compositing: %f sec", time.time()-start)
+        canvas.deferred_composite = True
+
+        # Same again, replaying the strokes on a single thread.
+        nthreads = canvas.get_playback_threads()
+        canvas.playback_threads = 1
+        start = time.time()
+        for i in range(0,100):
+            canvas.start_playback()
+            canvas.finish_playback()
+        log.debug("Canvas playback benchmark on one thread (%d by default): %f sec",
+            nthreads, time.time()-start)
+        canvas.playback_threads = 0
+
+        m = canvas.get_memory()
+        log.debug("Canvas memory: %d bytes (image %d, backup %d, alpha %d, pending %d, shared %d, reference %d, " \
+            "video %d, brush stamps %d, commands %d)", m.total, m.image, m.image_backup, m.alpha, m.pending, 
+            m.image_shared, m.image_reference, m.image_video, m.stamp_cache, m.commands)
+
         #canvasimage = gtk.gdk.Image(gtk.gdk.IMAGE_FASTEST, gtk.gdk.visual_get_system(), 600, 400)
         #start = time.time()
         #for i in range(0,100):
@@ -2153,9 +2617,26 @@ class Colors(activity.Activity, ExportedGObject):
             canvas.blit_2x(canvasimage, 0, 0, 0, 0, 600, 400, False)
         log.debug("Canvas 2.0x blit benchmark: %f sec", time.time()-start)
 
+        # Benchmark videopaint tracking on synthetic YUYV camera frames with a green blob.
+        from colorsc.benchmark import create_yuyv_test_frame
+        import pygst
+        pygst.require('0.10')
+        import gst
+        frame = gst.Buffer(create_yuyv_test_frame(640, 480, 400, 150, 60))
+        start = time.time()
+        for i in range(0,100):
+            canvas.videopaint_motion(frame, 640, 480)
+        log.debug("Videopaint 640x480 benchmark: %f sec (blob at %f,%f)", time.time()-start, 
+            canvas.videopaint_pos.x, canvas.videopaint_pos.y)
+
         # Benchmark a Palette object.
-        palette = Palette(500)
+        # The wheel is cached, so the first render (which may already have happened for the brush controls) is timed separately.
+        palette = Palette(BrushControlsPanel.PALETTE_SIZE)
         paletteimage = gtk.gdk.Image(gtk.gdk.IMAGE_FASTEST, gtk.gdk.visual_get_system(), BrushControlsPanel.PALETTE_SIZE, BrushControlsPanel.PALETTE_SIZE)
+        start = time.time()
+        palette.render_wheel(paletteimage)
+        log.debug("Palette first wheel benchmark: %f sec", time.time()-start)
+
         start = time.time()
         for i in range(0,100):
             palette.render_wheel(paletteimage)
@@ -2163,6 +2644,26 @@ class Colors(activity.Activity, ExportedGObject):
 
         start = time.time()
         for i in range(0,100):
+            # Change the hue each time, otherwise the triangle is not rendered again.
+            palette.palette_h = i*3.6
             palette.render_triangle(paletteimage)
         log.debug("Palette triangle benchmark: %f sec", time.time()-start)
 
+        # One full turn of the wheel in single degree steps, as when dragging the hue cursor around.
+        start = time.time()
+        for i in range(0,360):
+            palette.palette_h = i
+            palette.render_triangle(paletteimage)
+        log.debug("Palette triangle hue sweep benchmark: %f sec", time.time()-start)
+
+
+        # Benchmark the brush preview, scrubbing the size slider back and forth over the same values.
+        preview = BrushPreview(BrushControlsPanel.PREVIEW_SIZE)
+        previewimage = gtk.gdk.Image(gtk.gdk.IMAGE_FASTEST, gtk.gdk.visual_get_system(), BrushControlsPanel.PREVIEW_SIZE, BrushControlsPanel.PREVIEW_SIZE)
+        BrushPreview.clear_cache()
+        start = time.time()
+        for i in range(0,100):
+            preview.brush.size = 2 + (i%20)*6
+            preview.render(previewimage)
+        log.debug("Brush preview benchmark: %f sec (%d cache hits, %d misses)", time.time()-start, 
+            BrushPreview.get_cache_hits(), BrushPreview.get_cache_misses())
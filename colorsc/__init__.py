@@ -1,21 +1,69 @@
+"""The C++ part of Colors, wrapped by SWIG as colorsclib.
+
+colorsc/Makefile builds the wrappers into a directory named after the ABI they were built for, e.g. linux64_27 for a
+64 bit Python 2.7, and the bundle ships one of these for each supported ABI.  The one for the running interpreter is
+worked out up front and loaded directly.  Set COLORSC_LIB_DIR to load them from another directory instead, e.g. a
+local build.  Binaries built from older sources than this module are refused, see API_VERSION."""
+
 import os
 import sys
+import imp
+import time
+import struct
 import logging
 
-_sys_path = sys.path
-_root_path = os.path.dirname(__file__)
-
-for i in os.listdir(_root_path):
-    path = os.path.join(_root_path, i)
-    if (os.path.isdir(path)):
-        sys.path = _sys_path + [os.path.join('.', path)]
-        try:
-            from colorsclib import *
-            logging.debug('use %s blobs' % path)
-            _sys_path = None
-            break
-        except Exception, e:
-            logging.debug('skip %s blobs: %s' % (path, e))
-
-if _sys_path:
-    raise('cannot find proper binary blobs')
+_root_path = os.path.dirname(os.path.abspath(__file__))
+
+def get_lib_dir_name ():
+    """Returns the name of the directory with the wrappers for the running Python, as colorsc/Makefile names it.  Both
+    go by the pointer size of the interpreter rather than the machine, so keep them in step."""
+    return 'linux%d_%d%d' % (struct.calcsize('P')*8, sys.version_info[0], sys.version_info[1])
+
+def get_lib_dir ():
+    path = os.environ.get('COLORSC_LIB_DIR')
+    if path:
+        return os.path.join(_root_path, path)
+    return os.path.join(_root_path, get_lib_dir_name())
+
+def _load_module (name, lib_dir):
+    fp, pathname, description = imp.find_module(name, [lib_dir])
+    try:
+        return imp.load_module(name, fp, pathname, description)
+    finally:
+        if fp:
+            fp.close()
+
+def _load_colorsclib ():
+    # Loading is only ever done once per process, after which the modules are found in sys.modules.
+    if 'colorsclib' in sys.modules:
+        return
+
+    lib_dir = get_lib_dir()
+    if not os.path.isdir(lib_dir):
+        available = [i for i in os.listdir(_root_path) if os.path.isfile(os.path.join(_root_path, i, 'colorsclib.py'))]
+        available.sort()
+        raise ImportError("no colorsc binaries for this Python, expected them in %s (found %s); run make in %s to "
+            "build them, or set COLORSC_LIB_DIR" % (lib_dir, ', '.join(available) or 'none', _root_path))
+
+    # Older SWIG wrappers import _colorsclib by name, so load it first rather than put lib_dir on sys.path.
+    try:
+        _load_module('_colorsclib', lib_dir)
+        _load_module('colorsclib', lib_dir)
+    except ImportError, e:
+        raise ImportError("cannot load colorsc binaries from %s: %s" % (lib_dir, e))
+
+# The interface colors.py expects, see COLORSC_API_VERSION in colorsc.h.  Binaries from before it was introduced don't
+# define it at all.
+API_VERSION = 2
+
+start = time.time()
+_load_colorsclib()
+from colorsclib import *
+load_time = time.time() - start
+
+_version = getattr(sys.modules['colorsclib'], 'COLORSC_API_VERSION', 1)
+if _version != API_VERSION:
+    raise ImportError("the colorsc binaries in %s are out of date (interface version %d, expected %d); run make in %s "
+        "to rebuild them" % (get_lib_dir(), _version, API_VERSION, _root_path))
+logging.debug('use %s blobs, loaded in %.1fms' % (get_lib_dir(), load_time*1000))
+del start
@@ -0,0 +1,481 @@
+# Copyright 2008 by Jens Andersson and Wade Brainerd.
+# This file is part of Colors! XO.
+#
+# Colors is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Colors is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Colors.  If not, see <http://www.gnu.org/licenses/>.
+"""Headless benchmarks for the colorsc engine.
+
+Run from the activity bundle with
+
+    python -m colorsc.benchmark [--repeat N] [--filter NAME] [--output FILE] [--latency FILE] [--imports FILE]
+
+Nothing here needs Sugar, GTK or a display: blits and palette renders go into MemoryImage objects in plain memory, and
+videopaint is fed synthetic camera frames.  Each benchmark is run --repeat times and the fastest run is reported, in
+seconds per iteration, together with the commit it was run on, as JSON, so that results can be compared over time.
+
+The imports benchmark is the exception, as it times the Python modules the activity imports, which do need Sugar and
+GTK.  Modules which cannot be imported are listed in its results."""
+
+import os, sys, math, time, struct, shutil, tempfile, subprocess
+from optparse import OptionParser
+
+try:
+    import json
+    json.dumps
+except (ImportError, AttributeError):
+    import simplejson as json
+
+from colorsc import *
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_PATH = os.path.join(ROOT_PATH, 'data')
+
+# Prefer local modules.
+sys.path.insert(0, ROOT_PATH)
+from latency import LatencyHistogram, create_stroke_samples
+from rendercache import RenderCache
+
+# Canvas size used by the benchmarks, half of the XO screen as in the activity.
+CANVAS_WIDTH = 600
+CANVAS_HEIGHT = 450
+
+# Size of the images blitted into.  Every scale draws the same number of screen pixels.
+BLIT_WIDTH = 1200
+BLIT_HEIGHT = 900
+
+PALETTE_SIZE = 378
+
+# The modules colors.py imports when the activity starts, and those it only imports once a feature which needs them is
+# used.  Keep these in step with the imports in colors.py.
+STARTUP_IMPORTS = ['gobject', 'gtk', 'pango', 'sugar.activity.activity', 'sugar.graphics.style',
+    'sugar.graphics.toolbutton', 'sugar.graphics.toggletoolbutton', 'sugar.graphics.alert', 'sugar.graphics.menuitem',
+    'colorsc', 'videopaint', 'latency']
+DEFERRED_IMPORTS = ['pygame.camera', 'pygame.surface', 'dbus', 'telepathy', 'mesh',
+    'sugar.presence.presenceservice', 'sugar.datastore.datastore']
+
+# Run in a fresh interpreter to time the imports of each comma separated group of modules in its arguments, one group
+# after the other.  Prints a line for each module loaded, with the time spent in the module itself and including the
+# modules it imported, in microseconds, in the layout of the -X importtime option of later Pythons.
+IMPORT_TIMER = r"""
+import sys, time, __builtin__
+sys.path.insert(0, sys.argv[1])
+original_import = __builtin__.__import__
+nested = [0.0]
+def count_modules ():
+    return len([m for m in sys.modules.values() if m is not None])
+def timed_import (name, *args):
+    before = count_modules()
+    nested.append(0.0)
+    start = time.time()
+    try:
+        return original_import(name, *args)
+    finally:
+        t = time.time()-start
+        inner = nested.pop()
+        nested[-1] += t
+        if count_modules() != before:
+            print 'import time: %9d | %11d | %s%s' % ((t-inner)*1e6, t*1e6, '  '*(len(nested)-1), name)
+__builtin__.__import__ = timed_import
+for i, group in enumerate(sys.argv[2:]):
+    start = time.time()
+    for name in group.split(','):
+        try:
+            __import__(name)
+        except ImportError, e:
+            print 'missing %s: %s' % (name, e)
+    print 'group %d %d' % (i, (time.time()-start)*1e6)
+"""
+
+def create_yuyv_test_frame (width, height, cx, cy, r):
+    """Returns a synthetic YUYV camera frame as a string: a grey background with a green disc of radius r at cx,cy."""
+    # Each 32 bit word holds two pixels, packed the way Color::yuv_to_hsv unpacks them.
+    grey = struct.pack('<I', (120<<24)|(128<<16)|128)
+    green = struct.pack('<I', (145<<24)|(54<<16)|34)
+    rows = []
+    for y in range(height):
+        dy = y-cy
+        if abs(dy) < r:
+            dx = int(math.sqrt(r*r-dy*dy))
+            x0 = max(0, min(width, cx-dx))/2
+            x1 = max(0, min(width, cx+dx))/2
+            rows.append(grey*x0 + green*(x1-x0) + grey*(width/2-x1))
+        else:
+            rows.append(grey*(width/2))
+    return "".join(rows)
+
+def get_commit_id ():
+    """Returns the git commit the bundle is at, or None if it is not a git checkout."""
+    try:
+        p = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=ROOT_PATH,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out = p.communicate()[0]
+    except OSError:
+        return None
+    if p.returncode != 0:
+        return None
+    return out.strip()
+
+def get_drw_files ():
+    """Returns the names of the drawings in the data directory, without extension."""
+    names = [os.path.splitext(f)[0] for f in os.listdir(DATA_PATH) if f.endswith('.drw')]
+    names.sort()
+    return names
+
+def create_canvas (name=None):
+    canvas = Canvas(CANVAS_WIDTH, CANVAS_HEIGHT)
+    canvas.clear()
+    if name:
+        canvas.load(os.path.join(DATA_PATH, name + '.drw'))
+    return canvas
+
+class Benchmark:
+    """Runs timed functions and collects the results."""
+    def __init__ (self, repeat, filter=None):
+        self.repeat = repeat
+        self.filter = filter
+        self.results = {}
+        self.histograms = {}
+        self.import_report = []
+
+    def wants (self, name):
+        return not self.filter or self.filter in name
+
+    def run (self, name, fn, iterations=1):
+        """Calls fn iterations times, repeat times over, and records the best time per call.  fn may return a
+        dictionary of extra values to report, e.g. statistics about the work done; anything else it returns is
+        ignored."""
+        if not self.wants(name):
+            return
+        best = None
+        extra = None
+        for i in range(self.repeat):
+            start = time.time()
+            for j in range(iterations):
+                extra = fn()
+            t = (time.time()-start)/iterations
+            if best is None or t < best:
+                best = t
+        self.record(name, best, iterations, extra)
+
+    def record (self, name, seconds, iterations=1, extra=None):
+        result = { 'seconds': seconds, 'iterations': iterations }
+        if isinstance(extra, dict):
+            result.update(extra)
+        self.results[name] = result
+        sys.stderr.write("%-32s %10.3f ms\n" % (name, seconds*1000))
+
+def benchmark_drw (b):
+    tmpfd, tmpname = tempfile.mkstemp(suffix='.drw')
+    os.close(tmpfd)
+    try:
+        for name in get_drw_files():
+            filename = os.path.join(DATA_PATH, name + '.drw')
+            canvas = create_canvas()
+            # Snapshots are timed by benchmark_snapshots.
+            canvas.snapshot_max_bytes = 0
+            b.run('load/' + name, lambda: canvas.load(filename), 10)
+            b.run('save/' + name, lambda: canvas.save(tmpname), 10)
+
+            ncommands = canvas.get_num_commands()
+            b.run('convert_to_drw/' + name, lambda: canvas.send_drw_commands(0, ncommands), 10)
+            buf = canvas.send_drw_commands(0, ncommands)
+            b.run('convert_from_drw/' + name, lambda: canvas.receive_drw_commands(buf, 0), 10)
+    finally:
+        os.remove(tmpname)
+
+def benchmark_playback (b):
+    for name in get_drw_files():
+        canvas = create_canvas(name)
+        def playback ():
+            canvas.start_playback()
+            canvas.finish_playback()
+            return { 'commands': canvas.get_num_commands(), 'strokes': canvas.get_num_strokes() }
+        b.run('playback/' + name, playback)
+
+        # Same again, replaying the strokes on a single thread.
+        canvas.playback_threads = 1
+        b.run('playback_1thread/' + name, playback)
+        canvas.playback_threads = 0
+
+        # Same again, blending every brush stamp into the image immediately.
+        canvas.deferred_composite = False
+        b.run('playback_immediate/' + name, playback)
+        canvas.deferred_composite = True
+
+def benchmark_snapshots (b):
+    """Taking snapshots of each drawing, as colors.py does when idle, saving it with them and opening it again from
+    the last snapshot, to compare with playback.  The longest single make_next_snapshot call is reported too, as that
+    is how long the activity may not respond for."""
+    tmpfd, tmpname = tempfile.mkstemp(suffix='.drw')
+    os.close(tmpfd)
+    try:
+        for name in get_drw_files():
+            def make ():
+                canvas = create_canvas(name)
+                longest = 0
+                while True:
+                    start = time.time()
+                    more = canvas.make_next_snapshot()
+                    longest = max(longest, time.time()-start)
+                    if not more:
+                        break
+                return { 'snapshots': canvas.get_num_snapshots(), 'bytes': canvas.get_snapshot_bytes(),
+                         'longest_step': longest }
+            b.run('make_snapshots/' + name, make)
+
+            if not b.wants('save_snapshots/' + name) and not b.wants('open_snapshot/' + name):
+                continue
+            canvas = create_canvas(name)
+            canvas.make_snapshots()
+            b.run('save_snapshots/' + name, lambda: canvas.save(tmpname), 10)
+
+            if not b.wants('open_snapshot/' + name):
+                continue
+            canvas.save(tmpname)
+            canvas = create_canvas()
+            canvas.load(tmpname)
+            def open_drawing ():
+                canvas.start_playback()
+                canvas.restore_snapshot(canvas.playback_length())
+                canvas.finish_playback()
+            b.run('open_snapshot/' + name, open_drawing)
+    finally:
+        os.remove(tmpname)
+
+def benchmark_render_cache (b):
+    """Resuming each drawing from the render cache, as read_file in colors.py does, to compare with playback."""
+    path = tempfile.mkdtemp()
+    try:
+        cache = RenderCache(path, 64*1024*1024)
+        for name in get_drw_files():
+            canvas = create_canvas(name)
+            canvas.start_playback()
+            canvas.finish_playback()
+            ncommands = canvas.playback_length()
+            def get_key ():
+                buf = canvas.send_drw_commands(0, ncommands)
+                return cache.get_key(buf.get_bytes(), canvas.width, canvas.height)
+            key = get_key()
+            b.run('render_cache_store/' + name,
+                lambda: cache.store(key, ncommands, canvas.width, canvas.height, canvas.get_playback_pixels()))
+            def restore ():
+                # Working out the key is part of what read_file does to restore a drawing.
+                key = get_key()
+                canvas.start_playback()
+                pixels = cache.load(key, ncommands, canvas.width, canvas.height)
+                canvas.finish_playback_from_pixels(pixels, len(pixels))
+                return { 'bytes': os.path.getsize(cache.get_entry_path(key, ncommands, canvas.width, canvas.height)) }
+            b.run('render_cache/' + name, restore)
+    finally:
+        shutil.rmtree(path)
+
+def benchmark_draw_brush (b):
+    canvas = create_canvas()
+    for typename, brushtype in [('hard', BrushType.BRUSHTYPE_HARD), ('soft', BrushType.BRUSHTYPE_SOFT)]:
+        for size in [4, 16, 64, 256]:
+            canvas.brush.type = brushtype
+            # A diagonal line of overlapping stamps, one per pixel of distance, as the brush spacing would give.
+            positions = [Pos(50+i*2, 50+i*1.5) for i in range(200)]
+            def draw ():
+                for pos in positions:
+                    canvas.draw_brush(pos, size, 128)
+                canvas.resolve_pending()
+            b.run('draw_brush/%s/%d' % (typename, size), draw)
+
+def benchmark_blit (b):
+    canvas = create_canvas(get_drw_files()[0])
+    canvas.start_playback()
+    canvas.finish_playback()
+    for depth in [16, 24]:
+        image = MemoryImage(BLIT_WIDTH, BLIT_HEIGHT, depth)
+        for scale, blit in [(1, canvas.blit_1x), (2, canvas.blit_2x), (4, canvas.blit_4x), (8, canvas.blit_8x)]:
+            b.run('blit_%dx/%d' % (scale, depth),
+                lambda: blit(image, 0, 0, 0, 0, BLIT_WIDTH, BLIT_HEIGHT, False), 10)
+        b.run('blit_2x_overlay/%d' % depth,
+            lambda: canvas.blit_2x(image, 0, 0, 0, 0, BLIT_WIDTH, BLIT_HEIGHT, True), 10)
+
+def benchmark_resize (b):
+    canvas = create_canvas(get_drw_files()[0])
+    canvas.start_playback()
+    canvas.finish_playback()
+    sizes = [(CANVAS_WIDTH*2, CANVAS_HEIGHT*2), (CANVAS_WIDTH, CANVAS_HEIGHT)]
+    def resize ():
+        for w, h in sizes:
+            canvas.resize(w, h)
+    b.run('resize', resize, 5)
+
+def benchmark_palette (b):
+    image = MemoryImage(PALETTE_SIZE, PALETTE_SIZE, 24)
+
+    # The wheel is cached, so the first render is timed separately.
+    b.run('palette/wheel_first', lambda: Palette(PALETTE_SIZE).render_wheel(image), 10)
+    palette = Palette(PALETTE_SIZE)
+    b.run('palette/wheel', lambda: palette.render_wheel(image), 100)
+
+    # Change the hue each time, otherwise the triangle is not rendered again.
+    hue = [0]
+    def triangle ():
+        hue[0] = (hue[0] + 1) % 360
+        palette.palette_h = hue[0]
+        palette.render_triangle(image)
+    b.run('palette/triangle', triangle, 100)
+
+def benchmark_videopaint (b):
+    canvas = create_canvas()
+    frame = create_yuyv_test_frame(640, 480, 400, 150, 60)
+    def videopaint ():
+        canvas.videopaint_motion_from_string(frame, len(frame), 640, 480)
+        return { 'x': canvas.videopaint_pos.x, 'y': canvas.videopaint_pos.y }
+    b.run('videopaint/640x480', videopaint, 100)
+
+def benchmark_input_latency (b):
+    """Replays synthetic stylus input through the steps Colors takes for each sample in canvas mode: update_mode
+    saves the undo image at the start of a stroke and calls draw, which plays a draw command, and flush_dirty_canvas
+    blits the dirty rectangle to the screen image at 1x zoom.  The latency of each sample is recorded."""
+    samples = create_stroke_samples(CANVAS_WIDTH, CANVAS_HEIGHT)
+    image = MemoryImage(CANVAS_WIDTH, CANVAS_HEIGHT, 16)
+    for size in [8, 32, 128]:
+        name = 'input_latency/%d' % size
+        def replay ():
+            canvas = create_canvas()
+            canvas.play_command(DrawCommand.create_size_change(canvas.brush.control, canvas.brush.type, 
+                size/float(CANVAS_WIDTH), canvas.brush.opacity), True)
+            histogram = LatencyHistogram()
+            for x, y, pressure, touching in samples:
+                start = time.time()
+                if touching:
+                    if not canvas.stroke:
+                        canvas.save_shared_image()
+                    relpos = Pos(x, y) / Pos(CANVAS_WIDTH, CANVAS_HEIGHT)
+                    canvas.play_command(DrawCommand.create_draw(relpos, pressure), True)
+                elif canvas.stroke:
+                    canvas.play_command(DrawCommand.create_end_draw(pressure), True)
+                if canvas.dirtymin.x <= canvas.dirtymax.x:
+                    x0, y0 = int(canvas.dirtymin.x), int(canvas.dirtymin.y)
+                    x1, y1 = int(canvas.dirtymax.x), int(canvas.dirtymax.y)
+                    canvas.blit_1x(image, x0, y0, x0, y0, x1-x0+1, y1-y0+1, False)
+                    canvas.reset_dirty_rect()
+                histogram.add(time.time() - start)
+            b.histograms[name] = histogram
+            return histogram.get_summary()
+        b.run(name, replay)
+
+def benchmark_imports (b):
+    """Times importing the modules the activity needs at startup, and then the ones it defers, in a fresh interpreter
+    each run as a module is only loaded once per process.  The deferred time is what startup saves by not importing
+    them up front.  The module tree of the fastest run is kept for --imports."""
+    if not b.wants('imports/startup') and not b.wants('imports/deferred'):
+        return
+    best = None
+    for i in range(b.repeat):
+        p = subprocess.Popen([sys.executable, '-c', IMPORT_TIMER, ROOT_PATH, ','.join(STARTUP_IMPORTS),
+            ','.join(DEFERRED_IMPORTS)], cwd=ROOT_PATH, stdout=subprocess.PIPE)
+        out = p.communicate()[0]
+        groups = []
+        missing = []
+        report = []
+        for line in out.splitlines():
+            if line.startswith('import time:'):
+                report.append(line)
+            elif line.startswith('missing '):
+                missing.append(line[len('missing '):])
+            elif line.startswith('group '):
+                groups.append((int(line.split()[2])/1.0e6, missing, report))
+                missing = []
+                report = []
+        if len(groups) != 2:
+            raise RuntimeError("import timer failed: %r" % out)
+        if best is None or groups[0][0] < best[0][0]:
+            best = groups
+
+    for name, (seconds, missing, report) in zip(['imports/startup', 'imports/deferred'], best):
+        if b.wants(name):
+            b.record(name, seconds, 1, { 'missing': missing })
+            b.import_report.append((name, report))
+
+BENCHMARKS = [
+    benchmark_drw,
+    benchmark_playback,
+    benchmark_snapshots,
+    benchmark_render_cache,
+    benchmark_draw_brush,
+    benchmark_blit,
+    benchmark_resize,
+    benchmark_palette,
+    benchmark_videopaint,
+    benchmark_input_latency,
+    benchmark_imports,
+]
+
+def main (argv):
+    parser = OptionParser(usage="python -m colorsc.benchmark [options]")
+    parser.add_option('-r', '--repeat', type='int', default=3,
+        help="number of times to run each benchmark, keeping the fastest [%default]")
+    parser.add_option('-f', '--filter', default=None,
+        help="only run benchmarks whose name contains FILTER")
+    parser.add_option('-o', '--output', default=None,
+        help="write the JSON results to OUTPUT rather than stdout")
+    parser.add_option('-l', '--latency', default=None,
+        help="write the full input latency distributions to LATENCY")
+    parser.add_option('-i', '--imports', default=None,
+        help="write the time taken to import each module to IMPORTS")
+    options, args = parser.parse_args(argv)
+
+    b = Benchmark(options.repeat, options.filter)
+    for fn in BENCHMARKS:
+        fn(b)
+
+    report = {
+        'commit': get_commit_id(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()),
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'repeat': options.repeat,
+        'results': b.results,
+    }
+    if options.latency:
+        f = open(options.latency, 'w')
+        try:
+            names = b.histograms.keys()
+            names.sort()
+            for name in names:
+                f.write("# %s: %s\n" % (name, b.histograms[name]))
+                b.histograms[name].dump(f)
+                f.write("\n")
+        finally:
+            f.close()
+    if options.imports:
+        f = open(options.imports, 'w')
+        try:
+            for name, lines in b.import_report:
+                f.write("# %s\n" % name)
+                f.write("import time: self [us] | cumulative | imported package\n")
+                for line in lines:
+                    f.write(line + "\n")
+                f.write("\n")
+        finally:
+            f.close()
+
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(report, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
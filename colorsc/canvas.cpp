@@ -21,6 +21,24 @@ unsigned char BrushType::distance_tbl[DIST_TABLE_WIDTH][DIST_TABLE_WIDTH];
 
 BrushType Brush::brush_type[BrushType::NUM_BRUSHES];
 
+YuvHsvTable Canvas::yuv_hsv_tbl;
+
+const char* ProfileCounter::names[ProfileCounter::NUM_COUNTERS] =
+{
+    "draw_brush",
+    "command_draw",
+    "command_enddraw",
+    "play_command",
+    "blit_1x",
+    "blit_2x",
+    "blit_4x",
+    "blit_8x",
+    "render_overlay",
+    "videopaint_motion",
+    "load",
+    "save",
+};
+
 void test_method(void* data)
 {
 }
@@ -24,11 +24,25 @@
 #include "colorsc.h"
 #include "drwfile.h"
 
+#include <list>
+#include <map>
+#include <queue>
+
+#include <pthread.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <time.h>
+#include <zlib.h>
+#include <new>
+
 using namespace std;
 
 // Uncomment this to print all executed drawing commands to stdout.
 //#define CANVAS_DEBUG_COMMANDS
 
+// Comment this out to compile out the profiling counters, see Canvas::profiling.
+#define CANVAS_PROFILE
+
 // Structure for passing pixel data to and from Python.
 struct SurfaceA8R8G8B8
 {
@@ -37,71 +51,161 @@ struct SurfaceA8R8G8B8
     unsigned int* pixels;
 };
 
+// A GdkImage whose pixels are in plain memory rather than on a display, so that the blit and palette code can be run
+// and measured without GTK.  The typemap in colorsclib.i accepts one wherever a GdkImage* is expected.
+struct MemoryImage
+{
+    GdkImage image;
+
+    MemoryImage(int width, int height, int depth)
+    {
+        memset(&image, 0, sizeof(GdkImage));
+        image.width = width;
+        image.height = height;
+        image.depth = depth;
+        image.bpp = depth == 16 ? 2 : 4;
+        image.bpl = width*image.bpp;
+        image.bits_per_pixel = image.bpp*8;
+        image.mem = calloc(image.bpl*height, 1);
+    }
+
+    ~MemoryImage()
+    {
+        free(image.mem);
+    }
+
+    int get_width() { return image.width; }
+    int get_height() { return image.height; }
+    int get_depth() { return image.depth; }
+
+private:
+    MemoryImage(const MemoryImage&);
+    MemoryImage& operator=(const MemoryImage&);
+};
+
 // Structure for passing buffers of draw commands to and from Python.
+// 
+// The buffer grows geometrically and consumed commands are dropped from the front by advancing an offset, so that
+// a queue which is constantly appended to and drained costs amortized O(1) per command rather than a full copy
+// per append.
 struct DrawCommandBuffer
 {
+    // Smallest allocation made, in commands.
+    static const int MIN_CAPACITY = 64;
+
     DrawCommandBuffer()
     {
         cmds = NULL;
         ncommands = 0;
+        data = NULL;
+        capacity = 0;
     }
 
     DrawCommandBuffer(const char* _cmds, int _ncommands)
     {
-        cmds = (char*)malloc(_ncommands*sizeof(unsigned int));
-        memcpy(cmds, _cmds, _ncommands*sizeof(unsigned int));
-        ncommands = _ncommands;
+        cmds = NULL;
+        ncommands = 0;
+        data = NULL;
+        capacity = 0;
+        append_from_string(_cmds, _ncommands);
     }
 
     DrawCommandBuffer(const DrawCommandBuffer& b)
     {
-        cmds = (char*)malloc(b.ncommands*sizeof(unsigned int));
-        memcpy(cmds, b.cmds, b.ncommands*sizeof(unsigned int));
-        ncommands = b.ncommands;
+        cmds = NULL;
+        ncommands = 0;
+        data = NULL;
+        capacity = 0;
+        append_from_string(b.cmds, b.ncommands);
     }
 
     ~DrawCommandBuffer()
     {
-        if (cmds)
+        if (data)
         {
-            free((void*)cmds);
-            cmds = NULL;
+            free((void*)data);
+            data = NULL;
         }
+        cmds = NULL;
     }
 
     const DrawCommandBuffer& operator=(const DrawCommandBuffer& b)
     {
-        if (cmds)
-            free((void*)cmds);
-        cmds = (char*)malloc(b.ncommands*sizeof(unsigned int));
-        memcpy(cmds, b.cmds, b.ncommands*sizeof(unsigned int));
-        ncommands = b.ncommands;
+        if (&b == this)
+            return *this;
+        ncommands = 0;
+        cmds = data;
+        append_from_string(b.cmds, b.ncommands);
         return *this;
     }
 
-    void append(const DrawCommandBuffer& b)
+    // Makes room for at least n commands after the current ones.
+    void reserve(int n)
     {
-        char* newcmds = (char*)malloc((ncommands+b.ncommands)*sizeof(unsigned int));
-        if (cmds)
+        int offset = cmds ? (cmds - data) / sizeof(unsigned int) : 0;
+        if (offset + ncommands + n <= capacity)
+            return;
+
+        // Reclaim the consumed space at the front if that leaves at least as much free space as is in use.
+        if (ncommands + n <= capacity/2)
         {
-            memcpy(newcmds, cmds, ncommands*sizeof(unsigned int));
-            free(cmds);
+            memmove(data, cmds, ncommands*sizeof(unsigned int));
+            cmds = data;
+            return;
+        }
+
+        int newcapacity = max(capacity*2, MIN_CAPACITY);
+        while (newcapacity < ncommands + n)
+            newcapacity *= 2;
+        char* newdata = (char*)malloc(newcapacity*sizeof(unsigned int));
+        if (data)
+        {
+            memcpy(newdata, cmds, ncommands*sizeof(unsigned int));
+            free(data);
         }
-        memcpy(newcmds + ncommands*sizeof(unsigned int), b.cmds, b.ncommands*sizeof(unsigned int));
-        cmds = newcmds;
-        ncommands = ncommands + b.ncommands;
+        data = newdata;
+        cmds = newdata;
+        capacity = newcapacity;
+    }
+
+    void append(const DrawCommandBuffer& b)
+    {
+        append_from_string(b.cmds, b.ncommands);
     }
 
+    // Appends raw DRW commands, e.g. straight from a received Python string, without building a temporary buffer.
+    void append_from_string(const char* _cmds, int _ncommands)
+    {
+        if (_ncommands <= 0)
+            return;
+        reserve(_ncommands);
+        memcpy(cmds + ncommands*sizeof(unsigned int), _cmds, _ncommands*sizeof(unsigned int));
+        ncommands += _ncommands;
+    }
+
+    // Removes the first n commands.
+    void consume(int n)
+    {
+        n = min(max(n, 0), ncommands);
+        ncommands -= n;
+        if (ncommands == 0)
+            cmds = data;
+        else
+            cmds += n*sizeof(unsigned int);
+    }
+
+    // Removes all commands, but keeps the allocation for reuse.
     void clear()
     {
-        if (cmds)
-        {
-            free(cmds);
-            cmds = NULL;
-        }
+        cmds = data;
         ncommands = 0;
     }
 
+    int get_capacity()
+    {
+        return capacity;
+    }
+
     ByteBuffer get_bytes()
     {
         ByteBuffer buf;
@@ -113,6 +217,10 @@ struct DrawCommandBuffer
     char* cmds;
     int ncommands;
 
+    // Underlying allocation, of which cmds is a part.  Capacity is in commands.
+    char* data;
+    int capacity;
+
     static DrawCommandBuffer create_from_string(const char* cmds, int ncommands)
     {
         return DrawCommandBuffer(cmds, ncommands);
@@ -358,6 +466,117 @@ public:
     }
 };
 
+// Index entry for one stroke in the command list, see Canvas::stroke_index.  Positions and sizes are relative to the
+// canvas size, like those of the draw commands, so the index doesn't change when the canvas is resized.
+struct StrokeInfo
+{
+    int begin;                      // Index of the first draw command of the stroke.
+    int end;                        // Index just after its end draw command, or -1 if the stroke is unfinished.
+    Pos min, max;                   // Bounds of the draw positions, not including the brush.
+    int color_command;              // Index of the color change in effect at the start of the stroke, or -1.
+    int size_command;               // Index of the size change in effect at the start of the stroke, or -1.
+    float size;                     // Largest brush size in effect during the stroke.
+    int max_pressure;               // Highest pressure of the draw commands.
+    float cost;                     // Estimated replay cost, the area swept by the brush as a fraction of the canvas.
+    float total_cost;               // Cost of all strokes up to and including this one.
+};
+
+// Pixels saved at one of the stroke ends, see Canvas::make_next_snapshot.
+struct CanvasSnapshot
+{
+    int pos;                        // Number of commands replayed.
+    vector<unsigned char> data;     // The pixels from Canvas::get_playback_pixels, compressed with zlib.
+};
+
+// Memory used by the buffers of a Canvas, in bytes, see Canvas::get_memory.
+struct CanvasMemory
+{
+    int image;
+    int image_backup;
+    int alpha;
+    int pending;
+    int image_shared;
+    int image_reference;
+    int image_video;
+    int stamp_cache;
+    int commands;
+    int total;
+};
+
+// Call count, pixels touched and time taken by one of the profiled Canvas functions, see Canvas::profiling.
+// Times include the time of any other profiled functions called, e.g. play_command includes command_draw.
+struct ProfileCounter
+{
+    enum
+    {
+        DRAW_BRUSH,
+        COMMAND_DRAW,
+        COMMAND_ENDDRAW,
+        PLAY_COMMAND,
+        BLIT_1X,
+        BLIT_2X,
+        BLIT_4X,
+        BLIT_8X,
+        RENDER_OVERLAY,
+        VIDEOPAINT_MOTION,
+        LOAD,
+        SAVE,
+        NUM_COUNTERS
+    };
+
+    static const char* names[NUM_COUNTERS];
+
+    int calls;
+    long long pixels;
+    long long ns;
+
+    static long long get_time_ns()
+    {
+        timespec t;
+        clock_gettime(CLOCK_MONOTONIC, &t);
+        return t.tv_sec*1000000000LL + t.tv_nsec;
+    }
+};
+
+// Adds the time from construction to destruction to a ProfileCounter, unless it is NULL.
+struct ProfileTimer
+{
+    ProfileCounter* counter;
+    long long start;
+
+    ProfileTimer(ProfileCounter* counter) : counter(counter)
+    {
+        if (counter)
+            start = ProfileCounter::get_time_ns();
+    }
+
+    ~ProfileTimer()
+    {
+        if (counter)
+        {
+            counter->calls++;
+            counter->ns += ProfileCounter::get_time_ns() - start;
+        }
+    }
+};
+
+#ifdef CANVAS_PROFILE
+#define PROFILE_SCOPE(counter) ProfileTimer profile_timer(profiling ? &profile[ProfileCounter::counter] : NULL)
+#define PROFILE_PIXELS(counter, n) if (profiling) profile[ProfileCounter::counter].pixels += (n)
+#else
+#define PROFILE_SCOPE(counter)
+#define PROFILE_PIXELS(counter, n)
+#endif
+
+// A ready-made 8-bit intensity mask for one brush stamp, before opacity is applied.  
+// Stamps are cached by the Canvas so that a stroke at a fixed size doesn't have to look up the brush tables for
+// every pixel of every stamp.  See draw_brush.
+struct BrushStamp
+{
+    int size;                       // The mask is size x size pixels.
+    vector<unsigned char> mask;
+};
+
 // The canvas represents the current state of the user's painting.  It maintains both the pixels representing the
 // image, and also the complete list of drawing commands that contributed to the image.
 class Canvas
@@ -383,6 +602,14 @@ public:
     // List of drawing commands that make up the painting.
     vector<DrawCommand> commands;
 
+    // Index of the strokes in the command list, in order.  Kept up to date as commands are added, so that stroke 
+    // boundaries can be found with a binary search rather than a scan of the commands.
+    vector<StrokeInfo> stroke_index;
+    int indexed_commands;           // Number of commands that have been indexed.
+    int index_color_command;        // Color change and size change in effect after the indexed commands.
+    int index_size_command;
+    Pos index_lastpos;              // Last draw position of the unfinished stroke.
+
     // Canvas dimensions.
     int width;
     int height;
@@ -394,13 +621,29 @@ public:
     unsigned int* image_backup;
     unsigned char* alpha;
 
+    // Deferred compositing, see description in Drawing section.  Pixels whose alpha has changed but which have not 
+    // been blended into image yet are flagged in pending, and lie within the pending rectangle.
+    bool deferred_composite;
+    unsigned char* pending;
+    int pending_x0, pending_y0, pending_x1, pending_y1;
+    Color pending_color;
+
     // Shared (master) picture for collaborative painting.
     unsigned int* image_shared;
 
+    // Sparse storage, see description in Sparse storage section.  The canvas is divided into bands of rows, and 
+    // only the bands that have been painted on hold real pixels.
+    static const int BAND_HEIGHT = 16;
+    bool sparse;
+    vector<unsigned char> bands;            // Bands of image and image_backup which hold real pixels.
+    vector<unsigned char> shared_bands;     // Bands of image_shared which hold real pixels.
+    unsigned int* blank_row;                // One row of white pixels, standing in for the rows of blank bands.
+
     // Reference (webcam snapshot) picture.
     unsigned short* image_reference;
 
     // Videopaint variables.
+    static YuvHsvTable yuv_hsv_tbl;
     unsigned int* image_video[2];
     int video_idx;
     Pos videopaint_pos;
@@ -425,40 +668,81 @@ public:
     int idle_while_drawing;
     int drawtype;
 
+    // Brush stamp cache, see draw_brush.  Keyed by (brush type, brush width), and kept in least recently used order, 
+    // most recent first.
+    static const int STAMP_CACHE_BYTES = 4*1024*1024;
+    typedef pair<int, int> StampKey;
+    typedef list<pair<StampKey, BrushStamp> > StampList;
+    bool stamp_cache_enabled;
+    StampList stamp_list;
+    map<StampKey, StampList::iterator> stamp_map;
+    int stamp_cache_bytes;
+    int stamp_hits;
+    int stamp_misses;
+
     // VCR playback variables.
     bool playing;
     int playback;
     int playback_speed;
 
+    // Number of threads used to replay strokes in parallel, see finish_playback.  0 uses one per processor.
+    static const int MAX_PLAYBACK_THREADS = 8;
+    int playback_threads;
+
+    // True for a view, which draws into the pixels of another canvas rather than owning its own.
+    bool view;
+
     // True if the canvas has been modified since the last save.
     bool modified;
 
-    Canvas(int width, int height) : width(width), height(height)
-    {
-        image = new unsigned int[width*height];
-        image_backup = new unsigned int[width*height];
-        alpha = new unsigned char[width*height];
+    // Counters for the hot paths, see ProfileCounter.  These are only collected while profiling is set, and only
+    // when compiled with CANVAS_PROFILE, so they cost a branch per call otherwise.
+    bool profiling;
+    ProfileCounter profile[ProfileCounter::NUM_COUNTERS];
+
+    // Pixels returned by get_playback_pixels.
+    vector<unsigned char> playback_pixels;
 
-        image_shared = new unsigned int[width*height];
+    // Snapshots of the pixels at some of the stroke ends, in order, see Snapshots section.  Saved with the drawing
+    // unless snapshot_max_bytes is 0.
+    static const int SNAPSHOT_MAX_BYTES = 1024*1024;
+    vector<CanvasSnapshot> snapshots;
+    int snapshot_max_bytes;
+
+    // A sparse canvas only uses memory for the parts that have been painted on, see Sparse storage section.
+    Canvas(int width, int height, bool sparse = false) : width(width), height(height), sparse(sparse)
+    {
+        indexed_commands = 0;
 
-        image_reference = new unsigned short[REFERENCE_WIDTH*REFERENCE_HEIGHT];
-        memset(image_reference, 0, REFERENCE_WIDTH*REFERENCE_HEIGHT*sizeof(unsigned short));
+        image = alloc_pixels<unsigned int>(width*height);
+        image_backup = alloc_pixels<unsigned int>(width*height);
+        alpha = alloc_pixels<unsigned char>(width*height);
+        pending = alloc_pixels<unsigned char>(width*height);
+        deferred_composite = true;
 
-        image_video[0] = new unsigned int[VIDEO_WIDTH*VIDEO_HEIGHT];
-        image_video[1] = new unsigned int[VIDEO_WIDTH*VIDEO_HEIGHT];
-        memset(image_video[0], 0, VIDEO_WIDTH*VIDEO_HEIGHT*sizeof(unsigned int));
-        memset(image_video[1], 0, VIDEO_WIDTH*VIDEO_HEIGHT*sizeof(unsigned int));
+        // The shared, reference and video images are only allocated once they are used.
+        image_shared = NULL;
+        image_reference = NULL;
+        image_video[0] = image_video[1] = NULL;
         video_idx = 0;
 
+        blank_row = NULL;
+        create_bands();
+
         clear();
 
-        // Initialize lookup table.
-        BrushType::create_distance_table();
+        // Initialize lookup tables and brushes.  These are shared by all canvases, so only the first one does it.
+        static bool brushes_created = false;
+        if (!brushes_created)
+        {
+            BrushType::create_distance_table();
 
-        // Initialize brushes.
-        Brush::brush_type[BrushType::BRUSHTYPE_HARD].create_hard_brush();
-        Brush::brush_type[BrushType::BRUSHTYPE_SOFT].create_soft_brush();
-        Brush::brush_type[BrushType::BRUSHTYPE_CURSOR].create_cursor();
+            Brush::brush_type[BrushType::BRUSHTYPE_HARD].create_hard_brush();
+            Brush::brush_type[BrushType::BRUSHTYPE_SOFT].create_soft_brush();
+            Brush::brush_type[BrushType::BRUSHTYPE_CURSOR].create_cursor();
+            brushes_created = true;
+        }
+        yuv_hsv_tbl.create();
 
         reset_brush();
 
@@ -476,25 +760,44 @@ public:
         playing = false;
         playback = 0;
         playback_speed = 1;
+        playback_threads = 0;
+        snapshot_max_bytes = SNAPSHOT_MAX_BYTES;
+        view = false;
         modified = false;
 
         idle_while_drawing = 0;
 
         drawtype = DRAWBRUSH_TYPE_NORMAL;
+
+        stamp_cache_enabled = true;
+        stamp_cache_bytes = 0;
+        stamp_hits = stamp_misses = 0;
+
+        profiling = false;
+        reset_profile();
     }
 
     ~Canvas()
     {
-        delete[] image;
-        delete[] image_backup;
-        delete[] image_shared;
-        delete[] alpha;
+        // Views only borrow the pixels of their parent.
+        if (view)
+            return;
+
+        free_pixels(image, width*height);
+        free_pixels(image_backup, width*height);
+        free_pixels(image_shared, width*height);
+        free_pixels(alpha, width*height);
+        free_pixels(pending, width*height);
+        delete[] blank_row;
+        release_reference_image();
+        release_video_images();
     }
 
     // Clears the entire canvas (command history and image).
     void clear()
     {
         commands.clear();
+        reindex_strokes(0);
         clear_image();
     }
 
@@ -502,34 +805,63 @@ public:
     // Rather than trying to repaint everything from scratch, we simply quickly rescale it.
     void resize(int new_width, int new_height)
     {
-        unsigned int* new_image = new unsigned int[new_width*new_height];
-        unsigned int* new_image_backup = new unsigned int[new_width*new_height];
-        unsigned char* new_alpha = new unsigned char[new_width*new_height];
-        unsigned int* new_image_shared = new unsigned int[new_width*new_height];
+        resolve_pending();
 
-        int dx = (1<<16) * width / new_width;
+        // Snapshots are only any use on a canvas of the size they were taken on.
+        snapshots.clear();
+
+        unsigned int* new_image = alloc_pixels<unsigned int>(new_width*new_height);
+        unsigned int* new_image_backup = alloc_pixels<unsigned int>(new_width*new_height);
+        unsigned char* new_alpha = alloc_pixels<unsigned char>(new_width*new_height);
+        unsigned int* new_image_shared = image_shared ? alloc_pixels<unsigned int>(new_width*new_height) : NULL;
+
+        // A band of the resized canvas holds real pixels if any of the rows it is scaled from do.
+        int new_nbands = (new_height + BAND_HEIGHT-1) / BAND_HEIGHT;
+        vector<unsigned char> new_bands(new_nbands, 1), new_shared_bands(new_nbands, image_shared ? 1 : 0);
         int dy = (1<<16) * height / new_height;
+        if (sparse)
+        {
+            new_bands.assign(new_nbands, 0);
+            new_shared_bands.assign(new_nbands, 0);
+            for (int y = 0, ry = 0; y < new_height; y++, ry += dy)
+            {
+                new_bands[y/BAND_HEIGHT] |= bands[(ry>>16)/BAND_HEIGHT];
+                new_shared_bands[y/BAND_HEIGHT] |= shared_bands[(ry>>16)/BAND_HEIGHT];
+            }
+        }
+
+        int dx = (1<<16) * width / new_width;
         int ry = 0;
         for (int y = 0; y < new_height; y++)
         {
+            const unsigned int* __restrict src_image = get_image_row(ry>>16);
+            const unsigned int* __restrict src_image_backup = get_image_backup_row(ry>>16);
+            const unsigned int* __restrict src_image_shared = get_image_shared_row(ry>>16);
+            const unsigned char* __restrict src_alpha = &alpha[(ry>>16)*width];
+            bool band = new_bands[y/BAND_HEIGHT];
+            bool shared_band = new_shared_bands[y/BAND_HEIGHT];
             int rx = 0;
             for (int x = 0; x < new_width; x++)
             {
-                int sofs = (ry>>16)*width + (rx>>16);
                 int dofs = y*new_width+x;
-                new_image[dofs] = image[sofs];
-                new_image_backup[dofs] = image_backup[sofs];
-                new_alpha[dofs] = alpha[sofs];
-                new_image_shared[dofs] = image_shared[sofs];
+                if (band)
+                {
+                    new_image[dofs] = src_image[rx>>16];
+                    new_image_backup[dofs] = src_image_backup[rx>>16];
+                    new_alpha[dofs] = src_alpha[rx>>16];
+                }
+                if (shared_band)
+                    new_image_shared[dofs] = src_image_shared[rx>>16];
                 rx += dx;
             }
             ry += dy;
         }
  
-        delete[] image;
-        delete[] image_backup;
-        delete[] alpha;
-        delete[] image_shared;
+        free_pixels(image, width*height);
+        free_pixels(image_backup, width*height);
+        free_pixels(alpha, width*height);
+        free_pixels(image_shared, width*height);
+        free_pixels(pending, width*height);
         
         width = new_width;
         height = new_height;
@@ -538,6 +870,15 @@ public:
         image_backup = new_image_backup;
         alpha = new_alpha;
         image_shared = new_image_shared;
+
+        pending = alloc_pixels<unsigned char>(width*height);
+        if (!sparse)
+            memset(pending, 0, width*height*sizeof(unsigned char));
+        pending_x0 = pending_y0 = pending_x1 = pending_y1 = 0;
+
+        create_bands();
+        bands = new_bands;
+        shared_bands = new_shared_bands;
     }
     
     // Resets the brush to a random color and a default size and type.
@@ -566,13 +907,266 @@ public:
     // to the activity host, so they will be received again as a new master image later and not be lost.
     void save_shared_image()
     {
-        memcpy(image_shared, image, width*height*sizeof(unsigned int));
+        resolve_pending();
+        if (!image_shared)
+        {
+            image_shared = alloc_pixels<unsigned int>(width*height);
+            shared_bands.assign(shared_bands.size(), sparse ? 0 : 1);
+        }
+        if (!sparse)
+        {
+            memcpy(image_shared, image, width*height*sizeof(unsigned int));
+            return;
+        }
+        for (int b = 0; b < (int)bands.size(); b++)
+        {
+            int y0 = b*BAND_HEIGHT;
+            int n = (min(y0+BAND_HEIGHT, height)-y0)*width;
+            if (bands[b])
+                memcpy(&image_shared[y0*width], &image[y0*width], n*sizeof(unsigned int));
+            else if (shared_bands[b])
+                release_pixels(&image_shared[y0*width], n*sizeof(unsigned int));
+            shared_bands[b] = bands[b];
+        }
     }
 
     void restore_shared_image()
     {
-        memcpy(image, image_shared, width*height*sizeof(unsigned int));
-        memcpy(image_backup, image_shared, width*height*sizeof(unsigned int));
+        // Anything still pending would have been overwritten here.
+        discard_pending();
+        if (!sparse && !image_shared)
+        {
+            memset(image, 0xff, width*height*sizeof(unsigned int));
+            memset(image_backup, 0xff, width*height*sizeof(unsigned int));
+            return;
+        }
+        if (!sparse)
+        {
+            memcpy(image, image_shared, width*height*sizeof(unsigned int));
+            memcpy(image_backup, image_shared, width*height*sizeof(unsigned int));
+            return;
+        }
+        for (int b = 0; b < (int)bands.size(); b++)
+        {
+            int y0 = b*BAND_HEIGHT;
+            int n = (min(y0+BAND_HEIGHT, height)-y0)*width;
+            if (shared_bands[b])
+            {
+                memcpy(&image[y0*width], &image_shared[y0*width], n*sizeof(unsigned int));
+                memcpy(&image_backup[y0*width], &image_shared[y0*width], n*sizeof(unsigned int));
+            }
+            else if (bands[b])
+            {
+                release_pixels(&image[y0*width], n*sizeof(unsigned int));
+                release_pixels(&image_backup[y0*width], n*sizeof(unsigned int));
+            }
+            bands[b] = shared_bands[b];
+        }
+    }
+
+    // Frees the shared image.  Until it is saved again, it is blank.
+    void release_shared_image()
+    {
+        free_pixels(image_shared, width*height);
+        image_shared = NULL;
+        shared_bands.assign(shared_bands.size(), 0);
+    }
+
+    //---------------------------------------------------------------------------------------------
+    // Sparse storage
+    // 
+    // A very large canvas would need hundreds of megabytes for its pixel buffers before anything is painted.  A 
+    // sparse canvas maps its buffers from the operating system without touching them, so that no memory is used 
+    // for a page until something is written to it.  Untouched memory reads as zero, which is right for alpha and
+    // pending, but the image, backup and shared image start out white.  So these are divided into bands of 
+    // BAND_HEIGHT full rows, and a band is only filled with white and treated as holding real pixels once it is 
+    // drawn on.  Until then, reading a row of it gives the shared blank row instead.
+    //
+    // Bands rather than square tiles keep the buffers in the same flat layout as for a normal canvas, so the 
+    // drawing code indexes them the same way either way.  The only difference is that draw_brush and 
+    // command_enddraw make sure the rows they touch exist, and that code reading whole rows of the image goes 
+    // through get_image_row.  Resident memory then follows the painted rows rather than the canvas size.  
+    // Clearing the image gives the memory back.
+
+    template <typename T> T* alloc_pixels(int n)
+    {
+        if (!sparse)
+            return new T[n];
+        void* p = mmap(NULL, n*sizeof(T), PROT_READ|PROT_WRITE, MAP_PRIVATE|MAP_ANONYMOUS|MAP_NORESERVE, -1, 0);
+        if (p == MAP_FAILED)
+            throw bad_alloc();
+        return (T*)p;
+    }
+
+    template <typename T> void free_pixels(T* p, int n)
+    {
+        if (!sparse)
+            delete[] p;
+        else if (p)
+            munmap(p, n*sizeof(T));
+    }
+
+    // Gives the memory of the whole pages in a part of a sparse buffer back to the system.  They read as zero 
+    // afterwards.
+    static void release_pixels(void* p, size_t size)
+    {
+        size_t page = sysconf(_SC_PAGESIZE);
+        size_t p0 = ((size_t)p + page-1) & ~(page-1);
+        size_t p1 = ((size_t)p + size) & ~(page-1);
+        if (p0 < p1)
+            madvise((void*)p0, p1-p0, MADV_DONTNEED);
+    }
+
+    void create_bands()
+    {
+        int nbands = (height + BAND_HEIGHT-1) / BAND_HEIGHT;
+        bands.assign(nbands, sparse ? 0 : 1);
+        shared_bands.assign(nbands, (sparse || !image_shared) ? 0 : 1);
+        delete[] blank_row;
+        blank_row = new unsigned int[width];
+        memset(blank_row, 0xff, width*sizeof(unsigned int));
+    }
+
+    // Makes sure that rows y0 up to y1 of the image and backup hold real pixels.
+    inline void touch_rows(int y0, int y1)
+    {
+        if (!sparse || y0 >= y1)
+            return;
+        for (int b = max(y0, 0) / BAND_HEIGHT; b <= (min(y1, height)-1) / BAND_HEIGHT; b++)
+        {
+            if (!bands[b])
+            {
+                int r0 = b*BAND_HEIGHT;
+                int n = (min(r0+BAND_HEIGHT, height)-r0)*width;
+                memset(&image[r0*width], 0xff, n*sizeof(unsigned int));
+                memset(&image_backup[r0*width], 0xff, n*sizeof(unsigned int));
+                bands[b] = 1;
+            }
+        }
+    }
+
+    // Return a row of the image, backup or shared image for reading.
+    inline const unsigned int* get_image_row(int y)
+    {
+        return bands[y/BAND_HEIGHT] ? &image[y*width] : blank_row;
+    }
+
+    inline const unsigned int* get_image_backup_row(int y)
+    {
+        return bands[y/BAND_HEIGHT] ? &image_backup[y*width] : blank_row;
+    }
+
+    inline const unsigned int* get_image_shared_row(int y)
+    {
+        return shared_bands[y/BAND_HEIGHT] ? &image_shared[y*width] : blank_row;
+    }
+
+    // Returns the memory used by a pixel buffer.  For a sparse canvas, this is the size of the pages actually in 
+    // memory.
+    int get_pixels_memory(void* p, size_t size)
+    {
+        if (!p)
+            return 0;
+        if (!sparse)
+            return size;
+        size_t page = sysconf(_SC_PAGESIZE);
+        vector<unsigned char> resident((size + page-1) / page);
+        if (mincore(p, size, &resident[0]) != 0)
+            return size;
+        int n = 0;
+        for (int i = 0; i < (int)resident.size(); i++)
+            n += resident[i] & 1;
+        return min(n*page, size);
+    }
+
+    // Returns the memory used by each of the canvas buffers.
+    CanvasMemory get_memory()
+    {
+        CanvasMemory m;
+        m.image = get_pixels_memory(image, width*height*sizeof(unsigned int));
+        m.image_backup = get_pixels_memory(image_backup, width*height*sizeof(unsigned int));
+        m.alpha = get_pixels_memory(alpha, width*height*sizeof(unsigned char));
+        m.pending = get_pixels_memory(pending, width*height*sizeof(unsigned char));
+        m.image_shared = get_pixels_memory(image_shared, width*height*sizeof(unsigned int));
+        m.image_reference = image_reference ? REFERENCE_WIDTH*REFERENCE_HEIGHT*sizeof(unsigned short) : 0;
+        m.image_video = ((image_video[0] ? 1 : 0) + (image_video[1] ? 1 : 0)) * VIDEO_WIDTH*VIDEO_HEIGHT*sizeof(unsigned int);
+        m.stamp_cache = stamp_cache_bytes;
+        m.commands = commands.capacity()*sizeof(DrawCommand) + stroke_index.capacity()*sizeof(StrokeInfo);
+        m.total = m.image + m.image_backup + m.alpha + m.pending + m.image_shared + m.image_reference + 
+            m.image_video + m.stamp_cache + m.commands;
+        return m;
+    }
+
+    // Returns the number of bands which hold real pixels, out of the total number of bands.
+    int get_num_painted_bands()
+    {
+        return count(bands.begin(), bands.end(), 1);
+    }
+
+    int get_num_bands()
+    {
+        return bands.size();
+    }
+
+    // Returns the CRC-32 of the image pixels row by row, the same as zlib.crc32 of the whole image, with the unpainted
+    // rows of a sparse canvas counted as the white they stand for.  Used to check that playback still gives the same
+    // pixels, see golden.py.
+    unsigned int get_image_crc32()
+    {
+        resolve_pending();
+        uLong crc = crc32(0L, Z_NULL, 0);
+        for (int y = 0; y < height; y++)
+            crc = crc32(crc, (const Bytef*)get_image_row(y), width*sizeof(unsigned int));
+        return crc;
+    }
+
+    // Returns the pixels which replaying the commands up to the playback position leaves, for restoring them later
+    // with finish_playback_from_pixels rather than replaying again: the image, then the backup XORed with the image,
+    // then the alpha channel.  Between strokes the backup and image mostly agree and the alpha is mostly zero, so
+    // all but the image compress to very little.
+    ByteBuffer get_playback_pixels()
+    {
+        resolve_pending();
+        int n = width*height;
+        playback_pixels.resize(get_playback_pixels_size());
+        unsigned int* p = (unsigned int*)&playback_pixels[0];
+        for (int y = 0; y < height; y++)
+        {
+            const unsigned int* __restrict src = get_image_row(y);
+            const unsigned int* __restrict backup = get_image_backup_row(y);
+            for (int x = 0; x < width; x++)
+            {
+                p[y*width+x] = src[x];
+                p[n+y*width+x] = src[x] ^ backup[x];
+            }
+        }
+        memcpy(&p[2*n], alpha, n*sizeof(unsigned char));
+
+        ByteBuffer buf;
+        buf.size = playback_pixels.size();
+        buf.data = &playback_pixels[0];
+        return buf;
+    }
+
+    //---------------------------------------------------------------------------------------------
+    // Profiling
+    // 
+    // While profiling is set, the hot paths count their calls, the pixels they touch and the time they take, see
+    // ProfileCounter.  Python gets them all at once from Canvas.get_profile, see colorsclib.i.
+
+    void reset_profile()
+    {
+        memset(profile, 0, sizeof(profile));
+    }
+
+    ProfileCounter get_profile_counter(int i)
+    {
+        return profile[i];
+    }
+
+    static const char* get_profile_name(int i)
+    {
+        return ProfileCounter::names[i];
     }
 
     //---------------------------------------------------------------------------------------------
@@ -587,14 +1181,88 @@ public:
     // The net effect this is that during a stroke, which may overlap itself many times over, the brush color
     // will only be applied to any particular canvas pixel up to the defined brush transparency level.  
     // This is the core of our "natural media" engine.
+    //
+    // With deferred_composite set, brush stamps only accumulate into the alpha channel and flag the pixels they 
+    // cover as pending.  The blend into the real image is done once per pixel by resolve_pending, which runs before 
+    // anything looks at the image: blits, color pickup, the end of the stroke, saving the shared image, and changes 
+    // of brush color.  Overlapping stamps therefore cost one blend per pixel instead of one per stamp, and the image
+    // ends up exactly the same as when blending every stamp immediately.
+
+    // Blends all pending pixels into the image.
+    void resolve_pending()
+    {
+        for (int y = pending_y0; y < pending_y1; y++)
+        {
+            unsigned char* __restrict p = &pending[y*width];
+            for (int x = pending_x0; x < pending_x1; x++)
+            {
+                if (p[x])
+                {
+                    Color i = Color::create_from_a8r8g8b8(image_backup[y*width+x]);
+                    i = Color::create_from_lerp(pending_color, i, alpha[y*width+x]);
+                    image[y*width+x] = i.get_a8r8g8b8();
+                    p[x] = 0;
+                }
+            }
+        }
+        pending_x0 = pending_y0 = pending_x1 = pending_y1 = 0;
+    }
+
+    // Forgets the pending pixels without blending them, for when the image is about to be replaced.
+    void discard_pending()
+    {
+        for (int y = pending_y0; y < pending_y1; y++)
+            memset(&pending[y*width+pending_x0], 0, (pending_x1-pending_x0)*sizeof(unsigned char));
+        pending_x0 = pending_y0 = pending_x1 = pending_y1 = 0;
+    }
+
+    // Applies one brush stamp pixel with the given intensity to the alpha channel, and blends it into the image
+    // unless compositing is deferred.
+    inline void stamp_pixel(int ofs, int intensity, int opacity)
+    {
+        // New Alpha = Brush Intensity + Old Alpha - (Brush Intensity * Old Alpha)
+        // Also make sure the result is clamped to the incoming opacity and isn't lower than the alpha 
+        // already stored
+        int base = alpha[ofs];
+        int a = max(min(intensity + base - ((intensity * base) >> 8), opacity), base);
+        alpha[ofs] = a;
+
+        if (deferred_composite)
+            pending[ofs] = 1;
+        else
+        {
+            Color i = Color::create_from_a8r8g8b8(image_backup[ofs]);
+            i = Color::create_from_lerp(brush.color, i, a);
+            image[ofs] = i.get_a8r8g8b8();
+        }
+    }
 
     void clear_image()
     {
+        if (sparse)
+        {
+            release_pixels(image, width*height*sizeof(unsigned int));
+            release_pixels(image_backup, width*height*sizeof(unsigned int));
+            release_pixels(alpha, width*height*sizeof(unsigned char));
+            release_pixels(pending, width*height*sizeof(unsigned char));
+            if (image_shared)
+                release_pixels(image_shared, width*height*sizeof(unsigned int));
+            bands.assign(bands.size(), 0);
+            shared_bands.assign(shared_bands.size(), 0);
+            pending_x0 = pending_y0 = pending_x1 = pending_y1 = 0;
+            dirtymin = Pos(0, 0);
+            dirtymax = Pos(width, height);
+            return;
+        }
+
         memset(image, 0xff, width*height*sizeof(unsigned int));
         memset(image_backup, 0xff, width*height*sizeof(unsigned int));
         memset(alpha, 0, width*height*sizeof(unsigned char));
+        memset(pending, 0, width*height*sizeof(unsigned char));
+        pending_x0 = pending_y0 = pending_x1 = pending_y1 = 0;
 
-        memset(image_shared, 0xff, width*height*sizeof(unsigned int));
+        if (image_shared)
+            memset(image_shared, 0xff, width*height*sizeof(unsigned int));
 
         dirtymin = Pos(0, 0);
         dirtymax = Pos(width, height);
@@ -617,6 +1285,8 @@ public:
     // Called each tick while stylus is touching the screen and draws the selected brush into the Alpha of the Canvas.
     void command_draw(const Pos& pos, int pressure, bool forced)
     {
+        PROFILE_SCOPE(COMMAND_DRAW);
+
         lastorgpos = pos;
 
         if (brush.control == 0)
@@ -739,11 +1409,17 @@ public:
         if (!stroke)
             return;
 
+        PROFILE_SCOPE(COMMAND_ENDDRAW);
+
+        resolve_pending();
+
         // Copy current image to backup image and clear alpha in the region of the stroke.
         int x0 = max(min(int(strokemin.x), width), 0);
         int x1 = max(min(int(strokemax.x), width), 0);
         int y0 = max(min(int(strokemin.y), height), 0);
         int y1 = max(min(int(strokemax.y), height), 0);
+        PROFILE_PIXELS(COMMAND_ENDDRAW, (x1-x0)*(y1-y0));
+        touch_rows(y0, y1);
         for (int y = y0; y < y1; y++)
         {
             memcpy(&image_backup[y*width+x0], &image[y*width+x0], (x1-x0)*sizeof(unsigned int));
@@ -761,32 +1437,123 @@ public:
         dirtymax = Pos(-FLT_MAX,-FLT_MAX);
     }
 
-    // Rasters a brush with specified width and opacity into alpha at a specified position using lookup-tables.
-    void draw_brush(const Pos& pos, int brushwidth, int opacity)
+    // Returns the cached stamp mask for the current brush type and the given width, creating it if necessary.  
+    // The mask holds exactly what draw_brush looks up for an unclipped stamp whose table coordinates start at 0, 0.
+    const BrushStamp& get_stamp(int brushwidth)
     {
-        //printf("draw_brush %f,%f width=%d opacity=%d\n", pos.x, pos.y, brushwidth, opacity);
+        StampKey key(brush.type, brushwidth);
+        map<StampKey, StampList::iterator>::iterator i = stamp_map.find(key);
+        if (i != stamp_map.end())
+        {
+            stamp_hits++;
+            stamp_list.splice(stamp_list.begin(), stamp_list, i->second);
+            return stamp_list.front().second;
+        }
 
-        // Enforce minimum brush size.
-        if (brushwidth<2) brushwidth = 2;
+        stamp_misses++;
 
-        // Calculate drawing rectangle.
-        float halfwidth = brushwidth/2;
-        float p0x = pos.x - halfwidth;
-        float p0y = pos.y - halfwidth;
-        float p1x = pos.x + halfwidth + 1;
-        float p1y = pos.y + halfwidth + 1;
+        int size = (brushwidth/2)*2+1;
 
-        int x0 = int(max(min(p0x, p1x), 0.0f));
-        int x1 = int(min(max(p0x, p1x), float(width)));
-        int y0 = int(max(min(p0y, p1y), 0.0f));
-        int y1 = int(min(max(p0y, p1y), float(height)));
+        // Evict least recently used stamps to make room, but always keep at least the new one.
+        while (!stamp_list.empty() && stamp_cache_bytes + size*size > STAMP_CACHE_BYTES)
+        {
+            stamp_cache_bytes -= stamp_list.back().second.size*stamp_list.back().second.size;
+            stamp_map.erase(stamp_list.back().first);
+            stamp_list.pop_back();
+        }
 
-        // Accumulate dirty regions.
+        stamp_list.push_front(make_pair(key, BrushStamp()));
+        stamp_map[key] = stamp_list.begin();
+        stamp_cache_bytes += size*size;
+
+        BrushStamp& stamp = stamp_list.front().second;
+        stamp.size = size;
+        stamp.mask.resize(size*size);
+
+        // Same interpolation as draw_brush.
+        float db = (BrushType::DIST_TABLE_WIDTH-1) / float(brushwidth);
+        int brushidx = int(float(BrushType::BRUSH_TABLE_HEIGHT) / brushwidth);
+
+        unsigned char* m = &stamp.mask[0];
+        float yb = 0;
+        for (int y = 0; y < size; y++)
+        {
+            float x2b = 0;
+            for (int x = 0; x < size; x++)
+            {
+                int lookup = BrushType::distance_tbl[int(x2b)][int(yb)];
+                *m++ = Brush::brush_type[brush.type].intensity_tbl[lookup][brushidx];
+                x2b += db;
+            }
+            yb += db;
+        }
+
+        return stamp;
+    }
+
+    void clear_stamp_cache()
+    {
+        stamp_list.clear();
+        stamp_map.clear();
+        stamp_cache_bytes = 0;
+        stamp_hits = stamp_misses = 0;
+    }
+
+    // Rasters a brush with specified width and opacity into alpha at a specified position using lookup-tables.
+    void draw_brush(const Pos& pos, int brushwidth, int opacity)
+    {
+        //printf("draw_brush %f,%f width=%d opacity=%d\n", pos.x, pos.y, brushwidth, opacity);
+        PROFILE_SCOPE(DRAW_BRUSH);
+
+        // Enforce minimum brush size.
+        if (brushwidth<2) brushwidth = 2;
+
+        // Calculate drawing rectangle.
+        float halfwidth = brushwidth/2;
+        float p0x = pos.x - halfwidth;
+        float p0y = pos.y - halfwidth;
+        float p1x = pos.x + halfwidth + 1;
+        float p1y = pos.y + halfwidth + 1;
+
+        int x0 = int(max(min(p0x, p1x), 0.0f));
+        int x1 = int(min(max(p0x, p1x), float(width)));
+        int y0 = int(max(min(p0y, p1y), 0.0f));
+        int y1 = int(min(max(p0y, p1y), float(height)));
+        PROFILE_PIXELS(DRAW_BRUSH, max(x1-x0, 0)*max(y1-y0, 0));
+
+        // Accumulate dirty regions.
         strokemin = Pos::create_from_min(strokemin, Pos(x0, y0));
         strokemax = Pos::create_from_max(strokemax, Pos(x1, y1));
         dirtymin = Pos::create_from_min(dirtymin, Pos(x0, y0));
         dirtymax = Pos::create_from_max(dirtymax, Pos(x1, y1));
 
+        if (x0 < x1)
+            touch_rows(y0, y1);
+
+        if (drawtype == DRAWBRUSH_TYPE_NORMAL && deferred_composite && x0 < x1 && y0 < y1)
+        {
+            // Pending pixels have to be blended with the color they were drawn with.
+            if (pending_x0 < pending_x1 && pending_color.get_a8r8g8b8() != brush.color.get_a8r8g8b8())
+                resolve_pending();
+            if (pending_x0 < pending_x1)
+            {
+                pending_x0 = min(pending_x0, x0);
+                pending_y0 = min(pending_y0, y0);
+                pending_x1 = max(pending_x1, x1);
+                pending_y1 = max(pending_y1, y1);
+            }
+            else
+            {
+                pending_x0 = x0;
+                pending_y0 = y0;
+                pending_x1 = x1;
+                pending_y1 = y1;
+            }
+            pending_color = brush.color;
+        }
+        else if (drawtype == DRAWBRUSH_TYPE_GETCOLOR)
+            resolve_pending();
+
         // Calculate interpolation constants
         float db = (BrushType::DIST_TABLE_WIDTH-1) / float(brushwidth);
 
@@ -796,6 +1563,22 @@ public:
         // Select which line of the brush-lookup-table to use that most closely matches the current brush width
         int brushidx = int(float(BrushType::BRUSH_TABLE_HEIGHT) / brushwidth);
 
+        // The table coordinates are clamped to 0, so most unclipped stamps of a given width start at 0, 0 and look up 
+        // exactly the same intensities.  Those come from the stamp cache instead, which gives identical results.
+        // Stamps clipped on the top or left, or which start elsewhere in the table, use the general path below.
+        if (drawtype == DRAWBRUSH_TYPE_NORMAL && stamp_cache_enabled && xb == 0 && yb == 0 && 
+            p0x >= 0 && p0y >= 0 && x1-x0 <= (brushwidth/2)*2+1 && y1-y0 <= (brushwidth/2)*2+1)
+        {
+            const BrushStamp& stamp = get_stamp(brushwidth);
+            for (int y = y0; y < y1; y++)
+            {
+                const unsigned char* m = &stamp.mask[(y-y0)*stamp.size];
+                for (int x = x0; x < x1; x++)
+                    stamp_pixel(y*width+x, fixed_scale(*m++, opacity), opacity);
+            }
+            return;
+        }
+
         // Interpolate the distance table over the area. For each pixel find the distance, and look the 
         // brush-intensity up in the brush-table
         if (drawtype == DRAWBRUSH_TYPE_NORMAL)
@@ -808,17 +1591,7 @@ public:
                     // Find brush-intensity and mulitply that with incoming opacity
                     int lookup = BrushType::distance_tbl[int(x2b)][int(yb)];
                     int intensity = fixed_scale(Brush::brush_type[brush.type].intensity_tbl[lookup][brushidx], opacity);
-
-                    // New Alpha = Brush Intensity + Old Alpha - (Brush Intensity * Old Alpha)
-                    // Also make sure the result is clamped to the incoming opacity and isn't lower than the alpha 
-                    // already stored
-                    int base = alpha[y*width+x];
-                    int a = max(min(intensity + base - ((intensity * base) >> 8), opacity), base);
-                    alpha[y*width+x] = a;
-
-                    Color i = Color::create_from_a8r8g8b8(image_backup[y*width+x]);
-                    i = Color::create_from_lerp(brush.color, i, a);
-                    image[y*width+x] = i.get_a8r8g8b8();
+                    stamp_pixel(y*width+x, intensity, opacity);
 
                     x2b += db;
                 }
@@ -854,8 +1627,11 @@ public:
     // Return the color underneath the pos.
     Color pickup_color(const Pos& pos)
     {
-        int x = int(max(min(pos.x, float(width)), 0.0f));
-        int y = int(max(min(pos.y, float(height)), 0.0f));
+        resolve_pending();
+        int x = int(max(min(pos.x, float(width-1)), 0.0f));
+        int y = int(max(min(pos.y, float(height-1)), 0.0f));
+        if (!bands[y/BAND_HEIGHT])
+            return Color::create_from_a8r8g8b8(blank_row[x]);
         return Color::create_from_a8r8g8b8(image[y*width+x]);
     }
 
@@ -868,11 +1644,14 @@ public:
     void add_command(const DrawCommand& cmd)
     {
         commands.push_back(cmd);
+        index_strokes();
         modified = true;
     }
 
     void play_command(const DrawCommand& cmd, bool add)
     {
+        PROFILE_SCOPE(PLAY_COMMAND);
+
         if (cmd.type == DrawCommand::TYPE_DRAW)
         {
 #ifdef CANVAS_DEBUG_COMMANDS
@@ -968,8 +1747,58 @@ public:
 
     void finish_playback()
     {
-        while (!playback_done())
-            play_command(commands[playback++], false);
+        playback_to_parallel(commands.size());
+    }
+
+    // Same as finish_playback, except that the pixels are restored from get_playback_pixels at the end of the 
+    // commands, e.g. from a render cache, rather than drawn.  The commands must not end in the middle of a stroke.
+    bool finish_playback_from_pixels(const char* pixels, int size)
+    {
+        if (size != get_playback_pixels_size())
+        {
+            printf("Invalid playback pixels size %d for %dx%d canvas\n", size, width, height);
+            return false;
+        }
+        set_playback_pixels((const unsigned int*)pixels, commands.size());
+        return true;
+    }
+
+    int get_playback_pixels_size()
+    {
+        return width*height*(2*sizeof(unsigned int) + sizeof(unsigned char));
+    }
+
+    // Replaces the pixels with those from get_playback_pixels at pos, which must be at the end of a stroke, and moves
+    // playback there.  Only the brush changes up to pos are played, which leaves the brush as replaying the commands
+    // would.
+    void set_playback_pixels(const unsigned int* p, int pos)
+    {
+        // The brush changes are played from the start when going back, or from the middle of a stroke.  The stroke
+        // is dropped rather than ended, as its pixels are about to be replaced.
+        if (playback > pos || stroke)
+        {
+            stroke = false;
+            playback = 0;
+        }
+
+        int n = width*height;
+        discard_pending();
+        touch_rows(0, height);
+        for (int i = 0; i < n; i++)
+        {
+            image[i] = p[i];
+            image_backup[i] = p[i] ^ p[n+i];
+        }
+        memcpy(alpha, &p[2*n], n*sizeof(unsigned char));
+        dirtymin = Pos(0, 0);
+        dirtymax = Pos(width, height);
+
+        for (; playback < pos && !playback_done(); playback++)
+        {
+            const DrawCommand& cmd = commands[playback];
+            if (cmd.type != DrawCommand::TYPE_DRAW && cmd.type != DrawCommand::TYPE_DRAWEND)
+                play_command(cmd, false);
+        }
     }
 
     // This is used to avoid leaving the playback state in the middle of a stroke.
@@ -1010,7 +1839,9 @@ public:
 
     void truncate_at_playback()
     {
+        int n = commands.size();
         commands.resize(playback+1);
+        reindex_strokes(min(n, playback+1));
     }
 
     void update_playback()
@@ -1036,6 +1867,683 @@ public:
             play_command(commands[i], false);
     }
 
+    //---------------------------------------------------------------------------------------------
+    // Stroke index
+    // 
+    // A stroke starts with the first draw command after the end of the previous one, and ends with the next end draw
+    // command, just like in command_draw and command_enddraw.
+
+    // Indexes the commands which have been added since the last call.
+    void index_strokes()
+    {
+        for (int i = indexed_commands; i < (int)commands.size(); i++)
+        {
+            const DrawCommand& cmd = commands[i];
+            StrokeInfo* s = (!stroke_index.empty() && stroke_index.back().end < 0) ? &stroke_index.back() : NULL;
+            float size = index_size_command >= 0 ? commands[index_size_command].size : 1.0f/16.0f;
+            if (cmd.type == DrawCommand::TYPE_DRAW)
+            {
+                if (!s)
+                {
+                    StrokeInfo n;
+                    n.begin = i;
+                    n.end = -1;
+                    n.min = n.max = cmd.pos;
+                    n.color_command = index_color_command;
+                    n.size_command = index_size_command;
+                    n.size = size;
+                    n.max_pressure = cmd.pressure;
+                    n.cost = size*size;
+                    n.total_cost = (stroke_index.empty() ? 0 : stroke_index.back().total_cost) + n.cost;
+                    stroke_index.push_back(n);
+                }
+                else
+                {
+                    Pos d = cmd.pos - index_lastpos;
+                    float c = sqrtf(d.x*d.x + d.y*d.y) * size;
+                    s->min = Pos::create_from_min(s->min, cmd.pos);
+                    s->max = Pos::create_from_max(s->max, cmd.pos);
+                    s->max_pressure = max(s->max_pressure, cmd.pressure);
+                    s->cost += c;
+                    s->total_cost += c;
+                }
+                index_lastpos = cmd.pos;
+            }
+            else if (cmd.type == DrawCommand::TYPE_DRAWEND)
+            {
+                if (s)
+                    s->end = i+1;
+            }
+            else if (cmd.type == DrawCommand::TYPE_COLORCHANGE)
+            {
+                if (!cmd.flipx && !cmd.flipy)
+                    index_color_command = i;
+            }
+            else if (cmd.type == DrawCommand::TYPE_SIZECHANGE)
+            {
+                index_size_command = i;
+                if (s)
+                    s->size = max(s->size, cmd.size);
+            }
+        }
+        indexed_commands = commands.size();
+    }
+
+    // Brings the index up to date after the commands from pos onwards have been replaced or removed.  The last 
+    // stroke beginning before pos is indexed again too, because the brush changes after it have to be found again.
+    void reindex_strokes(int pos)
+    {
+        // The snapshots after pos are of commands which are gone.
+        while (!snapshots.empty() && snapshots.back().pos > pos)
+            snapshots.pop_back();
+
+        while (!stroke_index.empty() && (stroke_index.back().end < 0 || stroke_index.back().end > pos))
+            stroke_index.pop_back();
+
+        if (stroke_index.empty())
+        {
+            indexed_commands = 0;
+            index_color_command = -1;
+            index_size_command = -1;
+        }
+        else
+        {
+            indexed_commands = stroke_index.back().begin;
+            index_color_command = stroke_index.back().color_command;
+            index_size_command = stroke_index.back().size_command;
+            stroke_index.pop_back();
+        }
+
+        indexed_commands = min(indexed_commands, (int)commands.size());
+        index_strokes();
+    }
+
+    int get_num_strokes()
+    {
+        return stroke_index.size();
+    }
+
+    StrokeInfo get_stroke(int i)
+    {
+        return stroke_index[i];
+    }
+
+    // Returns the index of the last stroke beginning at or before command pos, or -1.
+    int find_stroke(int pos)
+    {
+        int lo = 0, hi = stroke_index.size();
+        while (lo < hi)
+        {
+            int mid = (lo + hi) / 2;
+            if (stroke_index[mid].begin <= pos)
+                lo = mid + 1;
+            else
+                hi = mid;
+        }
+        return lo - 1;
+    }
+
+    // Returns the playback position where playback_finish_stroke would stop when starting from pos.
+    int get_stroke_boundary(int pos)
+    {
+        int i = find_stroke(pos);
+        if (i < 0 || stroke_index[i].begin == pos)
+            return pos;
+        int end = stroke_index[i].end < 0 ? commands.size() : stroke_index[i].end;
+        return max(end, pos);
+    }
+
+    // Returns the end of the first stroke ending after pos, or the number of commands if there is none.
+    int get_next_stroke_end(int pos)
+    {
+        int i = find_stroke(pos);
+        if (i >= 0 && stroke_index[i].end > pos)
+            return stroke_index[i].end;
+        if (i+1 < (int)stroke_index.size() && stroke_index[i+1].end >= 0)
+            return stroke_index[i+1].end;
+        return commands.size();
+    }
+
+    // Returns the end of the last stroke ending before pos, or 0 if there is none.
+    int get_prev_stroke_end(int pos)
+    {
+        int i = find_stroke(pos-1);
+        while (i >= 0 && (stroke_index[i].end < 0 || stroke_index[i].end >= pos))
+            i--;
+        return i >= 0 ? stroke_index[i].end : 0;
+    }
+
+    // Returns the estimated cost of replaying the commands up to pos.
+    float get_replay_cost(int pos)
+    {
+        int i = find_stroke(pos-1);
+        if (i < 0)
+            return 0;
+        const StrokeInfo& s = stroke_index[i];
+        if (s.end >= 0 && s.end <= pos)
+            return s.total_cost;
+        // Count a stroke in progress in proportion to how far it has got.
+        int end = s.end < 0 ? commands.size() : s.end;
+        return s.total_cost - s.cost * (end - pos) / (end - s.begin);
+    }
+
+    // Returns the number of threads playback_to_parallel will use.
+    int get_playback_threads()
+    {
+        int n = playback_threads;
+        if (n <= 0)
+            n = sysconf(_SC_NPROCESSORS_ONLN);
+        return max(min(n, MAX_PLAYBACK_THREADS), 1);
+    }
+
+    // Same as playback_to, except that strokes which don't overlap are replayed in parallel.
+    //
+    // Each stroke only touches the pixels around the path of its brush, and strokes that touch disjoint pixels give
+    // the same result whichever order they are drawn in.  So the commands are scanned once to find the brush state
+    // at the start of each stroke and a conservative bounding box for it, every stroke is made to wait for the 
+    // earlier strokes its box overlaps, and the strokes are then drawn as soon as they are free on a pool of 
+    // threads.  Each thread draws through its own view of the canvas, which has its own brush and stroke state but
+    // shares the pixels.  The result is exactly the same as replaying the commands one by one.
+    //
+    // A stroke that is in progress at the start is finished first, and a stroke that is still unfinished at the 
+    // end is replayed sequentially afterwards.
+    void playback_to_parallel(int pos)
+    {
+        pos = min(pos, (int)commands.size());
+
+        while (stroke && playback < pos && !playback_done())
+            play_command(commands[playback++], false);
+
+        int nthreads = get_playback_threads();
+        if (nthreads > 1 && drawtype == DRAWBRUSH_TYPE_NORMAL && !playback_done() && playback < pos)
+        {
+            resolve_pending();
+
+            // Scan the commands, applying the brush changes as they come.  Only the strokes which end before pos
+            // are collected, the brush is left as it is at the end of the last of them.
+            PlaybackSchedule schedule;
+            vector<PlaybackStroke>& strokes = schedule.strokes;
+            Brush start_brush = brush;
+            Brush end_brush = brush;
+            int end = playback;
+            int begin = -1;
+            float minx = 0, miny = 0, maxx = 0, maxy = 0;
+            int maxpressure = 0, maxsize = 0;
+            for (int i = playback; i < pos; i++)
+            {
+                const DrawCommand& cmd = commands[i];
+                if (cmd.type == DrawCommand::TYPE_DRAW)
+                {
+                    Pos p = cmd.pos * Pos(width, height);
+                    if (begin < 0)
+                    {
+                        begin = i;
+                        strokes.push_back(PlaybackStroke());
+                        strokes.back().begin = i;
+                        strokes.back().brush = brush;
+                        minx = maxx = p.x;
+                        miny = maxy = p.y;
+                        maxpressure = 255;
+                        maxsize = brush.size;
+                    }
+                    minx = min(minx, p.x);
+                    miny = min(miny, p.y);
+                    maxx = max(maxx, p.x);
+                    maxy = max(maxy, p.y);
+                    maxpressure = max(maxpressure, cmd.pressure);
+                }
+                else if (cmd.type == DrawCommand::TYPE_DRAWEND)
+                {
+                    if (begin < 0)
+                        continue;
+
+                    // Every brush stamp lies on the path between the positions of the stroke, and is at most as 
+                    // large as the largest brush at the highest pressure.  The margin covers rounding.
+                    int halfwidth = max(maxsize * maxpressure / 255 + 1, 2) / 2;
+                    PlaybackStroke& s = strokes.back();
+                    s.end = i+1;
+                    s.x0 = max(int(floorf(minx)) - halfwidth - 2, 0);
+                    s.y0 = max(int(floorf(miny)) - halfwidth - 2, 0);
+                    s.x1 = min(int(ceilf(maxx)) + halfwidth + 2, width);
+                    s.y1 = min(int(ceilf(maxy)) + halfwidth + 2, height);
+
+                    begin = -1;
+                    end = i+1;
+                    end_brush = brush;
+                }
+                else
+                {
+                    play_command(cmd, false);
+                    maxsize = max(maxsize, brush.size);
+                }
+            }
+            if (begin >= 0)
+                strokes.pop_back();
+            brush = end_brush;
+
+            if (strokes.size() >= 2)
+            {
+                // Filling in a band on one thread could overwrite a stroke being drawn on another thread.
+                for (int i = 0; i < (int)strokes.size(); i++)
+                    if (strokes[i].x0 < strokes[i].x1)
+                        touch_rows(strokes[i].y0, strokes[i].y1);
+
+                schedule_strokes(strokes);
+                play_strokes(schedule, nthreads);
+                
+                // Continue from where the last stroke left off.
+                const PlaybackStroke& last = strokes.back();
+                lastpos = last.lastpos;
+                lastorgpos = last.lastorgpos;
+                lastpressure = last.lastpressure;
+                strokemin = last.strokemin;
+                strokemax = last.strokemax;
+                idle_while_drawing = last.idle_while_drawing;
+            }
+            else
+            {
+                // Not worth the threads, so go back and replay sequentially.
+                brush = start_brush;
+                end = playback;
+            }
+            playback = end;
+        }
+
+        while (playback < pos && !playback_done())
+            play_command(commands[playback++], false);
+    }
+
+private:
+    // One stroke to replay in playback_to_parallel.
+    struct PlaybackStroke
+    {
+        int begin, end;                 // Commands of the stroke, from the first draw to just after the end of it.
+        Brush brush;                    // Brush at the start of the stroke.
+        int x0, y0, x1, y1;             // Conservative bounds of the pixels the stroke touches.
+        int waiting;                    // Number of earlier overlapping strokes which haven't been drawn yet.
+        vector<int> successors;         // Later strokes waiting for this one.
+
+        // Stroke state after the stroke, for the canvas to continue from.
+        Pos lastpos, lastorgpos;
+        float lastpressure;
+        Pos strokemin, strokemax;
+        int idle_while_drawing;
+
+        PlaybackStroke() : begin(0), end(0), x0(0), y0(0), x1(0), y1(0), waiting(0) {}
+    };
+
+    // Work shared between the playback threads.
+    struct PlaybackSchedule
+    {
+        Canvas* canvas;
+        vector<PlaybackStroke> strokes;
+        priority_queue<int, vector<int>, greater<int> > ready;  // Strokes free to draw, earliest first.
+        int remaining;
+        pthread_mutex_t lock;
+        pthread_cond_t cond;
+    };
+
+    struct PlaybackWorker
+    {
+        PlaybackSchedule* schedule;
+        Canvas* view;
+        pthread_t thread;
+    };
+
+    // Size of the grid cells used to find overlapping strokes.
+    static const int PLAYBACK_CELL_SIZE = 32;
+
+    // Creates a view of another canvas for replaying strokes on a playback thread.
+    Canvas(Canvas* parent) : width(parent->width), height(parent->height)
+    {
+        indexed_commands = 0;
+        index_color_command = index_size_command = -1;
+
+        image = parent->image;
+        image_backup = parent->image_backup;
+        alpha = parent->alpha;
+        pending = parent->pending;
+        pending_x0 = pending_y0 = pending_x1 = pending_y1 = 0;
+        deferred_composite = parent->deferred_composite;
+
+        image_shared = NULL;
+        blank_row = NULL;
+        // The rows of every stroke have been made to exist up front, so the view never has to.
+        sparse = false;
+        image_reference = NULL;
+        image_video[0] = image_video[1] = NULL;
+        video_idx = 0;
+
+        lastpos = Pos(0,0);
+        lastorgpos = Pos(0,0);
+        lastpressure = 0;
+
+        dirtymin = Pos(FLT_MAX,FLT_MAX);
+        dirtymax = Pos(-FLT_MAX,-FLT_MAX);
+
+        strokemin = Pos(0,0);
+        strokemax = Pos(0,0);
+        stroke = false;
+
+        playing = false;
+        playback = 0;
+        playback_speed = 1;
+        playback_threads = 1;
+        view = true;
+        modified = false;
+
+        idle_while_drawing = 0;
+
+        drawtype = parent->drawtype;
+
+        stamp_cache_enabled = parent->stamp_cache_enabled;
+        stamp_cache_bytes = 0;
+        stamp_hits = stamp_misses = 0;
+
+        profiling = parent->profiling;
+        reset_profile();
+    }
+
+    // Makes every stroke wait for the latest earlier stroke in each grid cell it overlaps.  Waiting for the latest 
+    // one is enough, because that one waits for the one before it in turn.
+    void schedule_strokes(vector<PlaybackStroke>& strokes)
+    {
+        int cw = (width + PLAYBACK_CELL_SIZE-1) / PLAYBACK_CELL_SIZE;
+        int ch = (height + PLAYBACK_CELL_SIZE-1) / PLAYBACK_CELL_SIZE;
+        vector<int> latest(cw*ch, -1);
+        vector<int> deps;
+        for (int i = 0; i < (int)strokes.size(); i++)
+        {
+            PlaybackStroke& s = strokes[i];
+            if (s.x0 >= s.x1 || s.y0 >= s.y1)
+                continue;
+
+            deps.clear();
+            for (int cy = s.y0 / PLAYBACK_CELL_SIZE; cy <= (s.y1-1) / PLAYBACK_CELL_SIZE; cy++)
+            {
+                for (int cx = s.x0 / PLAYBACK_CELL_SIZE; cx <= (s.x1-1) / PLAYBACK_CELL_SIZE; cx++)
+                {
+                    int& l = latest[cy*cw+cx];
+                    if (l >= 0)
+                        deps.push_back(l);
+                    l = i;
+                }
+            }
+
+            sort(deps.begin(), deps.end());
+            deps.erase(unique(deps.begin(), deps.end()), deps.end());
+            for (int j = 0; j < (int)deps.size(); j++)
+                strokes[deps[j]].successors.push_back(i);
+            s.waiting = deps.size();
+        }
+    }
+
+    // Draws the scheduled strokes on nthreads threads, the calling thread included, and waits for all of them.
+    void play_strokes(PlaybackSchedule& schedule, int nthreads)
+    {
+        schedule.canvas = this;
+        schedule.remaining = schedule.strokes.size();
+        for (int i = 0; i < (int)schedule.strokes.size(); i++)
+            if (schedule.strokes[i].waiting == 0)
+                schedule.ready.push(i);
+        pthread_mutex_init(&schedule.lock, NULL);
+        pthread_cond_init(&schedule.cond, NULL);
+
+        vector<PlaybackWorker> workers(nthreads);
+        for (int i = 0; i < nthreads; i++)
+        {
+            workers[i].schedule = &schedule;
+            workers[i].view = new Canvas(this);
+        }
+
+        // If a thread can't be started, the others just get more to do.
+        vector<bool> started(nthreads, false);
+        for (int i = 1; i < nthreads; i++)
+            started[i] = pthread_create(&workers[i].thread, NULL, playback_worker, &workers[i]) == 0;
+        playback_worker(&workers[0]);
+        for (int i = 1; i < nthreads; i++)
+            if (started[i])
+                pthread_join(workers[i].thread, NULL);
+
+        pthread_cond_destroy(&schedule.cond);
+        pthread_mutex_destroy(&schedule.lock);
+
+        for (int i = 0; i < nthreads; i++)
+        {
+            Canvas* v = workers[i].view;
+            dirtymin = Pos::create_from_min(dirtymin, v->dirtymin);
+            dirtymax = Pos::create_from_max(dirtymax, v->dirtymax);
+            stamp_hits += v->stamp_hits;
+            stamp_misses += v->stamp_misses;
+            for (int c = 0; c < ProfileCounter::NUM_COUNTERS; c++)
+            {
+                profile[c].calls += v->profile[c].calls;
+                profile[c].pixels += v->profile[c].pixels;
+                profile[c].ns += v->profile[c].ns;
+            }
+            delete v;
+        }
+    }
+
+    static void* playback_worker(void* arg)
+    {
+        PlaybackWorker* worker = (PlaybackWorker*)arg;
+        PlaybackSchedule* schedule = worker->schedule;
+        Canvas* v = worker->view;
+
+        pthread_mutex_lock(&schedule->lock);
+        for (;;)
+        {
+            while (schedule->ready.empty() && schedule->remaining > 0)
+                pthread_cond_wait(&schedule->cond, &schedule->lock);
+            if (schedule->ready.empty())
+                break;
+            int i = schedule->ready.top();
+            schedule->ready.pop();
+            pthread_mutex_unlock(&schedule->lock);
+
+            PlaybackStroke& s = schedule->strokes[i];
+            v->brush = s.brush;
+            for (int c = s.begin; c < s.end; c++)
+                v->play_command(schedule->canvas->commands[c], false);
+            s.lastpos = v->lastpos;
+            s.lastorgpos = v->lastorgpos;
+            s.lastpressure = v->lastpressure;
+            s.strokemin = v->strokemin;
+            s.strokemax = v->strokemax;
+            s.idle_while_drawing = v->idle_while_drawing;
+
+            pthread_mutex_lock(&schedule->lock);
+            schedule->remaining--;
+            for (int j = 0; j < (int)s.successors.size(); j++)
+                if (--schedule->strokes[s.successors[j]].waiting == 0)
+                    schedule->ready.push(s.successors[j]);
+            pthread_cond_broadcast(&schedule->cond);
+        }
+        pthread_mutex_unlock(&schedule->lock);
+        return NULL;
+    }
+
+public:
+
+    //---------------------------------------------------------------------------------------------
+    // Snapshots
+    //
+    // Opening a drawing means replaying all of its commands, and so does every step back when scrubbing through it
+    // in playback.  To save most of that, make_next_snapshot takes snapshots of the pixels at some of the stroke ends,
+    // which are saved with the drawing, and restore_snapshot jumps playback to the nearest one to replay on from.
+    // Taking them means replaying the drawing, so they are taken one at a time while the activity is idle rather than
+    // when saving; save writes whichever have been taken by then.
+    //
+    // The snapshots are spaced out by the estimated cost of replaying the strokes between them, see get_replay_cost:
+    // one every SNAPSHOT_COST_STEP, and none for less than SNAPSHOT_MIN_COST, as restoring a snapshot takes about as
+    // long as replaying that much.  A cost of 1 takes about 5ms to replay on a desktop PC.  Each snapshot is a few
+    // hundred KB for a detailed drawing, so if they come to more than snapshot_max_bytes the ones which save the 
+    // least replaying are dropped until they fit, always keeping the last.
+    //
+    // Snapshots are kept as long as the commands before them don't change, so after a drawing has been opened or 
+    // saved with them only what was added since the last of them needs replaying.
+
+    static const float SNAPSHOT_COST_STEP = 4.0f;
+    static const float SNAPSHOT_MIN_COST = 2.0f;
+
+    int get_num_snapshots()
+    {
+        return snapshots.size();
+    }
+
+    int get_snapshot_pos(int i)
+    {
+        return snapshots[i].pos;
+    }
+
+    // Returns the size of the snapshots in bytes, as saved.
+    int get_snapshot_bytes()
+    {
+        int size = 0;
+        for (int i = 0; i < (int)snapshots.size(); i++)
+            size += snapshots[i].data.size();
+        return size;
+    }
+
+    // Returns the position of the snapshot make_next_snapshot would take next, or -1 if there is none to take.
+    int get_next_snapshot_pos()
+    {
+        // Snapshots are only taken between strokes, so stop short of an unfinished stroke.
+        int end = commands.size();
+        if (!stroke_index.empty() && stroke_index.back().end < 0)
+            end = stroke_index.back().begin;
+
+        int last = snapshots.empty() ? 0 : snapshots.back().pos;
+        float last_cost = get_replay_cost(last);
+        float end_cost = get_replay_cost(end);
+        if (end_cost - last_cost < SNAPSHOT_MIN_COST)
+            return -1;
+
+        for (int i = find_stroke(last-1) + 1; i < (int)stroke_index.size(); i++)
+        {
+            const StrokeInfo& s = stroke_index[i];
+            if (s.end < 0 || s.end >= end)
+                break;
+            if (s.total_cost >= last_cost + SNAPSHOT_COST_STEP && end_cost - s.total_cost >= SNAPSHOT_MIN_COST)
+                return s.end;
+        }
+        return end;
+    }
+
+    // Takes the next snapshot after the last one, replaying the strokes between them on a separate canvas, then 
+    // drops snapshots until they fit in snapshot_max_bytes.  That is usually no more than SNAPSHOT_COST_STEP plus 
+    // SNAPSHOT_MIN_COST of replaying, so it can be called from an idle handler until it returns false, meaning there 
+    // are no more snapshots to take for now.
+    bool make_next_snapshot()
+    {
+        if (snapshot_max_bytes <= 0)
+        {
+            snapshots.clear();
+            return false;
+        }
+
+        int pos = get_next_snapshot_pos();
+        if (pos < 0)
+            return false;
+
+        // A snapshot which can't be read is no use to start from, so drop it and start from the one before.
+        if (!snapshots.empty() && !unpack_snapshot(snapshots.back()))
+        {
+            snapshots.pop_back();
+            return true;
+        }
+
+        // Replay on a sparse canvas, so as to leave this one as it is.
+        Canvas scratch(width, height, true);
+        scratch.playback_threads = playback_threads;
+        scratch.commands.assign(commands.begin(), commands.begin()+pos);
+        scratch.reindex_strokes(0);
+        scratch.start_playback();
+        if (!snapshots.empty())
+            scratch.set_playback_pixels((const unsigned int*)&playback_pixels[0], snapshots.back().pos);
+        scratch.playback_to_parallel(pos);
+
+        ByteBuffer pixels = scratch.get_playback_pixels();
+        uLongf size = compressBound(pixels.size);
+        snapshots.push_back(CanvasSnapshot());
+        CanvasSnapshot& s = snapshots.back();
+        s.pos = pos;
+        s.data.resize(size);
+        if (compress(&s.data[0], &size, (const Bytef*)pixels.data, pixels.size) != Z_OK)
+        {
+            snapshots.pop_back();
+            return false;
+        }
+        s.data.resize(size);
+
+        trim_snapshots();
+        return !snapshots.empty();
+    }
+
+    // Takes all the snapshots make_next_snapshot would, in one go.
+    void make_snapshots()
+    {
+        while (make_next_snapshot())
+            ;
+    }
+
+    // Drops the snapshots which save the least replaying, until the rest fit in snapshot_max_bytes.  That is the 
+    // one whose neighbours are closest together, as replaying from the earlier of them is what dropping it costs.
+    void trim_snapshots()
+    {
+        int size = get_snapshot_bytes();
+        while (size > snapshot_max_bytes && snapshots.size() > 1)
+        {
+            int best = 0;
+            float best_cost = FLT_MAX;
+            for (int i = 0; i+1 < (int)snapshots.size(); i++)
+            {
+                float cost = get_replay_cost(snapshots[i+1].pos) - (i > 0 ? get_replay_cost(snapshots[i-1].pos) : 0);
+                if (cost < best_cost)
+                {
+                    best = i;
+                    best_cost = cost;
+                }
+            }
+            size -= snapshots[best].data.size();
+            snapshots.erase(snapshots.begin()+best);
+        }
+        if (size > snapshot_max_bytes)
+            snapshots.clear();
+    }
+
+    // Moves playback to the last snapshot at or before pos, restoring its pixels, if playback is before that 
+    // snapshot or past pos.  Returns false, leaving playback as it is, if there is no snapshot to move to.
+    bool restore_snapshot(int pos)
+    {
+        int i = (int)snapshots.size()-1;
+        while (i >= 0 && snapshots[i].pos > pos)
+            i--;
+        if (i < 0 || (playback >= snapshots[i].pos && playback <= pos))
+            return false;
+
+        if (!unpack_snapshot(snapshots[i]))
+        {
+            // It won't be any better next time, and nor will the ones after it, which were read the same way.
+            printf("Invalid snapshot at command %d\n", snapshots[i].pos);
+            snapshots.resize(i);
+            return false;
+        }
+        set_playback_pixels((const unsigned int*)&playback_pixels[0], snapshots[i].pos);
+        return true;
+    }
+
+    // Decompresses a snapshot into playback_pixels.
+    bool unpack_snapshot(const CanvasSnapshot& s)
+    {
+        playback_pixels.resize(get_playback_pixels_size());
+        uLongf size = playback_pixels.size();
+        if (s.data.empty() || uncompress(&playback_pixels[0], &size, &s.data[0], s.data.size()) != Z_OK)
+            return false;
+        return size == playback_pixels.size();
+    }
+
     //---------------------------------------------------------------------------------------------
     // Blit
     // 
@@ -1136,6 +2644,8 @@ public:
     void blit(GdkImage *img, int src_x, int src_y, int dest_x,
             int dest_y, int dest_w, int dest_h, bool overlay)
     {
+        resolve_pending();
+
         pixel_t *pixels = (pixel_t*)img->mem;
         int pitch = img->bpl/sizeof(pixel_t);
         
@@ -1174,7 +2684,7 @@ public:
             }
             else
             {
-                unsigned int* __restrict src = &image[csy*width+src_x];
+                const unsigned int* __restrict src = get_image_row(csy) + src_x;
 
                 int cdx = 0;
                 int csx = src_x;
@@ -1245,6 +2755,8 @@ public:
     void blit_1x(GdkImage* img, int src_x, int src_y, int dest_x, int dest_y,
             int dest_w, int dest_h, bool overlay)
     {
+        PROFILE_SCOPE(BLIT_1X);
+        PROFILE_PIXELS(BLIT_1X, dest_w*dest_h);
         blit_x<scale1_t, 1> (img, src_x, src_y, dest_x, dest_y, dest_w, dest_h,
                 overlay);
     }
@@ -1252,6 +2764,8 @@ public:
     void blit_2x(GdkImage* img, int src_x, int src_y, int dest_x, int dest_y,
             int dest_w, int dest_h, bool overlay)
     {
+        PROFILE_SCOPE(BLIT_2X);
+        PROFILE_PIXELS(BLIT_2X, dest_w*dest_h);
         blit_x<scale2_t, 2> (img, src_x, src_y, dest_x, dest_y, dest_w, dest_h,
                 overlay);
     }
@@ -1259,6 +2773,8 @@ public:
     void blit_4x(GdkImage* img, int src_x, int src_y, int dest_x, int dest_y,
             int dest_w, int dest_h, bool overlay)
     {
+        PROFILE_SCOPE(BLIT_4X);
+        PROFILE_PIXELS(BLIT_4X, dest_w*dest_h);
         blit_x<scale4_t, 4> (img, src_x, src_y, dest_x, dest_y, dest_w, dest_h,
                 overlay);
     }
@@ -1267,6 +2783,8 @@ public:
     void blit_8x(GdkImage* img, int src_x, int src_y, int dest_x, int dest_y,
             int dest_w, int dest_h, bool overlay)
     {
+        PROFILE_SCOPE(BLIT_8X);
+        PROFILE_PIXELS(BLIT_8X, dest_w*dest_h);
         blit_x<scale8_t, 8> (img, src_x, src_y, dest_x, dest_y, dest_w, dest_h,
                 overlay);
     }
@@ -1300,53 +2818,128 @@ public:
         }
     }
 
+    // Thresholds green, i.e. 80 < hue < 150 and saturation > 100 (on the 0-255 scales of Color::yuv_to_hsv).
+    // Rather than computing hue and saturation, the thresholds are rearranged into multiplications so that the test
+    // needs no divisions.  Hue can only be in range when green or blue is the maximum channel.
+    static inline bool is_videopaint_green(unsigned int yuv)
+    {
+        int r, g, b;
+        yuv_hsv_tbl.yuv_to_rgb(yuv, &r, &g, &b);
+
+        int val = max(max(r, g), b);
+        int delta = val - min(min(r, g), b);
+
+        // saturation = 255*delta/val > 100
+        if (delta*255 < 101*val || delta == 0)
+            return false;
+
+        if (val == r)
+            return false;
+        else if (val == g)
+            return 85*(b-r) >= -8*delta;    // hue = 85 + 42.5*(b-r)/delta >= 81
+        else
+            return 85*(r-g) < -40*delta;    // hue = 170 + 42.5*(r-g)/delta < 150
+    }
+
+    // Tracks the green object over the full camera frame.  Every YUYV word (two pixels, of which the first is used)
+    // of every row is converted through yuv_hsv_tbl and thresholded, and the centroid of the matching pixels is 
+    // accumulated in integers.  image_video[0] receives a decimated copy of the mask for display.
     void videopaint_motion(GstBuffer* buf, int vwidth, int vheight)
     {
-        downsize_video(image_video[1], buf, vwidth, vheight);
+        if (vwidth < 2 || vheight < 1 || buf->size != vwidth*vheight*sizeof(unsigned short))
+        {
+            printf("Invalid Gst video buffer size %d (%dx%d)\n", buf->size, vwidth, vheight);
+            return;
+        }
 
-        unsigned int* pixels0 = image_video[0];
-        unsigned int* pixels1 = image_video[1];
-        double cx = 0, cy = 0, cnt = 0;
-        for (int y = 0; y < VIDEO_HEIGHT; y++)
+        PROFILE_SCOPE(VIDEOPAINT_MOTION);
+        PROFILE_PIXELS(VIDEOPAINT_MOTION, vwidth*vheight);
+        videopaint_frame((const unsigned int*)buf->data, vwidth, vheight);
+    }
+
+    // Same as videopaint_motion, for a YUYV frame passed as a string of the given size, e.g. a synthetic frame.
+    void videopaint_motion_from_string(const char* pixels, int size, int vwidth, int vheight)
+    {
+        if (vwidth < 2 || vheight < 1 || size != vwidth*vheight*int(sizeof(unsigned short)))
         {
-            unsigned int* __restrict row = &pixels1[y*VIDEO_WIDTH];
-            unsigned int* destrow = &pixels0[y*VIDEO_WIDTH];
-            for (int x = 0; x < VIDEO_WIDTH; x++)
+            printf("Invalid video frame size %d (%dx%d)\n", size, vwidth, vheight);
+            return;
+        }
+
+        PROFILE_SCOPE(VIDEOPAINT_MOTION);
+        PROFILE_PIXELS(VIDEOPAINT_MOTION, vwidth*vheight);
+        videopaint_frame((const unsigned int*)pixels, vwidth, vheight);
+    }
+
+    // Returns one of the videopaint buffers, allocating it cleared to black when first used.
+    unsigned int* get_image_video(int i)
+    {
+        if (!image_video[i])
+        {
+            image_video[i] = new unsigned int[VIDEO_WIDTH*VIDEO_HEIGHT];
+            memset(image_video[i], 0, VIDEO_WIDTH*VIDEO_HEIGHT*sizeof(unsigned int));
+        }
+        return image_video[i];
+    }
+
+    void release_video_images()
+    {
+        delete[] image_video[0];
+        delete[] image_video[1];
+        image_video[0] = image_video[1] = NULL;
+    }
+
+    void videopaint_frame(const unsigned int* source_pixels, int vwidth, int vheight)
+    {
+        memset(get_image_video(0), 0, VIDEO_WIDTH*VIDEO_HEIGHT*sizeof(unsigned int));
+
+        int words = vwidth/2;
+
+        // 16.16 steps from camera coordinates to preview coordinates.
+        int preview_dx = (VIDEO_WIDTH<<16) / words;
+        int preview_dy = (VIDEO_HEIGHT<<16) / vheight;
+
+        long long cx = 0, cy = 0;
+        int cnt = 0;
+        for (int y = 0; y < vheight; y++)
+        {
+            const unsigned int* __restrict row = &source_pixels[y*words];
+            unsigned int* preview = &image_video[0][((y*preview_dy)>>16)*VIDEO_WIDTH];
+            int rowcnt = 0;
+            int rowx = 0;
+            for (int x = 0; x < words; x++)
             {
-                // Convert YUYV to HSV
-                Color c = Color::yuv_to_hsv(*row);
-                // Threshold green
-                if ((c.r > 80) && (c.r < 150) && (c.g > 100)) {
-                    destrow[0] = 0xffff;
-                    cnt++;
-                    cx += (80-x);
-                    cy += y;
-                } else {
-                    destrow[0] = 0;
+                if (is_videopaint_green(row[x]))
+                {
+                    rowcnt++;
+                    rowx += x;
+                    preview[(x*preview_dx)>>16] = 0xffff;
                 }
-                row++;
-                destrow++;
             }
+            cnt += rowcnt;
+            // The image is mirrored horizontally.
+            cx += rowcnt*(words-1) - rowx;
+            cy += (long long)rowcnt*y;
         }
 
         if (cnt > 0)
         {
-            cx /= cnt;
-            cy /= cnt;
+            float fx = float(cx)/cnt;
+            float fy = float(cy)/cnt;
             // The mouse coordinates are scaled somewhat, as the nature of the video processing causes the blob to leave
             // the screen partially and become smaller (and less significant) towards the edges.
             videopaint_pos = Pos(
-                map_range(cx, 0, VIDEO_WIDTH, -0.2f, 1.2f),
-                map_range(cy, 0, VIDEO_HEIGHT, -0.2f, 1.2f));
+                map_range(fx, 0, words, -0.2f, 1.2f),
+                map_range(fy, 0, vheight, -0.2f, 1.2f));
             // todo- estimate size
-            videopaint_pressure = map_range(cnt, 0, (VIDEO_WIDTH*VIDEO_HEIGHT)/8, 0, 255);
+            videopaint_pressure = map_range(cnt, 0, (words*vheight)/8, 0, 255);
             // Mark mouse pixel in red.
-                        int rx = int(cx);
-                        int ry = int(cy);
-                        unsigned short red = Color(255,0,0,0).get_r5g6b5();
-            for (int x = -3; x <= 3; x++)
-                for (int y = -3; y <= 3; y++)
-                    image_video[0][ry+y*VIDEO_WIDTH+rx+x] = red;
+            int rx = int((words-1-fx)*preview_dx)>>16;
+            int ry = int(fy*preview_dy)>>16;
+            unsigned short red = Color(255,0,0,0).get_r5g6b5();
+            for (int y = max(ry-3, 0); y <= min(ry+3, VIDEO_HEIGHT-1); y++)
+                for (int x = max(rx-3, 0); x <= min(rx+3, VIDEO_WIDTH-1); x++)
+                    image_video[0][y*VIDEO_WIDTH+x] = red;
         }
     }
 
@@ -1357,7 +2950,7 @@ public:
                 
                 for (int y = 0; y < VIDEO_HEIGHT; y++)
                 {
-                        unsigned int* __restrict src = &image_video[0][y*VIDEO_WIDTH];
+                        unsigned int* __restrict src = &get_image_video(0)[y*VIDEO_WIDTH];
                         unsigned short* __restrict dest = &pixels[y*pitch];
                         for (int x = 0; x < VIDEO_WIDTH; x++)
                         {
@@ -1377,6 +2970,23 @@ public:
     // The reference image is a snapshot taken by the webcam that can transparently displayed over the canvas.
     // Note that painting currently cannot take place while the reference image is shown.
 
+    // Returns the reference image, allocating it cleared to black when first used.
+    unsigned short* get_image_reference()
+    {
+        if (!image_reference)
+        {
+            image_reference = new unsigned short[REFERENCE_WIDTH*REFERENCE_HEIGHT];
+            memset(image_reference, 0, REFERENCE_WIDTH*REFERENCE_HEIGHT*sizeof(unsigned short));
+        }
+        return image_reference;
+    }
+
+    void release_reference_image()
+    {
+        delete[] image_reference;
+        image_reference = NULL;
+    }
+
     void set_reference_buffer(GstBuffer* buf, int vwidth, int vheight)
     {
         if (vwidth != REFERENCE_WIDTH || vheight != REFERENCE_HEIGHT || buf->size != vwidth*vheight*sizeof(unsigned short))
@@ -1384,13 +2994,16 @@ public:
             printf("Invalid Gst reference buffer size %d\n", buf->size);
             return;
         }
-        memcpy(image_reference, buf->data, min(size_t(buf->size), size_t(REFERENCE_WIDTH*REFERENCE_HEIGHT*sizeof(unsigned short))));
+        memcpy(get_image_reference(), buf->data, min(size_t(buf->size), size_t(REFERENCE_WIDTH*REFERENCE_HEIGHT*sizeof(unsigned short))));
     }
 
     void render_reference_overlay()
     {
         // Uses image_backup to blend over the canvas without affecting the contents of the canvas.
         // Scales up from whatever REFERENCE_WIDTH/REFERENCE_HEIGHT are to the canvas size.
+        discard_pending();
+        touch_rows(0, height);
+        get_image_reference();
         int dx = (1<<16) * REFERENCE_WIDTH / width;
         int dy = (1<<16) * REFERENCE_HEIGHT / height;
         int ry = 0;
@@ -1415,8 +3028,13 @@ public:
 
     void render_overlay()
     {
+        PROFILE_SCOPE(RENDER_OVERLAY);
+        PROFILE_PIXELS(RENDER_OVERLAY, width*height);
+
         // Since the image is backed up in image_backup, it's ok to destroy the contents of image since
         // clear_overlay will just restore it from image_backup.
+        discard_pending();
+        touch_rows(0, height);
         for (int y = 0; y < height; y++)
             for (int x = 0; x < width; x++)
             {
@@ -1429,6 +3047,7 @@ public:
 
     void clear_overlay()
     {
+        discard_pending();
         memcpy(image, image_backup, width*height*sizeof(unsigned int));
     }
 
@@ -1476,6 +3095,8 @@ public:
 
     bool load(const char* filename)
     {
+        PROFILE_SCOPE(LOAD);
+
         FILE* drwfile = fopen(filename, "rb");
         if (!drwfile)
             return false;
@@ -1497,21 +3118,62 @@ public:
 
         DRW_Command* cmds = (DRW_Command*)malloc(header.ncommands*sizeof(DRW_Command));
         r = fread(cmds, 1, header.ncommands*sizeof(DRW_Command), drwfile);
-    
-        fclose(drwfile);
+        bool has_snapshots = header.id == DRW_Header::ID && header.version >= DRW_VERSION_SNAPSHOTS;
 
         upgrade_drw_header(&header, cmds);
 
         clear();
         convert_from_drw(cmds, 0, header.ncommands);
+        reindex_strokes(0);
 
         free(cmds);
 
+        if (has_snapshots)
+            load_snapshots(drwfile);
+
+        fclose(drwfile);
+
         return true;
     }
+
+    // Reads the snapshots which follow the commands, if there are any.  They are left out if they were taken on a 
+    // canvas of another size, and so are any which don't make sense, along with the rest after them.
+    void load_snapshots(FILE* drwfile)
+    {
+        DRW_SnapshotHeader header;
+        if (fread(&header, 1, sizeof(header), drwfile) != sizeof(header) || header.id != DRW_SnapshotHeader::ID)
+            return;
+        if (header.width != width || header.height != height)
+            return;
+
+        int prev = 0;
+        for (int i = 0; i < header.nsnapshots; i++)
+        {
+            DRW_Snapshot snapshot;
+            if (fread(&snapshot, 1, sizeof(snapshot), drwfile) != sizeof(snapshot))
+                break;
+            if (snapshot.pos <= prev || snapshot.pos > (int)commands.size() ||
+                get_stroke_boundary(snapshot.pos) != snapshot.pos ||
+                snapshot.size <= 0 || snapshot.size > get_playback_pixels_size())
+                break;
+
+            snapshots.push_back(CanvasSnapshot());
+            CanvasSnapshot& s = snapshots.back();
+            s.pos = snapshot.pos;
+            s.data.resize(snapshot.size);
+            if (fread(&s.data[0], 1, snapshot.size, drwfile) != (size_t)snapshot.size)
+            {
+                snapshots.pop_back();
+                break;
+            }
+            prev = snapshot.pos;
+        }
+    }
     
     bool save(const char* filename)
     {
+        PROFILE_SCOPE(SAVE);
+
         FILE* drwfile = fopen(filename, "wb");
         if (!drwfile)
             return false;
@@ -1535,11 +3197,34 @@ public:
         r = fwrite(cmds, sizeof(DRW_Command), commands.size(), drwfile);
         free(cmds);
 
+        // Only the snapshots taken so far are saved, as taking more here would hold up saving by replaying.
+        if (!snapshots.empty())
+            save_snapshots(drwfile);
+
         fclose(drwfile);
 
         return true;
     }
 
+    void save_snapshots(FILE* drwfile)
+    {
+        DRW_SnapshotHeader header;
+        header.id = DRW_SnapshotHeader::ID;
+        header.width = width;
+        header.height = height;
+        header.nsnapshots = snapshots.size();
+        fwrite(&header, 1, sizeof(header), drwfile);
+
+        for (int i = 0; i < (int)snapshots.size(); i++)
+        {
+            DRW_Snapshot snapshot;
+            snapshot.pos = snapshots[i].pos;
+            snapshot.size = snapshots[i].data.size();
+            fwrite(&snapshot, 1, sizeof(snapshot), drwfile);
+            fwrite(&snapshots[i].data[0], 1, snapshot.size, drwfile);
+        }
+    }
+
     void convert_from_drw(DRW_Command* cmds, int start, int ncommands)
     {
         commands.resize(start+ncommands);
@@ -1573,6 +3258,9 @@ public:
             DRW_Command* drw = &(*cmds)[i];
             DrawCommand* cmd = &commands[start+i];
 
+            // Each type only sets some of the fields, so clear the rest rather than leave whatever malloc returned, 
+            // which would make the same commands convert to different bytes.
+            drw->raw = 0;
             drw->type = cmd->type;
 
             if (cmd->type == DrawCommand::TYPE_DRAW)
@@ -1603,15 +3291,22 @@ public:
 
     DrawCommandBuffer send_drw_commands(int start, int ncommands)
     {
+        // Convert into a local pointer rather than writing buf.data through a cast, which the optimizer may assume
+        // doesn't change buf.data.
+        DRW_Command* cmds;
+        convert_to_drw(&cmds, start, ncommands);
         DrawCommandBuffer buf;
+        buf.data = (char*)cmds;
+        buf.cmds = buf.data;
         buf.ncommands = ncommands;
-        convert_to_drw((DRW_Command**)&buf.cmds, start, ncommands);
+        buf.capacity = ncommands;
         return buf;
     }
 
     void receive_drw_commands(const DrawCommandBuffer& buf, int start)
     {
         convert_from_drw((DRW_Command*)buf.cmds, start, buf.ncommands);
+        reindex_strokes(start);
     }
 };
 
@@ -20,6 +20,9 @@
 
 #include <Python.h>
 
+// For the guint types below.  Included here so that the header doesn't depend on what was included before it.
+#include <glib.h>
+
 #include <vector>
 #include <algorithm>
 using namespace std;
@@ -27,6 +30,10 @@ using namespace std;
 #include <cmath>
 #include <float.h>
 
+// Version of the interface colors.py uses, checked by colorsc/__init__.py against the prebuilt binaries it loads.  Bump
+// it, and the one there, whenever a change to the C++ code means the binaries have to be rebuilt.
+#define COLORSC_API_VERSION 2
+
 typedef guint16 depth16_t;
 typedef guint32 depth24_t;
 
@@ -205,6 +212,93 @@ struct Color
 
 };
 
+// Lookup tables for converting YUYV camera pixels to HSV using only integer arithmetic.  Gives the same result as 
+// Color::yuv_to_hsv to within +-1 per channel, at a fraction of the cost, since the float multiplies, clamps and 
+// divisions are all replaced by table lookups and 16.16 fixed point multiplies.
+struct YuvHsvTable
+{
+    int y_tbl[256];     //  1.164*(y-16)
+    int rv_tbl[256];    //  1.596*(v-128)
+    int gv_tbl[256];    // -0.813*(v-128)
+    int gu_tbl[256];    // -0.391*(u-128)
+    int bu_tbl[256];    //  2.018*(u-128)
+    int hue_tbl[256];   //  42.5/delta
+    int sat_tbl[256];   //  255/val
+
+    bool created;
+
+    YuvHsvTable() : created(false) {}
+
+    static int to_fixed(float a)
+    {
+        return int(floorf(a*65536.0f + 0.5f));
+    }
+
+    void create()
+    {
+        if (created)
+            return;
+        for (int i = 0; i < 256; i++)
+        {
+            y_tbl[i]  = to_fixed( 1.164f*(i-16));
+            rv_tbl[i] = to_fixed( 1.596f*(i-128));
+            gv_tbl[i] = to_fixed(-0.813f*(i-128));
+            gu_tbl[i] = to_fixed(-0.391f*(i-128));
+            bu_tbl[i] = to_fixed( 2.018f*(i-128));
+            hue_tbl[i] = i ? to_fixed(42.5f/i) : 0;
+            sat_tbl[i] = i ? to_fixed(255.0f/i) : 0;
+        }
+        created = true;
+    }
+
+    static inline int clamp_byte(int a)
+    {
+        a >>= 16;
+        return a < 0 ? 0 : (a > 255 ? 255 : a);
+    }
+
+    // Same packing as Color::yuv_to_hsv.
+    inline void yuv_to_rgb(unsigned int yuv, int* r, int* g, int* b) const
+    {
+        int y = (yuv>>24)&0xff;
+        int u = (yuv>>16)&0xff;
+        int v = yuv&0xff;
+
+        int yy = y_tbl[y];
+        *r = clamp_byte(yy + rv_tbl[v]);
+        *g = clamp_byte(yy + gv_tbl[v] + gu_tbl[u]);
+        *b = clamp_byte(yy + bu_tbl[u]);
+    }
+
+    // Same packing as Color::yuv_to_hsv; returns hue in r, saturation in g and value in b.
+    inline Color yuv_to_hsv(unsigned int yuv) const
+    {
+        int r, g, b;
+        yuv_to_rgb(yuv, &r, &g, &b);
+
+        int val = max(max(r, g), b);
+        int delta = val - min(min(r, g), b);
+
+        Color c;
+        c.b = val;
+        if (delta == 0)
+            return c;
+
+        int hue;
+        if (val == r)
+            hue = (g-b)*hue_tbl[delta];
+        else if (val == g)
+            hue = (b-r)*hue_tbl[delta] + (85<<16);
+        else
+            hue = (r-g)*hue_tbl[delta] + (170<<16);
+        if (hue < 0)
+            hue += 255<<16;
+        c.r = min(hue>>16, 255);
+        c.g = min((delta*sat_tbl[val])>>16, 255);
+        return c;
+    }
+};
+
 // Structure for passing byte data to and from Python.
 struct ByteBuffer
 {
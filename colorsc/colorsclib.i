@@ -37,12 +37,20 @@
         $1 = buf;
 }
 
-// Pass a gtk.gdk.Image as a GdkImage*.
+// Pass a gtk.gdk.Image, or a MemoryImage for drawing without a display, as a GdkImage*.
 %typemap(in) GdkImage* {
-        // todo- Error checking would be nice.
-        PyGObject* pygo = (PyGObject*)$input;
-        GdkImage* img = (GdkImage*)pygo->obj;
-        $1 = img;
+        MemoryImage* mimg;
+        if (SWIG_IsOK(SWIG_ConvertPtr($input, (void**)&mimg, $descriptor(MemoryImage*), 0)))
+        {
+            $1 = &mimg->image;
+        }
+        else
+        {
+            // todo- Error checking would be nice.
+            PyGObject* pygo = (PyGObject*)$input;
+            GdkImage* img = (GdkImage*)pygo->obj;
+            $1 = img;
+        }
 }
 
 // Return SurfaceA8R8G8B8 as Python string.
@@ -59,3 +67,18 @@
 %include "canvas.h"
 %include "palette.h"
 
+%extend Canvas {
+%pythoncode {
+    def get_profile(self, reset=False):
+        """Returns a snapshot of the profiling counters as a dictionary of function name to a dictionary of calls,
+        pixels and ns, optionally resetting them."""
+        profile = {}
+        for i in range(ProfileCounter.NUM_COUNTERS):
+            c = self.get_profile_counter(i)
+            profile[self.get_profile_name(i)] = { 'calls': c.calls, 'pixels': c.pixels, 'ns': c.ns }
+        if reset:
+            self.reset_profile()
+        return profile
+}
+}
+
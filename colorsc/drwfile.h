@@ -18,7 +18,10 @@
 #ifndef _DRWFILE_H_
 #define _DRWFILE_H_
 
-#define DRW_VERSION 1070
+#define DRW_VERSION 1071
+
+// The first version whose files may have snapshots after the commands.
+#define DRW_VERSION_SNAPSHOTS 1071
 
 struct DRW_Command
 {
@@ -74,4 +77,24 @@ struct DRW_Header
     int ncommands;
 };
 
+// Since DRW_VERSION_SNAPSHOTS the commands may be followed by snapshots of the pixels at some of the stroke ends, so
+// that the drawing can be opened and scrubbed through without replaying all of it, see Canvas::make_next_snapshot.  
+// Readers of earlier versions only read ncommands commands, so never see them.
+struct DRW_SnapshotHeader
+{
+    static const unsigned int ID = 0x536e6170; // 'Snap'
+
+    unsigned int id;
+    int width;                      // Size of the canvas the snapshots were taken on.
+    int height;
+    int nsnapshots;
+};
+
+// Each snapshot is followed by size bytes of the pixels from Canvas::get_playback_pixels, compressed with zlib.
+struct DRW_Snapshot
+{
+    int pos;                        // Number of commands replayed, always at the end of a stroke.
+    int size;
+};
+
 #endif
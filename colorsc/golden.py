@@ -0,0 +1,204 @@
+# Copyright 2008 by Jens Andersson and Wade Brainerd.
+# This file is part of Colors! XO.
+#
+# Colors is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Colors is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Colors.  If not, see <http://www.gnu.org/licenses/>.
+"""Golden image checks for playback, to catch any change to the pixels a drawing replays to.
+
+Run from the activity bundle with
+
+    python -m colorsc.golden [--update] [--golden FILE] [--sizes WxH,...] [DRAWING.drw ...]
+
+Each drawing (by default every data/*.drw) is replayed at each canvas size, and the CRC-32 of the image is taken at the
+end of every stroke.  These are compared with the hashes stored in the golden file, and the first one which differs
+gives the range of commands where the pixels first changed.  The final image is also checked after finish_playback,
+which replays strokes in parallel, and on a sparse canvas, since both must give exactly the pixels of playing the
+commands one at a time.
+
+Run with --update to record the current hashes, e.g. for a new drawing or after an intended change to the rasterizer.
+The hashes are of the raw pixel words, so golden files can only be compared between machines of the same byte
+order."""
+
+import os, sys
+from optparse import OptionParser
+
+try:
+    import json
+    json.dumps
+except (ImportError, AttributeError):
+    import simplejson as json
+
+from colorsc import *
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_PATH = os.path.join(ROOT_PATH, 'data')
+GOLDEN_PATH = os.path.join(DATA_PATH, 'golden.json')
+
+GOLDEN_VERSION = 1
+
+# Canvas sizes to replay at.  The odd size catches rounding differences which the even ones may hide.
+SIZES = [(600, 450), (300, 225), (601, 451)]
+
+def get_drawing_name (filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+def replay (filename, width, height):
+    """Replays a drawing on a new canvas.  Returns a dictionary of the number of commands, a list of [command index,
+    image CRC] at the end of each stroke, and the CRC of the final image, along with a list of errors for playback
+    methods which disagree with each other."""
+    canvas = Canvas(width, height)
+    canvas.clear()
+    if not canvas.load(filename):
+        raise IOError("cannot load %s" % filename)
+    ncommands = canvas.get_num_commands()
+
+    checkpoints = []
+    canvas.start_playback()
+    for i in range(canvas.get_num_strokes()):
+        end = canvas.get_stroke(i).end
+        if end < 0:
+            break
+        canvas.playback_to(end)
+        checkpoints.append([end, canvas.get_image_crc32()])
+    canvas.playback_to(ncommands)
+    final = canvas.get_image_crc32()
+
+    errors = []
+    canvas.start_playback()
+    canvas.finish_playback()
+    crc = canvas.get_image_crc32()
+    if crc != final:
+        errors.append("finish_playback gives %08x, playing the commands in order gives %08x" % (crc, final))
+
+    sparse = Canvas(width, height, True)
+    sparse.clear()
+    sparse.load(filename)
+    sparse.start_playback()
+    sparse.finish_playback()
+    crc = sparse.get_image_crc32()
+    if crc != final:
+        errors.append("sparse canvas gives %08x, normal canvas gives %08x" % (crc, final))
+
+    return { 'commands': ncommands, 'checkpoints': checkpoints, 'final': final }, errors
+
+def compare (golden, result):
+    """Returns a list of the differences between a replay result and its golden hashes, earliest first."""
+    errors = []
+    if golden['commands'] != result['commands']:
+        errors.append("%d commands loaded, expected %d" % (result['commands'], golden['commands']))
+
+    start = 0
+    for expected, actual in zip(golden['checkpoints'], result['checkpoints']):
+        if expected != actual:
+            if expected[0] != actual[0]:
+                errors.append("stroke ending at command %d, expected one ending at %d" % (actual[0], expected[0]))
+            else:
+                errors.append("first difference in commands %d to %d: image %08x, expected %08x" %
+                    (start, actual[0]-1, actual[1], expected[1]))
+            return errors
+        start = actual[0]
+    if len(golden['checkpoints']) != len(result['checkpoints']):
+        errors.append("%d strokes, expected %d" % (len(result['checkpoints']), len(golden['checkpoints'])))
+
+    if golden['final'] != result['final']:
+        errors.append("first difference after command %d: final image %08x, expected %08x" %
+            (start, result['final'], golden['final']))
+    return errors
+
+def read_golden (path):
+    if not os.path.exists(path):
+        return { 'version': GOLDEN_VERSION, 'drawings': {} }
+    f = open(path)
+    try:
+        golden = json.load(f)
+    finally:
+        f.close()
+    if golden.get('version') != GOLDEN_VERSION:
+        raise ValueError("%s has version %s, expected %d" % (path, golden.get('version'), GOLDEN_VERSION))
+    return golden
+
+def write_golden (path, golden):
+    """Writes the golden hashes with one line per drawing and size, which keeps diffs between versions readable."""
+    f = open(path, 'w')
+    try:
+        f.write('{\n"version": %d,\n"drawings": {\n' % golden['version'])
+        names = golden['drawings'].keys()
+        names.sort()
+        for i, name in enumerate(names):
+            sizes = golden['drawings'][name]
+            keys = sizes.keys()
+            keys.sort()
+            f.write('%s: {\n' % json.dumps(name))
+            for j, key in enumerate(keys):
+                f.write('  %s: %s%s\n' % (json.dumps(key), json.dumps(sizes[key], sort_keys=True),
+                    j < len(keys)-1 and ',' or ''))
+            f.write('}%s\n' % (i < len(names)-1 and ',' or ''))
+        f.write('}\n}\n')
+    finally:
+        f.close()
+
+def parse_sizes (s):
+    sizes = []
+    for size in s.split(','):
+        w, h = size.lower().split('x')
+        sizes.append((int(w), int(h)))
+    return sizes
+
+def main (argv):
+    parser = OptionParser(usage="python -m colorsc.golden [options] [DRAWING.drw ...]")
+    parser.add_option('-u', '--update', action='store_true', default=False,
+        help="record the current hashes in the golden file rather than checking them")
+    parser.add_option('-g', '--golden', default=GOLDEN_PATH,
+        help="golden file to check against or update [%default]")
+    parser.add_option('-s', '--sizes', default=None,
+        help="comma separated canvas sizes to replay at, e.g. 600x450,300x225 [all of %s]" %
+            ','.join(['%dx%d' % s for s in SIZES]))
+    options, args = parser.parse_args(argv)
+
+    filenames = args
+    if not filenames:
+        filenames = [os.path.join(DATA_PATH, f) for f in os.listdir(DATA_PATH) if f.endswith('.drw')]
+        filenames.sort()
+    sizes = SIZES
+    if options.sizes:
+        sizes = parse_sizes(options.sizes)
+
+    golden = read_golden(options.golden)
+    failures = 0
+    for filename in filenames:
+        name = get_drawing_name(filename)
+        drawing = golden['drawings'].setdefault(name, {})
+        for width, height in sizes:
+            key = '%dx%d' % (width, height)
+            result, errors = replay(filename, width, height)
+            if options.update:
+                drawing[key] = result
+            elif key not in drawing:
+                errors.append("no golden hashes, run with --update to record them")
+            else:
+                errors = compare(drawing[key], result) + errors
+            if errors:
+                failures += 1
+                for e in errors:
+                    print "FAIL %s %s: %s" % (name, key, e)
+            else:
+                print "ok   %s %s: %d commands, %d strokes" % (name, key, result['commands'],
+                    len(result['checkpoints']))
+
+    if options.update:
+        write_golden(options.golden, golden)
+        print "Wrote %s" % options.golden
+    return failures and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
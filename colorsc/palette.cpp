@@ -17,3 +17,9 @@
 */
 #include "palette.h"
 
+Palette::WheelCache Palette::wheel_cache;
+
+BrushPreview::CacheList BrushPreview::cache_list;
+BrushPreview::CacheMap BrushPreview::cache_map;
+int BrushPreview::cache_hits = 0;
+int BrushPreview::cache_misses = 0;
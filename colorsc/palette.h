@@ -21,6 +21,9 @@
 #include "colorsc.h"
 #include "canvas.h"
 
+#include <map>
+#include <list>
+
 // The Palette is the color wheel and triangle that are part of the brush controls dialog.
 // This class manages rendering the palette as efficiently as possible into GdkImage objects which are
 // then displayed on the screen.
@@ -30,6 +33,11 @@ class Palette
 public:
     static const int WHEEL_WIDTH = 75;
 
+    // Rendered color wheels, shared by all Palette objects since the wheel never changes.  
+    // Keyed by (size, depth), with the rows packed tightly.
+    typedef map<pair<int, int>, vector<unsigned char> > WheelCache;
+    static WheelCache wheel_cache;
+
     int size;
 
     float palette_h, palette_s, palette_v;
@@ -38,10 +46,16 @@ public:
     bool triangle_capture;
     bool wheel_capture;
 
+    // The image and hue the triangle was last rendered with, so it is only rendered again when the hue changes.
+    GdkImage* triangle_image;
+    float triangle_h;
+
     Palette(int size) : size(size)
     {
         palette_h = palette_s = palette_v = 0;
         triangle_capture = false;
+        triangle_image = NULL;
+        triangle_h = 0;
     }
 
     float get_wheel_radius()
@@ -88,6 +102,17 @@ public:
         h /= 60;                    // sector 0 to 5
         int i = int(floorf(h));
         float f = h - i;            // factorial part of h
+        hsv_sector_to_rgb(r, g, b, i, f, s, v);
+    }
+
+    // The second half of hsv_to_rgb, for when the hue has already been split into sector i and fraction f.
+    inline void hsv_sector_to_rgb(float* r, float* g, float* b, int i, float f, float s, float v)
+    {
+        if (s == 0) 
+        {
+            *r = *g = *b = v;
+            return;
+        }
         float p = v * (1-s);
         float q = v * (1-s * f);
         float t = v * (1-s * (1 - f));
@@ -106,29 +131,60 @@ public:
     void set_color(const Color& c)
     {
         rgb_to_hsv(c.r/255.0f, c.g/255.0f, c.b/255.0f, &palette_h, &palette_s, &palette_v);
+        triangle_cursor = get_triangle_pos_for_hsv(palette_h, palette_s, palette_v);
+    }
 
-        // I couldn't work out an exact solution to the blobby triangle position, so I'm using a relaxation algorithm.  
-        // It usually takes less than 10 iterations to converge and only runs when you first open the palette.
+    // Returns where the triangle cursor goes for a color, with the triangle rotated to hue h.
+    // Saturation and value are distances from p0 and p2 (see process_mouse), so the position is where the circle of 
+    // radius (1-s)*side around p0 meets the circle of radius v*side around p2, on the same side as p1.
+    // Colors which the blobby triangle cannot show exactly have circles which do not meet.  Those get the point on the 
+    // p2 circle closest to the p0 circle, the same point the old relaxation algorithm settled on.
+    Pos get_triangle_pos_for_hsv(float h, float s, float v)
+    {
         Pos p0, p1, p2;
-        get_triangle_points(&p0, &p1, &p2);
+        get_triangle_points_for_hue(h, &p0, &p1, &p2);
         float side = distance(p0, p1);
+        float r0 = (1.0f-s)*side;
+        float r2 = v*side;
+
+        Pos axis = (p2-p0)/side;
+        if (r0 >= r2+side)
+            return p2 + axis*r2;
+        if (r0+r2 <= side || r2 >= r0+side)
+            return p2 - axis*r2;
+
+        float along = (side*side + r0*r0 - r2*r2)/(2.0f*side);
+        float across = sqrtf(max(0.0f, r0*r0 - along*along));
+        Pos normal(-axis.y, axis.x);
+        if (dot(normal, p1-p0) < 0)
+            normal = normal*-1.0f;
+        return p0 + axis*along + normal*across;
+    }
 
-        Pos p = (p0+p1+p2)*(1.0f/3.0f);
-        float epsilon = 0.001f;
-        int max_iterations = 50;
-        for (int i = 0; i < max_iterations; i++)
-        {
-            float d0 = distance(p, p0);
-            float d0ok = fabsf((side-d0)-palette_s*side);
-            p = p + ((p0-p)/length(p0-p)) * (d0-(1.0f-palette_s)*side);
-
-            float d2 = distance(p, p2);
-            float d2ok = fabsf(d2-palette_v*side); 
-            p = p + ((p2-p)/length(p2-p)) * (d2-palette_v*side);
+    // Positions returned by get_triangle_positions are kept here until the next call.
+    vector<float> triangle_positions;
 
-            if (d0ok <= epsilon && d2ok <= epsilon) break;
+    // Bulk version of get_triangle_pos_for_hsv for many colors at once, e.g. for swatches.  
+    // Takes ncolors colors packed as native endian a8r8g8b8 words and returns the x, y positions as packed floats, 
+    // each with the triangle rotated to that color's own hue.
+    ByteBuffer get_triangle_positions(const char* colors, int ncolors)
+    {
+        triangle_positions.resize(ncolors*2);
+        const unsigned int* c = (const unsigned int*)colors;
+        for (int i = 0; i < ncolors; i++)
+        {
+            Color color = Color::create_from_a8r8g8b8(c[i]);
+            float h, s, v;
+            rgb_to_hsv(color.r/255.0f, color.g/255.0f, color.b/255.0f, &h, &s, &v);
+            Pos p = get_triangle_pos_for_hsv(h, s, v);
+            triangle_positions[i*2+0] = p.x;
+            triangle_positions[i*2+1] = p.y;
         }
-        triangle_cursor = p;
+
+        ByteBuffer buf;
+        buf.size = ncolors*2*sizeof(float);
+        buf.data = ncolors ? &triangle_positions[0] : NULL;
+        return buf;
     }
 
     Color get_color()
@@ -174,31 +230,27 @@ public:
     }
 
     void get_triangle_points(Pos* p0, Pos* p1, Pos* p2)
+    {
+        get_triangle_points_for_hue(palette_h, p0, p1, p2);
+    }
+
+    void get_triangle_points_for_hue(float h, Pos* p0, Pos* p1, Pos* p2)
     {
         Pos center(size/2, size/2);
-        *p0 = center + Pos::create_from_angle(palette_h+0.0f, size/2-WHEEL_WIDTH);
-        *p1 = center + Pos::create_from_angle(palette_h+120.0f, size/2-WHEEL_WIDTH);
-        *p2 = center + Pos::create_from_angle(palette_h+240.0f, size/2-WHEEL_WIDTH);
+        *p0 = center + Pos::create_from_angle(h+0.0f, size/2-WHEEL_WIDTH);
+        *p1 = center + Pos::create_from_angle(h+120.0f, size/2-WHEEL_WIDTH);
+        *p2 = center + Pos::create_from_angle(h+240.0f, size/2-WHEEL_WIDTH);
     }
 
     template <typename pixel_t> inline
-    void _render_wheel(GdkImage* image)
+    void _render_wheel(pixel_t* pixels, int stride)
     {
-        if (image->width != size || image->height != size)
-        {
-            fprintf(stderr, "Error: Invalid Palette GdkImage.\n");
-            return;
-        }
-
         Color bkg(64, 64, 64, 0);
 
         float wheel_radius = size/2;
         float ring_min_sqr = sqr(wheel_radius-WHEEL_WIDTH);
         float ring_max_sqr = sqr(wheel_radius);
 
-        pixel_t* pixels = (pixel_t*)image->mem;
-        int stride = image->bpl/sizeof(pixel_t);
-
         for (int y = 0; y < size; y++)
         {
             pixel_t* row = &pixels[y*stride];
@@ -227,15 +279,95 @@ public:
         }
     }
 
-    // The wheel never changes, so it can be rendered once here.  This also clears the image background.
+    // The wheel never changes, so it is rendered once per size and depth into the wheel cache and copied from there.  
+    // This also clears the image background, so the triangle has to be rendered again afterwards.
     void render_wheel(GdkImage* image)
     {
-        if (image->depth == 16)
-            _render_wheel<depth16_t>(image);
-        else
-            _render_wheel<depth24_t>(image);
+        if (image->width != size || image->height != size)
+        {
+            fprintf(stderr, "Error: Invalid Palette GdkImage.\n");
+            return;
+        }
+
+        int row_bytes = size * (image->depth == 16 ? sizeof(depth16_t) : sizeof(depth24_t));
+
+        vector<unsigned char>& pixels = wheel_cache[make_pair(size, image->depth)];
+        if (pixels.empty())
+        {
+            pixels.resize(row_bytes*size);
+            if (image->depth == 16)
+                _render_wheel<depth16_t>((depth16_t*)&pixels[0], size);
+            else
+                _render_wheel<depth24_t>((depth24_t*)&pixels[0], size);
+        }
+
+        for (int y = 0; y < size; y++)
+            memcpy((unsigned char*)image->mem + y*image->bpl, &pixels[y*row_bytes], row_bytes);
+
+        triangle_image = NULL;
+    }
+
+    // Returns the range of x values on row y that lie within radius_sqr of c, or false if there are none.
+    bool get_circle_span(const Pos& c, float radius_sqr, float y, float* lo, float* hi)
+    {
+        float dy = y-c.y;
+        float rhs = radius_sqr - dy*dy;
+        if (rhs < 0)
+            return false;
+        float half = sqrtf(rhs);
+        *lo = c.x-half;
+        *hi = c.x+half;
+        return true;
     }
 
+    // Converts the x range [lo, hi] into the indices of the 2x2 blocks starting at x0 it covers, then corrects the 
+    // ends with the exact per-block test so that rounding in the span calculation can never change the result.  
+    // Returns an empty range (first > last) if no block passes.
+    template <typename Inside>
+    void get_block_span(float lo, float hi, int x0, int nblocks, const Inside& inside, int* first, int* last)
+    {
+        int k0 = max(0, min(nblocks-1, int(ceilf((lo-x0)*0.5f))));
+        int k1 = max(0, min(nblocks-1, int(floorf((hi-x0)*0.5f))));
+        while (k0 > 0 && inside(k0-1)) k0--;
+        while (k0 <= k1 && !inside(k0)) k0++;
+        while (k1 < nblocks-1 && inside(k1+1)) k1++;
+        while (k1 >= k0 && !inside(k1)) k1--;
+        *first = k0;
+        *last = k1;
+    }
+
+    // Exact test for whether the block at index k of a row is inside the blobby triangle.
+    struct InsideTriangle
+    {
+        Palette* palette;
+        Pos p0, p1, p2;
+        float side_sqr;
+        int x0;
+        float y;
+
+        bool operator()(int k) const
+        {
+            Pos p(x0+2*k, y);
+            return palette->distance_sqr(p, p0) <= side_sqr && palette->distance_sqr(p, p1) <= side_sqr && 
+                palette->distance_sqr(p, p2) <= side_sqr;
+        }
+    };
+
+    // Exact test for whether the block at index k of a row is inside the inner circle of the wheel.
+    struct InsideRing
+    {
+        Palette* palette;
+        Pos center;
+        float radius_sqr;
+        int x0;
+        float y;
+
+        bool operator()(int k) const
+        {
+            return palette->distance_sqr(Pos(x0+2*k, y), center) < radius_sqr;
+        }
+    };
+
     template <typename pixel_t>
     void _render_triangle(GdkImage* image)
     {
@@ -257,49 +389,78 @@ public:
 
         float wheel_radius = size/2;
         float ring_min_sqr = sqr(wheel_radius-WHEEL_WIDTH);
+        Pos center(wheel_radius, wheel_radius);
 
         int x0 = WHEEL_WIDTH;
         int x1 = size-WHEEL_WIDTH;
+        int nblocks = (x1-x0+1)/2;
+
+        // The hue is the same over the whole triangle, so split it into sector and fraction just once.
+        float h = palette_h/60;
+        int sector = int(floorf(h));
+        float f = h - sector;
+
+        InsideTriangle in_triangle = { this, p0, p1, p2, triangle_side_sqr, x0, 0 };
+        InsideRing in_ring = { this, center, ring_min_sqr, x0, 0 };
 
         pixel_t* pixels = (pixel_t*)image->mem;
         int stride = image->bpl/sizeof(pixel_t);
 
-        Pos p(x0,x0);
-        for (int y = x0; y < x1; y+=2, p.y += 2.0f)
+        // Each row is rasterized as a span of triangle colors, with spans of background on either side out to the edge
+        // of the inner circle.  Blocks outside the inner circle belong to the wheel and are left alone.
+        for (int y = x0; y < x1; y+=2)
         {
-            p.x = x0;
+            in_triangle.y = in_ring.y = y;
+
+            int r0 = 0, r1 = -1;
+            float lo, hi;
+            if (get_circle_span(center, ring_min_sqr, y, &lo, &hi))
+                get_block_span(lo, hi, x0, nblocks, in_ring, &r0, &r1);
+
+            int t0 = 0, t1 = -1;
+            float lo0, hi0, lo1, hi1, lo2, hi2;
+            if (get_circle_span(p0, triangle_side_sqr, y, &lo0, &hi0) && 
+                get_circle_span(p1, triangle_side_sqr, y, &lo1, &hi1) && 
+                get_circle_span(p2, triangle_side_sqr, y, &lo2, &hi2))
+                get_block_span(max(max(lo0, lo1), lo2), min(min(hi0, hi1), hi2), x0, nblocks, in_triangle, &t0, &t1);
+
             pixel_t* __restrict row0 = &pixels[(y+0)*stride+x0];
             pixel_t* __restrict row1 = &pixels[(y+1)*stride+x0];
-            for (int x = x0; x < x1; x+=2, p.x += 2.0f)
+
+            // Background left and right of the triangle.  If the row misses the triangle, it is all background.
+            if (t0 > t1)
             {
-                // Calculate position inside triangle.  If inside, then use as HSV.  
-                float d0_sqr = distance_sqr(p, p0);
-                float d1_sqr = distance_sqr(p, p1);
-                float d2_sqr = distance_sqr(p, p2);
-                if (d0_sqr <= triangle_side_sqr && d1_sqr <= triangle_side_sqr && d2_sqr <= triangle_side_sqr)
-                {
-                    float r, g, b;
-                    hsv_to_rgb(&r, &g, &b, palette_h, 1.0f-sqrtf(d0_sqr)*inv_triangle_side, sqrtf(d2_sqr)*inv_triangle_side);
-                    pixel_t c;
-                    Color::create_from_float(r, g, b, 1).to_pixel(&c);
-                    row0[0] = c; 
-                    row0[1] = c;
-                    row1[0] = c; 
-                    row1[1] = c;
-                }
-                else
-                {
-                    // Inside ring?  Clear to background.
-                    if (distance_sqr(p, Pos(wheel_radius, wheel_radius)) < ring_min_sqr)
-                    {
-                        row0[0] = bkgc;
-                        row0[1] = bkgc;
-                        row1[0] = bkgc;
-                        row1[1] = bkgc;
-                    }
-                }
-                row0 += 2;
-                row1 += 2;
+                t0 = r1+1;
+                t1 = r1;
+            }
+            for (int k = r0; k <= r1 && k < t0; k++)
+            {
+                row0[2*k+0] = bkgc;
+                row0[2*k+1] = bkgc;
+                row1[2*k+0] = bkgc;
+                row1[2*k+1] = bkgc;
+            }
+            for (int k = max(r0, t1+1); k <= r1; k++)
+            {
+                row0[2*k+0] = bkgc;
+                row0[2*k+1] = bkgc;
+                row1[2*k+0] = bkgc;
+                row1[2*k+1] = bkgc;
+            }
+
+            // The triangle itself.  Saturation falls off with distance from p0, value rises with distance from p2.
+            Pos p(x0+2*t0, y);
+            for (int k = t0; k <= t1; k++, p.x += 2.0f)
+            {
+                float r, g, b;
+                hsv_sector_to_rgb(&r, &g, &b, sector, f, 
+                    1.0f-sqrtf(distance_sqr(p, p0))*inv_triangle_side, sqrtf(distance_sqr(p, p2))*inv_triangle_side);
+                pixel_t c;
+                Color::create_from_float(r, g, b, 1).to_pixel(&c);
+                row0[2*k+0] = c; 
+                row0[2*k+1] = c;
+                row1[2*k+0] = c; 
+                row1[2*k+1] = c;
             }
         }
     }
@@ -308,12 +469,21 @@ public:
     // Scales up implicitly by 2x to improve performance.
     // The appearance was an accident which creates a kind of blobby triangle, like the intersection of three circles.
     // But I like the look so I'm keeping it!
-    void render_triangle(GdkImage* image)
+    // Only the hue affects the triangle, so nothing is done if the image already holds the triangle for the current hue.
+    // Returns true if the image was changed.
+    bool render_triangle(GdkImage* image)
     {
+        if (image == triangle_image && palette_h == triangle_h)
+            return false;
+
         if (image->depth == 16)
             _render_triangle<depth16_t>(image);
         else
             _render_triangle<depth24_t>(image);
+
+        triangle_image = image;
+        triangle_h = palette_h;
+        return true;
     }
 
     Pos get_wheel_pos()
@@ -401,6 +571,35 @@ public:
 class BrushPreview
 {
 public:
+    // Everything that affects the rendered preview.
+    struct CacheKey
+    {
+        int type, size, opacity;
+        unsigned int color;
+        int depth, width, height;
+
+        bool operator<(const CacheKey& b) const
+        {
+            if (type != b.type) return type < b.type;
+            if (size != b.size) return size < b.size;
+            if (opacity != b.opacity) return opacity < b.opacity;
+            if (color != b.color) return color < b.color;
+            if (depth != b.depth) return depth < b.depth;
+            if (width != b.width) return width < b.width;
+            return height < b.height;
+        }
+    };
+
+    // Rendered previews, shared by all BrushPreview objects and kept in least recently used order, most recent first.  
+    // Rows are packed tightly.  Scrubbing a slider back over values already seen only costs a copy.
+    typedef list<pair<CacheKey, vector<unsigned char> > > CacheList;
+    typedef map<CacheKey, CacheList::iterator> CacheMap;
+    static const int CACHE_SIZE = 64;
+    static CacheList cache_list;
+    static CacheMap cache_map;
+    static int cache_hits;
+    static int cache_misses;
+
     int size;
 
     Brush brush;
@@ -409,6 +608,16 @@ public:
     {
     }
 
+    static int get_cache_hits() { return cache_hits; }
+    static int get_cache_misses() { return cache_misses; }
+
+    static void clear_cache()
+    {
+        cache_list.clear();
+        cache_map.clear();
+        cache_hits = cache_misses = 0;
+    }
+
     template <typename pixel_t> inline
     void _render(GdkImage* image)
     {
@@ -482,10 +691,57 @@ public:
 
     void render(GdkImage* image)
     {
-        if (image->depth == 16)
-            _render<depth16_t>(image);
+        if (image->width != size || image->height != size || (size&1))
+        {
+            fprintf(stderr, "Error: Invalid BrushPreview GdkImage.\n");
+            return;
+        }
+
+        // Minimum brush size, as in _render.
+        if (brush.size<2) brush.size = 2;
+
+        CacheKey key;
+        key.type = brush.type;
+        key.size = brush.size;
+        key.opacity = int(round(255.0f * brush.opacity));
+        key.color = brush.color.get_a8r8g8b8();
+        key.depth = image->depth;
+        key.width = image->width;
+        key.height = image->height;
+
+        int row_bytes = size * (image->depth == 16 ? sizeof(depth16_t) : sizeof(depth24_t));
+
+        CacheMap::iterator i = cache_map.find(key);
+        if (i != cache_map.end())
+        {
+            cache_hits++;
+            cache_list.splice(cache_list.begin(), cache_list, i->second);
+        }
         else
-            _render<depth24_t>(image);
+        {
+            cache_misses++;
+            if ((int)cache_map.size() >= CACHE_SIZE)
+            {
+                cache_map.erase(cache_list.back().first);
+                cache_list.pop_back();
+            }
+
+            if (image->depth == 16)
+                _render<depth16_t>(image);
+            else
+                _render<depth24_t>(image);
+
+            cache_list.push_front(make_pair(key, vector<unsigned char>(row_bytes*size)));
+            cache_map[key] = cache_list.begin();
+            vector<unsigned char>& pixels = cache_list.front().second;
+            for (int y = 0; y < size; y++)
+                memcpy(&pixels[y*row_bytes], (unsigned char*)image->mem + y*image->bpl, row_bytes);
+            return;
+        }
+
+        vector<unsigned char>& pixels = cache_list.front().second;
+        for (int y = 0; y < size; y++)
+            memcpy((unsigned char*)image->mem + y*image->bpl, &pixels[y*row_bytes], row_bytes);
     }
 };
 
@@ -0,0 +1,149 @@
+# Copyright 2008 by Jens Andersson and Wade Brainerd.
+# This file is part of Colors! XO.
+#
+# Colors is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Colors is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Colors.  If not, see <http://www.gnu.org/licenses/>.
+"""Measuring the latency from an input sample to its pixels being drawn on the screen.
+
+LatencyHistogram collects the latencies of a session and reports percentiles of them.  create_stroke_samples makes up
+input to replay where there is no stylus, see the input latency benchmark in colorsc/benchmark.py.
+
+Nothing in this module depends on GTK or Sugar."""
+
+import math, random
+
+class LatencyHistogram:
+    """Counts latencies in buckets which are wider the longer the latency, as HdrHistogram does.  Every latency from a
+    microsecond to hours is kept to within 1/SUB_BUCKETS of its value, in a few hundred buckets at most, so a whole
+    session can be recorded at a constant small cost per sample."""
+
+    # Latencies are counted in whole microseconds.  Below SUB_BUCKETS microseconds every value has its own bucket,
+    # above that every power of two is split into SUB_BUCKETS/2 buckets.
+    SUB_BITS = 5
+    SUB_BUCKETS = 1<<SUB_BITS
+
+    def __init__ (self):
+        self.reset()
+
+    def reset (self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def get_bucket (self, us):
+        """Returns the index of the bucket counting a latency in microseconds."""
+        shift = 0
+        while us >> (shift + LatencyHistogram.SUB_BITS):
+            shift += 1
+        return shift*(LatencyHistogram.SUB_BUCKETS/2) + (us >> shift)
+
+    def get_bucket_limit (self, index):
+        """Returns the highest latency in microseconds counted by a bucket."""
+        half = LatencyHistogram.SUB_BUCKETS/2
+        shift = max(0, index/half - 1)
+        return ((index - shift*half + 1) << shift) - 1
+
+    def add (self, latency):
+        """Records a latency in seconds."""
+        us = max(0, int(latency*1.0e6))
+        index = self.get_bucket(us)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += latency
+        if self.min is None or latency < self.min:
+            self.min = latency
+        self.max = max(self.max, latency)
+
+    def merge (self, other):
+        for index, n in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def mean (self):
+        if self.count == 0:
+            return 0.0
+        return self.total/self.count
+
+    def percentile (self, p):
+        """Returns the latency in seconds which p percent of the samples are at or below.  This is the top of the
+        bucket it falls in, so it errs on the long side, but never beyond the longest latency recorded."""
+        if self.count == 0:
+            return 0.0
+        rank = max(1, int(math.ceil(self.count*p/100.0)))
+        seen = 0
+        indices = self.buckets.keys()
+        indices.sort()
+        for index in indices:
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.get_bucket_limit(index)/1.0e6, self.max)
+        return self.max
+
+    def get_summary (self):
+        """Returns the usual percentiles, in seconds, as a dictionary."""
+        return {
+            'count': self.count,
+            'mean': self.mean(),
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+    def dump (self, f):
+        """Writes the percentile distribution to a file, in the layout of HdrHistogram's text output."""
+        f.write("%12s %14s %10s %14s\n\n" % ("Value(ms)", "Percentile", "TotalCount", "1/(1-Percentile)"))
+        seen = 0
+        indices = self.buckets.keys()
+        indices.sort()
+        for index in indices:
+            seen += self.buckets[index]
+            fraction = float(seen)/self.count
+            value = min(self.get_bucket_limit(index)/1.0e6, self.max)
+            if fraction < 1.0:
+                f.write("%12.3f %14.12f %10d %14.2f\n" % (value*1000, fraction, seen, 1/(1-fraction)))
+            else:
+                f.write("%12.3f %14.12f %10d\n" % (value*1000, fraction, seen))
+        f.write("#[Mean    = %12.3f, Max     = %12.3f]\n" % (self.mean()*1000, self.max*1000))
+        f.write("#[Total count    = %12d]\n" % self.count)
+
+    def __str__ (self):
+        return "%d samples, p50 %.1fms, p95 %.1fms, p99 %.1fms, max %.1fms" % \
+            (self.count, self.percentile(50)*1000, self.percentile(95)*1000, self.percentile(99)*1000, self.max*1000)
+
+def create_stroke_samples (width, height, strokes=20, samples=50, seed=0):
+    """Returns synthetic stylus input as a list of (x, y, pressure, touching) samples: a number of wandering strokes
+    of the given number of samples each, every one followed by a sample with the stylus lifted.  The same seed always
+    gives the same samples."""
+    rand = random.Random(seed)
+    result = []
+    for i in range(strokes):
+        x = rand.uniform(0, width)
+        y = rand.uniform(0, height)
+        angle = rand.uniform(0, 2*math.pi)
+        for j in range(samples):
+            # Turn a little and move a few pixels, as a hand does between two samples.
+            angle += rand.uniform(-0.3, 0.3)
+            step = rand.uniform(2, 8)
+            x = min(max(x + step*math.cos(angle), 0), width-1)
+            y = min(max(y + step*math.sin(angle), 0), height-1)
+            pressure = int(128 + 127*math.sin(math.pi*j/samples))
+            result.append((int(x), int(y), pressure, True))
+        result.append((int(x), int(y), 0, False))
+    return result
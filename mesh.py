@@ -0,0 +1,108 @@
+# Copyright 2008 by Jens Andersson and Wade Brainerd.
+# This file is part of Colors! XO.
+#
+# Colors is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Colors is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Colors.  If not, see <http://www.gnu.org/licenses/>.
+"""The DBus signals which the peers of a shared activity exchange over a telepathy tube.
+
+The activity imports this module only once it is shared or joins a shared activity, so that DBus and telepathy are
+not loaded at all when painting alone.  The protocol is described in the mesh networking section of colors.py."""
+
+import telepathy
+from dbus.service import signal
+from dbus.gobject_service import ExportedGObject
+from sugar.presence.tubeconn import TubeConnection
+
+# DBUS identifiers are used to uniquely identify the activity for network communcations.
+DBUS_IFACE   = "org.laptop.community.Colors"
+DBUS_PATH    = "/org/laptop/community/Colors"
+DBUS_SERVICE = DBUS_IFACE
+
+class ColorsMesh(ExportedGObject):
+    """The object exported on the tube.  Calling one of its signals sends it to every peer, and each signal received
+    is passed on to the Receive method of the activity which handles it."""
+
+    def __init__ (self, activity, conn, tubes_chan, text_chan, id):
+        # Create the TubeConnection object to manage the connection.
+        self.tube = TubeConnection(conn,
+            tubes_chan[telepathy.CHANNEL_TYPE_TUBES],
+            id, group_iface=text_chan[telepathy.CHANNEL_INTERFACE_GROUP])
+        ExportedGObject.__init__(self, self.tube, DBUS_PATH)
+
+        # Set up DBUS Signal receiviers.
+        self.tube.add_signal_receiver(activity.ReceiveHello,        'BroadcastHello',        DBUS_IFACE, path=DBUS_PATH)
+        self.tube.add_signal_receiver(activity.ReceiveCanvasMode,   'BroadcastCanvasMode',   DBUS_IFACE, path=DBUS_PATH)
+        self.tube.add_signal_receiver(activity.ReceiveClear,        'BroadcastClear',        DBUS_IFACE, path=DBUS_PATH)
+        self.tube.add_signal_receiver(activity.ReceiveSnapshot,     'BroadcastSnapshot',     DBUS_IFACE, path=DBUS_PATH)
+        self.tube.add_signal_receiver(activity.ReceiveSubmit,       'SubmitDrawCommands',    DBUS_IFACE, path=DBUS_PATH)
+        self.tube.add_signal_receiver(activity.ReceiveDrawCommands, 'BroadcastDrawCommands', DBUS_IFACE, path=DBUS_PATH)
+        self.tube.add_signal_receiver(activity.ReceiveDrawSeq,      'BroadcastDrawSeq',      DBUS_IFACE, path=DBUS_PATH)
+        self.tube.add_signal_receiver(activity.ReceiveRequest,      'RequestDrawCommands',   DBUS_IFACE, path=DBUS_PATH)
+        self.tube.add_signal_receiver(activity.ReceiveSnapshotRequest, 'RequestSnapshot',    DBUS_IFACE, path=DBUS_PATH)
+        self.tube.add_signal_receiver(activity.ReceivePlayback,     'BroadcastPlayback',     DBUS_IFACE, path=DBUS_PATH)
+
+    # Notes about DBUS signals:
+    # - When you call a @signal function, its implementation is invoked, and the registered callback is invoked on all
+    #   the peers (including the one who invoked the signal!).  So it's usually best for the @signal function to do
+    #   nothing at all.
+    # - The 'signature' describes the parameters to the function.
+
+    @signal(dbus_interface=DBUS_IFACE, signature='')
+    def BroadcastHello (self):
+        """Broadcast signal sent when a client joins the shared activity."""
+        pass
+
+    @signal(dbus_interface=DBUS_IFACE, signature='')
+    def BroadcastCanvasMode (self):
+        """Broadcast signal for forcing clients into Canvas mode."""
+        pass
+
+    @signal(dbus_interface=DBUS_IFACE, signature='')
+    def BroadcastClear (self):
+        """Broadcast signal for clearing the canvas."""
+        pass
+
+    @signal(dbus_interface=DBUS_IFACE, signature='ayii')
+    def BroadcastSnapshot (self, cmds, ncommands, seq):
+        """Broadcast signal containing the entire master command list, followed by batch number seq."""
+        pass
+
+    @signal(dbus_interface=DBUS_IFACE, signature='ayi')
+    def SubmitDrawCommands (self, cmds, ncommands):
+        """Signal sent by any peer to submit drawing commands to the host for sequencing."""
+        pass
+
+    @signal(dbus_interface=DBUS_IFACE, signature='ayiii')
+    def BroadcastDrawCommands (self, cmds, ncommands, seq, base):
+        """Broadcast signal for drawing commands.  The batch has sequence number seq and starts at command index base."""
+        pass
+
+    @signal(dbus_interface=DBUS_IFACE, signature='i')
+    def BroadcastDrawSeq (self, seq):
+        """Broadcast signal from the host announcing that seq is the number of the next batch."""
+        pass
+
+    @signal(dbus_interface=DBUS_IFACE, signature='ii')
+    def RequestDrawCommands (self, first, last):
+        """Signal sent by a peer to ask the host to rebroadcast batches first to last inclusive."""
+        pass
+
+    @signal(dbus_interface=DBUS_IFACE, signature='')
+    def RequestSnapshot (self):
+        """Signal sent by a peer which has lost track of the master state, to ask the host for a snapshot."""
+        pass
+
+    @signal(dbus_interface=DBUS_IFACE, signature='bii')
+    def BroadcastPlayback (self, playing, playback_pos, playback_speed):
+        """Broadcast signal controlling playback.  Not yet used."""
+        pass
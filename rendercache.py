@@ -0,0 +1,142 @@
+# Copyright 2008 by Jens Andersson and Wade Brainerd.
+# This file is part of Colors! XO.
+#
+# Colors is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Colors is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Colors.  If not, see <http://www.gnu.org/licenses/>.
+"""A cache on disk of the pixels drawings replay to, so that resuming a drawing from the Journal need not replay it.
+
+Each entry holds the pixels from Canvas.get_playback_pixels after replaying a whole drawing, compressed, and is named
+after a key made from the drawing's commands and the canvas size (see get_key), with its number of commands and the
+canvas size, all of which are checked again in the entry's header when it is read.  The key leaves out the rest of
+the .drw file, as the snapshots saved with the commands change without changing the pixels.
+
+Invalidation is by name: a drawing whose commands change has a different hash, so its old entry is never found again,
+and is left for trim to delete.  An entry whose header doesn't match its name, or which cannot be read, is deleted
+when found.  Changing VERSION, e.g. along with the rasterizer, makes every existing entry unreadable in the same way.
+
+The cache is kept under max_bytes by trim, which deletes the least recently used entries first.  Reading an entry
+touches its file, so the modification times order the entries by use.
+
+Entries must only ever be stored from replaying a drawing, never from the canvas it was painted on: painting live
+draws slightly differently, see Canvas.command_draw.
+
+Nothing in this module depends on GTK or Sugar."""
+
+import os, struct, zlib, hashlib
+
+class RenderCache:
+    MAGIC = 'CLRC'
+    VERSION = 1
+
+    # File layout: the header, then the compressed pixels.
+    HEADER = '<4sIIII20s'   # Magic, version, width, height, number of commands, key.
+    SUFFIX = '.cache'
+
+    def __init__ (self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def get_key (self, commands, width, height):
+        """Returns the hash which the entries for a drawing are stored under, given its commands as the string from
+        Canvas.send_drw_commands and the size of the canvas it is replayed on."""
+        h = hashlib.sha1(struct.pack('<II', width, height))
+        h.update(commands)
+        return h.hexdigest()
+
+    def get_entry_path (self, key, ncommands, width, height):
+        return os.path.join(self.path, '%s-%d-%dx%d%s' % (key, ncommands, width, height, RenderCache.SUFFIX))
+
+    def load (self, key, ncommands, width, height):
+        """Returns the pixels stored for a drawing, or None if there are none."""
+        path = self.get_entry_path(key, ncommands, width, height)
+        try:
+            f = open(path, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        except IOError:
+            return None
+
+        size = struct.calcsize(RenderCache.HEADER)
+        try:
+            header = struct.unpack(RenderCache.HEADER, data[:size])
+            if header != (RenderCache.MAGIC, RenderCache.VERSION, width, height, ncommands, key.decode('hex')):
+                raise ValueError("header does not match")
+            pixels = zlib.decompress(data[size:])
+        except (struct.error, ValueError, zlib.error):
+            self.remove(path)
+            return None
+
+        # Mark the entry as recently used.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return pixels
+
+    def store (self, key, ncommands, width, height, pixels):
+        """Stores the pixels for a drawing, then trims the cache.  The entry is written to a temporary file first and
+        then renamed, so that it is never seen half written."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        path = self.get_entry_path(key, ncommands, width, height)
+        tmppath = path + '.tmp'
+        f = open(tmppath, 'wb')
+        try:
+            f.write(struct.pack(RenderCache.HEADER, RenderCache.MAGIC, RenderCache.VERSION, width, height, ncommands,
+                key.decode('hex')))
+            f.write(zlib.compress(pixels))
+        finally:
+            f.close()
+        os.rename(tmppath, path)
+        self.trim()
+
+    def remove (self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def get_entries (self):
+        """Returns the entries as (modification time, size, path), least recently used first."""
+        entries = []
+        if not os.path.isdir(self.path):
+            return entries
+        for name in os.listdir(self.path):
+            if name.endswith(RenderCache.SUFFIX):
+                path = os.path.join(self.path, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        return entries
+
+    def get_size (self):
+        return sum([size for mtime, size, path in self.get_entries()])
+
+    def trim (self):
+        """Deletes the least recently used entries until the cache fits in max_bytes."""
+        entries = self.get_entries()
+        total = sum([size for mtime, size, path in entries])
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    def clear (self):
+        for mtime, size, path in self.get_entries():
+            self.remove(path)
@@ -0,0 +1,370 @@
+# Copyright 2008 by Jens Andersson and Wade Brainerd.
+# This file is part of Colors! XO.
+#
+# Colors is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Colors is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Colors.  If not, see <http://www.gnu.org/licenses/>.
+"""Videopaint camera capture and object tracking, run on a worker thread so that it never blocks the GTK main loop.
+
+The worker repeatedly captures a camera frame and analyzes it, and publishes only the most recent result.  The main
+loop polls for that result without blocking; results which are superseded before the main loop gets to them are
+simply dropped, so the cursor always follows the newest frame.
+
+Nothing in this module depends on GTK or Sugar, and the camera and analyzer are both pluggable, so the pipeline can be
+exercised with FakeCamera and a stand-in analyzer where there is no webcam.  Running the module checks the tracker and
+the worker that way, on synthetic frames of a green disc moving in a circle:
+
+    python videopaint.py [--frames N] [--fps FPS] [--seconds S]"""
+
+import math, sys, threading, time
+from optparse import OptionParser
+
+class VideoPaintResult:
+    """The outcome of analyzing one camera frame."""
+    def __init__ (self, pos, count, capture_time, analyzed_time):
+        self.pos = pos                     # Centroid of the tracked object, in analysis frame coordinates.
+        self.count = count                 # Size of the tracked object in pixels.
+        self.capture_time = capture_time   # time.time() when the frame was captured.
+        self.analyzed_time = analyzed_time # time.time() when the analysis finished.
+
+class BlobAnalyzer:
+    """Tracks the largest OLPC green object in camera frames using the Pygame mask module.
+
+    Once the object has been found, only a region of interest around its last position is converted and searched,
+    which is much cheaper than the whole frame.  The full frame is only scanned again when the object is lost or
+    leaves the region.  Position and size are smoothed over time, more strongly for the small movements which are
+    mostly camera noise."""
+    SIZE = (240,180)
+
+    # Smallest object which is not just noise, in pixels.
+    MIN_COUNT = 2000
+
+    # Region of interest half size, in multiples of the object radius, plus a fixed margin for fast movement.  The half
+    # size is rounded up to a multiple of ROI_STEP so that it stays the same while the object size wobbles, and the
+    # surfaces for it only need to be reallocated when the object really grows or shrinks.
+    ROI_SCALE = 2.0
+    ROI_MARGIN = 16
+    ROI_STEP = 8
+
+    # Smoothing weights given to the new measurement.  Movements shorter than JITTER pixels get the stronger smoothing.
+    JITTER = 4.0
+    POS_SMOOTH_SLOW = 0.3
+    POS_SMOOTH_FAST = 0.8
+    COUNT_SMOOTH = 0.25
+
+    def __init__ (self, capture):
+        from pygame import surface
+        self.camsmall = surface.Surface(BlobAnalyzer.SIZE, 0, capture)
+        self.camhsv = surface.Surface(BlobAnalyzer.SIZE, 0, capture)
+        # Region of interest surfaces, reused for as long as the region keeps its size.
+        self.roismall = None
+        self.roihsv = None
+        self.reset()
+
+    def reset (self):
+        self.pos = None
+        self.count = 0
+        # Statistics, for measuring the tracker.
+        self.roi_hits = 0
+        self.full_scans = 0
+
+    def get_roi (self):
+        """Returns the region of interest around the last position as (x, y, w, h).  Near the edges the region is moved
+        inside the frame rather than clipped, so that its size does not change; it is only clipped when larger than
+        the frame."""
+        from pygame import Rect
+        r = int(math.sqrt(self.count/math.pi) * BlobAnalyzer.ROI_SCALE) + BlobAnalyzer.ROI_MARGIN
+        r = -(-r // BlobAnalyzer.ROI_STEP) * BlobAnalyzer.ROI_STEP
+        frame = Rect((0,0), BlobAnalyzer.SIZE)
+        roi = Rect(int(self.pos[0])-r, int(self.pos[1])-r, 2*r, 2*r)
+        return roi.clamp(frame).clip(frame)
+
+    def find (self, rect):
+        """Finds the largest object in the given part of the frame.  Returns (centroid, count, bounds) in frame
+        coordinates, or None."""
+        from pygame import camera, mask, surface
+        # convert colorspace to HSV, good for object tracking
+        if rect.size == BlobAnalyzer.SIZE:
+            hsv = self.camhsv = camera.colorspace(self.camsmall, "HSV", self.camhsv)
+        else:
+            # colorspace() ignores the pitch of subsurfaces, so copy the region out first.
+            if self.roismall is None or self.roismall.get_size() != rect.size:
+                self.roismall = surface.Surface(rect.size, 0, self.camsmall)
+                self.roihsv = surface.Surface(rect.size, 0, self.camsmall)
+            self.roismall.blit(self.camsmall, (0,0), rect)
+            hsv = self.roihsv = camera.colorspace(self.roismall, "HSV", self.roihsv)
+        # currently just threshold the OLPC green color.
+        cammask = mask.from_threshold(hsv, (90,128,128), (50,120,120))
+        # find the largest object in the mask
+        camcomponent = cammask.connected_component()
+        camcount = camcomponent.count()
+        # make sure its not just noise
+        if camcount <= BlobAnalyzer.MIN_COUNT:
+            return None
+        pos = camcomponent.centroid()
+        bounds = camcomponent.get_bounding_rects()[0].move(rect.x, rect.y)
+        return (pos[0]+rect.x, pos[1]+rect.y), camcount, bounds
+
+    def __call__ (self, frame):
+        """Returns the smoothed (centroid, count) of the tracked object, or None if it was not found."""
+        from pygame import transform, Rect
+        # scale it to a quarter the size before colorspace conversion
+        self.camsmall = transform.scale(frame, BlobAnalyzer.SIZE, self.camsmall)
+
+        found = None
+        if self.pos:
+            roi = self.get_roi()
+            found = self.find(roi)
+            # An object touching the edge of the region may continue outside it, so measure it over the whole frame.
+            if found:
+                bounds = found[2]
+                if (bounds.left <= roi.left and roi.left > 0) or (bounds.top <= roi.top and roi.top > 0) or \
+                   (bounds.right >= roi.right and roi.right < BlobAnalyzer.SIZE[0]) or \
+                   (bounds.bottom >= roi.bottom and roi.bottom < BlobAnalyzer.SIZE[1]):
+                    found = None
+                else:
+                    self.roi_hits += 1
+        if not found:
+            self.full_scans += 1
+            found = self.find(Rect((0,0), BlobAnalyzer.SIZE))
+        if not found:
+            self.pos = None
+            self.count = 0
+            return None
+
+        pos, count = found[0], found[1]
+        if self.pos:
+            dx = pos[0]-self.pos[0]
+            dy = pos[1]-self.pos[1]
+            if dx*dx+dy*dy < BlobAnalyzer.JITTER*BlobAnalyzer.JITTER:
+                k = BlobAnalyzer.POS_SMOOTH_SLOW
+            else:
+                k = BlobAnalyzer.POS_SMOOTH_FAST
+            pos = (self.pos[0] + k*dx, self.pos[1] + k*dy)
+            count = self.count + BlobAnalyzer.COUNT_SMOOTH*(count-self.count)
+        self.pos = pos
+        self.count = count
+        return pos, int(count)
+
+class FakeCamera:
+    """Stand-in for pygame.camera.Camera.  Serves the given frames in a loop at the given rate, for testing and
+    measuring the videopaint pipeline without a webcam."""
+    def __init__ (self, frames, fps=30.0):
+        self.frames = frames
+        self.interval = 1.0/fps
+        self.index = 0
+        self.next_time = 0
+        self.started = False
+
+    def start (self):
+        self.started = True
+        self.next_time = time.time()
+
+    def stop (self):
+        self.started = False
+
+    def set_controls (self, **kwargs):
+        pass
+
+    def query_image (self):
+        return self.started and time.time() >= self.next_time
+
+    def get_image (self, dest=None):
+        # Block until the next frame is due, as a real camera does.
+        delay = self.next_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_time = max(self.next_time + self.interval, time.time())
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        return frame
+
+class VideoPaintWorker(threading.Thread):
+    """Captures and analyzes camera frames on a background thread, publishing only the latest result."""
+
+    # How long to sleep when the camera has no new frame yet.
+    POLL_INTERVAL = 0.005
+
+    def __init__ (self, cam, analyze, capture=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.cam = cam
+        self.analyze = analyze
+        self.capture = capture
+        self.lock = threading.Lock()
+        self.result = None
+        self.running = False
+        # Statistics, for measuring the pipeline.
+        self.frames_captured = 0
+        self.frames_dropped = 0
+
+    def run (self):
+        while self.running:
+            if not self.cam.query_image():
+                time.sleep(VideoPaintWorker.POLL_INTERVAL)
+                continue
+            self.capture = self.cam.get_image(self.capture)
+            capture_time = time.time()
+            found = self.analyze(self.capture)
+            self.frames_captured += 1
+            if found is None:
+                continue
+            pos, count = found
+            result = VideoPaintResult(pos, count, capture_time, time.time())
+            self.lock.acquire()
+            try:
+                if self.result is not None:
+                    self.frames_dropped += 1
+                self.result = result
+            finally:
+                self.lock.release()
+        # Stopping the camera here rather than from the main loop means it is never stopped in the middle of a capture.
+        self.cam.stop()
+
+    def start (self):
+        self.running = True
+        threading.Thread.start(self)
+
+    def stop (self):
+        """Asks the thread to finish after the current frame and stop the camera.  Does not wait for it."""
+        self.running = False
+
+    def get_result (self):
+        """Returns the newest result not yet returned, or None.  Never blocks on the camera."""
+        self.lock.acquire()
+        try:
+            result = self.result
+            self.result = None
+        finally:
+            self.lock.release()
+        return result
+
+class LatencyStats:
+    """Accumulates latencies in seconds, e.g. from frame capture to cursor update."""
+    def __init__ (self):
+        self.reset()
+
+    def reset (self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add (self, latency):
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+        self.last = latency
+
+    def mean (self):
+        if self.count == 0:
+            return 0.0
+        return self.total/self.count
+
+    def __str__ (self):
+        return "%d samples, mean %.1fms, max %.1fms, last %.1fms" % \
+            (self.count, self.mean()*1000, self.max*1000, self.last*1000)
+
+# Synthetic frames for the __main__ check.  The disc colour is inside BlobAnalyzer's green threshold and the grey
+# background is not; the disc is large enough to be tracked at the analysis size.
+CAMERA_SIZE = (320,240)
+DISC_COLOR = (40,160,60)
+DISC_RADIUS = 40
+BACKGROUND_COLOR = (128,128,128)
+CIRCLE_RADIUS = 60
+
+# Largest allowed distance, in analysis frame pixels, between the tracked position and the disc centre.
+MAX_ERROR = 6.0
+
+def make_frames (count):
+    """Returns count camera sized frames, and the disc centre in each in analysis frame coordinates."""
+    import pygame
+    frames = []
+    centers = []
+    sx = float(BlobAnalyzer.SIZE[0])/CAMERA_SIZE[0]
+    sy = float(BlobAnalyzer.SIZE[1])/CAMERA_SIZE[1]
+    for i in range(count):
+        a = 2*math.pi*i/count
+        x = CAMERA_SIZE[0]/2 + int(CIRCLE_RADIUS*math.cos(a))
+        y = CAMERA_SIZE[1]/2 + int(CIRCLE_RADIUS*math.sin(a))
+        frame = pygame.Surface(CAMERA_SIZE, 0, 24)
+        frame.fill(BACKGROUND_COLOR)
+        pygame.draw.circle(frame, DISC_COLOR, (x, y), DISC_RADIUS)
+        frames.append(frame)
+        centers.append(((x+0.5)*sx, (y+0.5)*sy))
+    return frames, centers
+
+def check_tracking (frames, centers):
+    """Runs the analyzer over two loops of the frames and returns a list of errors.  The first frame is always a full
+    scan; after that the object should be found in the region of interest every time."""
+    errors = []
+    analyze = BlobAnalyzer(frames[0])
+    start = time.time()
+    for i in range(2*len(frames)):
+        found = analyze(frames[i % len(frames)])
+        cx, cy = centers[i % len(frames)]
+        if found is None:
+            errors.append("frame %d: disc at (%d, %d) not found" % (i, cx, cy))
+            continue
+        pos = found[0]
+        error = math.sqrt((pos[0]-cx)**2 + (pos[1]-cy)**2)
+        if error > MAX_ERROR:
+            errors.append("frame %d: tracked (%d, %d), disc at (%d, %d)" % (i, pos[0], pos[1], cx, cy))
+    elapsed = time.time() - start
+    if analyze.full_scans != 1:
+        errors.append("%d full frame scans, expected 1" % analyze.full_scans)
+    print "Tracker: %d frames, %.2fms per frame, %d region of interest hits, %d full frame scans" % \
+        (2*len(frames), elapsed*1000/(2*len(frames)), analyze.roi_hits, analyze.full_scans)
+    return errors
+
+def check_worker (frames, fps, seconds):
+    """Runs the worker on a FakeCamera, polling it the way colors.py does, and returns a list of errors."""
+    errors = []
+    cam = FakeCamera(frames, fps)
+    cam.start()
+    worker = VideoPaintWorker(cam, BlobAnalyzer(frames[0]))
+    latency = LatencyStats()
+    worker.start()
+    end = time.time() + seconds
+    while time.time() < end:
+        time.sleep(0.033)
+        result = worker.get_result()
+        if result:
+            latency.add(time.time() - result.capture_time)
+    worker.stop()
+    worker.join()
+    if cam.started:
+        errors.append("worker did not stop the camera")
+    if latency.count == 0:
+        errors.append("worker published no results")
+    print "Worker: %d frames, %d dropped, capture to poll latency %s" % \
+        (worker.frames_captured, worker.frames_dropped, latency)
+    return errors
+
+def main (argv):
+    parser = OptionParser(usage="python videopaint.py [options]")
+    parser.add_option('-n', '--frames', type='int', default=60,
+        help="number of frames in one loop of the disc [%default]")
+    parser.add_option('-f', '--fps', type='float', default=30.0,
+        help="frame rate of the fake camera [%default]")
+    parser.add_option('-s', '--seconds', type='float', default=2.0,
+        help="how long to run the worker for [%default]")
+    options, args = parser.parse_args(argv)
+
+    frames, centers = make_frames(options.frames)
+    errors = check_tracking(frames, centers) + check_worker(frames, options.fps, options.seconds)
+    for e in errors:
+        print "FAIL %s" % e
+    return errors and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))